@@ -0,0 +1,487 @@
+"""
+Admission control for chat turns, in front of ai_service.
+
+Two limits, checked before a turn writes anything:
+- Per-user token bucket (opt-in, USER_RATE_LIMIT_PER_MINUTE, burst
+  USER_RATE_LIMIT_BURST): a user who sends faster than that gets a 429
+  with Retry-After, before they can eat into everyone's Gemini quota.
+  Only turns that reach the LLM are charged: see refund()
+- Global concurrency (LLM_MAX_CONCURRENCY): at most that many turns talk to
+  the LLM at once. Further turns wait in a bounded FIFO queue
+  (LLM_QUEUE_SIZE) for up to LLM_QUEUE_TIMEOUT_SECONDS; a full queue or an
+  expired wait is a 503 with Retry-After
+
+Backends (ADMISSION_BACKEND):
+- "memory": limits apply per worker process
+- "database": buckets and slots live in the rate_limit_buckets / llm_slots
+  tables, so the limits hold across workers. The wait queue itself is
+  still per worker: each worker's first waiter polls for a free slot.
+
+Usage:
+    async with admission_controller.hold(current_user.id):
+        ...  # build the context, call the LLM, save the reply
+"""
+
+import asyncio
+import math
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set
+
+from fastapi import HTTPException, status
+from sqlalchemy import case, func, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import metrics, models
+from .config import settings
+from .database import async_engine
+
+rejections = metrics.REGISTRY.register(metrics.Counter(
+    "admission_rejections_total",
+    "Chat turns refused by admission control (rate_limited, queue_full, queue_timeout).",
+    ("reason",),
+))
+in_flight = metrics.REGISTRY.register(metrics.Gauge(
+    "admission_in_flight",
+    "Chat turns holding an LLM slot in this worker.",
+))
+queue_depth = metrics.REGISTRY.register(metrics.Gauge(
+    "admission_queue_depth",
+    "Chat turns waiting for an LLM slot in this worker.",
+))
+
+
+# ----- Per-user token buckets -----
+
+class MemoryRateLimiter:
+    """Token buckets in a dict; refilled lazily when a user sends a message."""
+
+    # Above this many buckets, full ones are dropped (a missing bucket is a full one)
+    MAX_BUCKETS = 10000
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.burst = float(max(1, burst))
+        self._buckets: Dict[int, List[float]] = {}
+
+    def _refilled(self, bucket: List[float], now: float) -> float:
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    async def take(self, user_id: int) -> float:
+        """Take one token. Returns 0 if granted, else seconds until one is available."""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        tokens = self.burst if bucket is None else self._refilled(bucket, now)
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+        if len(self._buckets) >= self.MAX_BUCKETS and bucket is None:
+            self._prune(now)
+        self._buckets[user_id] = [tokens - 1, now]
+        return 0.0
+
+    async def refund(self, user_id: int) -> None:
+        """Give back a token taken by take() for a turn that never ran."""
+        bucket = self._buckets.get(user_id)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def _prune(self, now: float) -> None:
+        for user_id in [u for u, b in self._buckets.items() if self._refilled(b, now) >= self.burst]:
+            del self._buckets[user_id]
+
+
+class DatabaseRateLimiter:
+    """
+    Token buckets in the rate_limit_buckets table, shared by all workers.
+
+    Refill and take happen in one conditional UPDATE, so concurrent
+    requests for the same user can't both spend the last token.
+    """
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.burst = float(max(1, burst))
+        self.table = models.RateLimitBucket.__table__
+
+    def _refilled(self, now: float):
+        t = self.table.c
+        tokens = t.tokens + (literal(now) - t.updated_at) * self.rate
+        return case((tokens > self.burst, literal(self.burst)), else_=tokens)
+
+    async def take(self, user_id: int) -> float:
+        now = time.time()
+        t = self.table.c
+        refilled = self._refilled(now)
+        async with async_engine.begin() as conn:
+            result = await conn.execute(
+                update(self.table)
+                .where(t.user_id == user_id, refilled >= 1)
+                .values(tokens=refilled - 1, updated_at=now)
+            )
+            if result.rowcount:
+                return 0.0
+        try:
+            # First message from this user (or since the bucket was cleared)
+            async with async_engine.begin() as conn:
+                await conn.execute(insert(self.table).values(
+                    user_id=user_id, tokens=self.burst - 1, updated_at=now
+                ))
+            return 0.0
+        except IntegrityError:
+            pass
+        # The bucket exists and is empty: work out when it has a token again
+        async with async_engine.connect() as conn:
+            tokens = (await conn.execute(
+                select(refilled).where(t.user_id == user_id)
+            )).scalar()
+        return max((1 - (tokens or 0)) / self.rate, 0.0)
+
+    async def refund(self, user_id: int) -> None:
+        """Give back a token taken by take() for a turn that never ran."""
+        t = self.table.c
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                update(self.table)
+                .where(t.user_id == user_id)
+                .values(tokens=case((t.tokens + 1 > self.burst, literal(self.burst)), else_=t.tokens + 1))
+            )
+
+
+# ----- LLM concurrency slots -----
+
+class MemoryConcurrencyLimiter:
+    """A counter of slots in use in this process."""
+
+    # Nobody else frees slots, so waiters only need waking on release()
+    poll_interval: Optional[float] = None
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.in_use = 0
+
+    async def try_acquire(self) -> Optional[object]:
+        if self.in_use >= self.max_concurrency:
+            return None
+        self.in_use += 1
+        return True
+
+    def release(self, slot: object) -> None:
+        self.in_use -= 1
+
+
+@dataclass
+class _Lease:
+    slot: int
+    holder: str
+
+
+class DatabaseConcurrencyLimiter:
+    """
+    Leases on rows of the llm_slots table, shared by all workers.
+
+    Slot rows 0..max_concurrency-1 are created on first use. A slot is
+    taken with a conditional UPDATE (free or expired -> ours), so two
+    workers can't take the same one. Leases expire after
+    ADMISSION_LEASE_SECONDS in case a worker dies holding one.
+    """
+
+    def __init__(self, max_concurrency: int, lease_seconds: float, poll_interval: float):
+        self.max_concurrency = max_concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.table = models.LLMSlot.__table__
+        self._ready = False
+        # Releases run in the background; kept so they aren't garbage-collected
+        self._releases: Set[asyncio.Task] = set()
+
+    async def _ensure_slots(self) -> None:
+        if self._ready:
+            return
+        async with async_engine.connect() as conn:
+            existing = set((await conn.execute(select(self.table.c.slot))).scalars().all())
+        for slot in range(self.max_concurrency):
+            if slot in existing:
+                continue
+            try:
+                async with async_engine.begin() as conn:
+                    await conn.execute(insert(self.table).values(slot=slot))
+            except IntegrityError:
+                pass  # Another worker created it first
+        self._ready = True
+
+    async def try_acquire(self) -> Optional[_Lease]:
+        await self._ensure_slots()
+        now = time.time()
+        t = self.table.c
+        free = (t.holder.is_(None)) | (t.expires_at < now)
+        # A random free slot, so workers don't all race for the same row
+        candidate = (
+            select(t.slot)
+            .where(free, t.slot < self.max_concurrency)
+            .order_by(func.random())
+            .limit(1)
+            .scalar_subquery()
+        )
+        holder = uuid.uuid4().hex
+        async with async_engine.begin() as conn:
+            # `free` is checked again on the row itself: if another worker
+            # took it in the meantime, nothing is updated
+            slot = (await conn.execute(
+                update(self.table)
+                .where(t.slot == candidate, free)
+                .values(holder=holder, expires_at=now + self.lease_seconds)
+                .returning(t.slot)
+            )).scalar()
+        return None if slot is None else _Lease(slot, holder)
+
+    def release(self, lease: _Lease) -> None:
+        task = asyncio.get_running_loop().create_task(self._release(lease))
+        self._releases.add(task)
+        task.add_done_callback(self._releases.discard)
+
+    async def _release(self, lease: _Lease) -> None:
+        t = self.table.c
+        try:
+            async with async_engine.begin() as conn:
+                await conn.execute(
+                    update(self.table)
+                    .where(t.slot == lease.slot, t.holder == lease.holder)
+                    .values(holder=None, expires_at=None)
+                )
+        except Exception as e:
+            # The lease runs out on its own
+            print(f"⚠️ Could not release LLM slot {lease.slot}: {e}")
+
+    async def close(self) -> None:
+        if self._releases:
+            await asyncio.gather(*self._releases, return_exceptions=True)
+
+
+# ----- Controller -----
+
+# Slot of a turn admitted while the slot store was unreachable: nothing to release
+UNTRACKED = object()
+
+
+@dataclass
+class Ticket:
+    """An admitted turn; hand it back to AdmissionController.release()."""
+    slot: Optional[object]
+    admitted_at: float
+
+
+class AdmissionController:
+    """
+    Rate limit, then a slot (or a place in the queue for one).
+
+    Either limiter may be None (that limit is off). Not thread-safe: it is
+    only used from the event loop.
+    """
+
+    def __init__(
+        self,
+        rate_limiter=None,
+        concurrency_limiter=None,
+        queue_size: int = 0,
+        queue_timeout_seconds: float = 0.0
+    ):
+        self.rate_limiter = rate_limiter
+        self.slots = concurrency_limiter
+        self.queue_size = queue_size
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._waiters: Deque[asyncio.Event] = deque()
+        # Moving average of how long a turn holds its slot, for Retry-After
+        self._hold_seconds = 5.0
+
+    def _reject(self, reason: str, code: int, detail: str, retry_after: float) -> HTTPException:
+        rejections.inc(reason=reason)
+        return HTTPException(
+            status_code=code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(math.ceil(retry_after))))}
+        )
+
+    def _queue_retry_after(self) -> float:
+        """Rough time until the queue has drained enough to let one more in."""
+        slots = getattr(self.slots, "max_concurrency", 1) or 1
+        return self._hold_seconds * (len(self._waiters) + 1) / slots
+
+    async def _check_rate(self, user_id: int) -> bool:
+        """Take one of the user's tokens (429 if none). Returns whether one was taken."""
+        try:
+            wait = await self.rate_limiter.take(user_id)
+        except Exception as e:
+            # Fail open: a broken limiter table mustn't take chat down
+            print(f"⚠️ Rate limiter unavailable, admitting user {user_id}: {e}")
+            return False
+        if wait > 0:
+            raise self._reject(
+                "rate_limited",
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Too many messages, please slow down",
+                wait
+            )
+        return True
+
+    async def _refund_rate(self, user_id: int) -> None:
+        try:
+            await self.rate_limiter.refund(user_id)
+        except Exception as e:
+            print(f"⚠️ Could not refund rate limit token for user {user_id}: {e}")
+
+    async def _try_slot(self):
+        try:
+            return await self.slots.try_acquire()
+        except Exception as e:
+            print(f"⚠️ LLM slot store unavailable, admitting without a slot: {e}")
+            return UNTRACKED
+
+    async def _wait_for_slot(self):
+        if not self._waiters:
+            slot = await self._try_slot()
+            if slot is not None:
+                return slot
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject(
+                "queue_full",
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "The coach is busy right now, please try again shortly",
+                self._queue_retry_after()
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout_seconds
+        wakeup = asyncio.Event()
+        self._waiters.append(wakeup)
+        queue_depth.inc()
+        try:
+            with metrics.span("admission_wait"):
+                while True:
+                    # Only the head of the queue may take a slot: FIFO
+                    if self._waiters[0] is wakeup:
+                        slot = await self._try_slot()
+                        if slot is not None:
+                            return slot
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise self._reject(
+                            "queue_timeout",
+                            status.HTTP_503_SERVICE_UNAVAILABLE,
+                            "The coach is busy right now, please try again shortly",
+                            self._queue_retry_after()
+                        )
+                    wakeup.clear()
+                    timeout = remaining
+                    if self.slots.poll_interval is not None:
+                        timeout = min(remaining, self.slots.poll_interval)
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._waiters.remove(wakeup)
+            queue_depth.dec()
+            if self._waiters:
+                self._waiters[0].set()  # Next in line
+
+    async def acquire(self, user_id: int) -> Optional[Ticket]:
+        """
+        Admit a turn for a user, waiting in the queue if needed.
+
+        Returns:
+            A Ticket to pass to release() once the turn is done, or None
+            if no limit is configured
+
+        A turn turned away with a 503 (or cancelled while queued) gets its
+        rate limit token back: it never reached the LLM, and the client is
+        told to retry.
+
+        Raises:
+            HTTPException 429 (user over their rate) or 503 (queue full or
+            waited too long), each with a Retry-After header
+        """
+        charged = False
+        if self.rate_limiter is not None:
+            charged = await self._check_rate(user_id)
+        if self.slots is None:
+            return None
+        try:
+            slot = await self._wait_for_slot()
+        except BaseException:
+            if charged:
+                await self._refund_rate(user_id)
+            raise
+        in_flight.inc()
+        return Ticket(slot=slot, admitted_at=time.monotonic())
+
+    async def refund(self, user_id: int) -> None:
+        """
+        Give back the rate limit token acquire() took, for a turn refused
+        after admission but before it reached the LLM (e.g. a 404 for an
+        unknown conversation).
+        """
+        if self.rate_limiter is not None:
+            await self._refund_rate(user_id)
+
+    def release(self, ticket: Optional[Ticket]) -> None:
+        if ticket is None:
+            return
+        in_flight.dec()
+        held = time.monotonic() - ticket.admitted_at
+        self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held
+        if ticket.slot is not UNTRACKED:
+            self.slots.release(ticket.slot)
+        if self._waiters:
+            self._waiters[0].set()
+
+    @asynccontextmanager
+    async def hold(self, user_id: int) -> AsyncIterator[None]:
+        ticket = await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    async def close(self) -> None:
+        """Wait for slot releases still in flight (database backend)."""
+        close = getattr(self.slots, "close", None)
+        if close is not None:
+            await close()
+
+
+def build_controller() -> AdmissionController:
+    """AdmissionController configured from settings."""
+    shared = settings.ADMISSION_BACKEND == "database"
+    if settings.ADMISSION_BACKEND not in ("memory", "database"):
+        raise ValueError(
+            f"Unknown ADMISSION_BACKEND {settings.ADMISSION_BACKEND!r} (expected 'memory' or 'database')"
+        )
+
+    rate_limiter = None
+    if settings.USER_RATE_LIMIT_PER_MINUTE > 0:
+        limiter_class = DatabaseRateLimiter if shared else MemoryRateLimiter
+        rate_limiter = limiter_class(settings.USER_RATE_LIMIT_PER_MINUTE, settings.USER_RATE_LIMIT_BURST)
+
+    concurrency_limiter = None
+    if settings.LLM_MAX_CONCURRENCY > 0:
+        if shared:
+            concurrency_limiter = DatabaseConcurrencyLimiter(
+                settings.LLM_MAX_CONCURRENCY,
+                settings.ADMISSION_LEASE_SECONDS,
+                settings.ADMISSION_POLL_INTERVAL_MS / 1000,
+            )
+        else:
+            concurrency_limiter = MemoryConcurrencyLimiter(settings.LLM_MAX_CONCURRENCY)
+
+    return AdmissionController(
+        rate_limiter,
+        concurrency_limiter,
+        queue_size=settings.LLM_QUEUE_SIZE,
+        queue_timeout_seconds=settings.LLM_QUEUE_TIMEOUT_SECONDS,
+    )
+
+
+admission_controller = build_controller()
@@ -1,33 +1,99 @@
 """
-AI Service for Google Gemini integration.
+AI Service for the coach's LLM.
 
 Handles all AI interactions including:
 - Building conversation history from database
 - Injecting personality into system prompts
-- Generating AI responses
+- Generating AI responses (blocking and asyncio variants)
+
+The LLM itself sits behind llm_backends.LLMBackend (Gemini in production,
+a deterministic fake offline), chosen by settings.LLM_BACKEND.
 """
 
-import google.generativeai as genai
-from typing import List, Dict
+from typing import Dict, List, Optional, Tuple
 from .config import settings
-from .personalities import get_personality
-from . import models
+from .llm_backends import get_backend
+from .response_cache import ResponseCache, make_key
+from . import metrics, models
+
+# Opt-in cache of replies to repeated turns (see response_cache.py)
+# None when RESPONSE_CACHE_ENABLED is off
+response_cache: Optional[ResponseCache] = (
+    ResponseCache(
+        max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+        variants=settings.RESPONSE_CACHE_VARIANTS
+    )
+    if settings.RESPONSE_CACHE_ENABLED else None
+)
+metrics.REGISTRY.register(metrics.StatsCollector(
+    "response_cache",
+    "Cached replies to repeated turns, from ResponseCache.stats()",
+    lambda: None if response_cache is None else response_cache.stats(),
+))
+
+
+def lookup_cached_response(
+    personality_name: str,
+    history: List[Dict[str, str]],
+    user_message: str
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Check the response cache for this turn.
+    
+    Returns:
+        (cache_key, cached_reply) - cache_key is None when the cache is off,
+        cached_reply is None on a miss
+    """
+    if response_cache is None:
+        return None, None
+    cache_key = make_key(personality_name, history, user_message)
+    return cache_key, response_cache.get(cache_key)
+
 
-# Configure Gemini API
-genai.configure(api_key=settings.GEMINI_API_KEY)
+def warm_up() -> None:
+    """Prepare the configured LLM backend (e.g. pre-build Gemini clients)."""
+    get_backend().warm()
 
 
-def build_conversation_history(messages: List[models.Message]) -> List[Dict[str, str]]:
+def build_conversation_history(
+    messages: List[models.Message],
+    summary: Optional[str] = None,
+    recalled: Optional[List[str]] = None
+) -> List[Dict[str, str]]:
     """
     Convert database messages to Gemini chat history format.
     
     Args:
         messages: List of Message objects from database
+        summary: Optional rolling summary of older turns that were left out
+                 of `messages` (see context_builder.py)
+        recalled: Optional snippets of the user's other conversations
+                  (see retrieval.py)
         
     Returns:
         List of message dictionaries in Gemini format
     """
     history = []
+    if recalled:
+        history.append({
+            "role": "user",
+            "parts": ["(From our other conversations, in case it's relevant)\n" + "\n".join(recalled)]
+        })
+        history.append({
+            "role": "model",
+            "parts": ["Noted, I'll keep that in mind."]
+        })
+    if summary:
+        # Prepend the summary as an exchange so roles keep alternating
+        history.append({
+            "role": "user",
+            "parts": [f"(Summary of our earlier conversation, for context)\n{summary}"]
+        })
+        history.append({
+            "role": "model",
+            "parts": ["Got it, I remember."]
+        })
     for msg in messages:
         # Gemini uses "user" and "model" roles
         role = "user" if msg.role == "user" else "model"
@@ -41,77 +107,201 @@ def build_conversation_history(messages: List[models.Message]) -> List[Dict[str,
 def generate_response(
     user_message: str,
     conversation_history: List[models.Message],
-    personality_name: str = "sophia"
+    personality_name: str = "sophia",
+    summary: Optional[str] = None,
+    recalled: Optional[List[str]] = None
 ) -> str:
     """
-    Generate an AI response using Google Gemini with personality injection.
+    Generate an AI response with personality injection.
     
     Args:
         user_message: The user's current message
         conversation_history: Previous messages in this conversation
         personality_name: Name of the personality to use (default: "sophia")
+        summary: Optional rolling summary of turns not in conversation_history
+        recalled: Optional snippets of the user's other conversations
         
     Returns:
         AI-generated response text
     """
-    # Get personality configuration
-    personality = get_personality(personality_name)
-    system_prompt = personality["system_prompt"]
-    
-    # Initialize Gemini model
-    # Using gemini-2.5-flash for free tier with long context
-    model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        system_instruction=system_prompt
-    )
-    
     # Build chat history
-    history = build_conversation_history(conversation_history)
+    history = build_conversation_history(conversation_history, summary, recalled)
+    
+    # Repeated turn? Skip the LLM entirely
+    cache_key, cached = lookup_cached_response(personality_name, history, user_message)
+    if cached is not None:
+        return cached
+    
+    # Generate response (the backend injects the personality's system prompt)
+    response = get_backend().generate(personality_name, history, user_message)
+    if cache_key:
+        response_cache.add(cache_key, response)
+    return response
+
+
+async def generate_response_async(
+    user_message: str,
+    conversation_history: List[models.Message],
+    personality_name: str = "sophia",
+    summary: Optional[str] = None,
+    recalled: Optional[List[str]] = None
+) -> str:
+    """
+    Awaitable version of generate_response.
+    
+    Uses the backend's asyncio path, so the event loop stays free while
+    the model is thinking instead of blocking a threadpool worker.
     
-    # Start chat with history
-    chat = model.start_chat(history=history)
+    Args:
+        user_message: The user's current message
+        conversation_history: Previous messages in this conversation
+        personality_name: Name of the personality to use (default: "sophia")
+        summary: Optional rolling summary of turns not in conversation_history
+        recalled: Optional snippets of the user's other conversations
+        
+    Returns:
+        AI-generated response text
+    """
+    # Build chat history
+    history = build_conversation_history(conversation_history, summary, recalled)
     
-    # Generate response
-    response = chat.send_message(user_message)
+    # Repeated turn? Skip the LLM entirely
+    cache_key, cached = lookup_cached_response(personality_name, history, user_message)
+    if cached is not None:
+        return cached
     
-    return response.text
+    # Generate response without blocking the event loop
+    response = await get_backend().generate_async(personality_name, history, user_message)
+    if cache_key:
+        response_cache.add(cache_key, response)
+    return response
 
 
 def generate_response_streaming(
     user_message: str,
     conversation_history: List[models.Message],
-    personality_name: str = "sophia"
+    personality_name: str = "sophia",
+    summary: Optional[str] = None,
+    recalled: Optional[List[str]] = None
 ):
     """
-    Generate an AI response with streaming (for future real-time updates).
+    Generate an AI response with streaming (blocking iterator).
     
     Args:
         user_message: The user's current message
         conversation_history: Previous messages in this conversation
         personality_name: Name of the personality to use (default: "sophia")
+        summary: Optional rolling summary of turns not in conversation_history
+        recalled: Optional snippets of the user's other conversations
         
     Yields:
         Chunks of AI-generated response text
     """
-    # Get personality configuration
-    personality = get_personality(personality_name)
-    system_prompt = personality["system_prompt"]
-    
-    # Initialize Gemini model
-    model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        system_instruction=system_prompt
-    )
+    # Build chat history
+    history = build_conversation_history(conversation_history, summary, recalled)
+    
+    # Repeated turn? Replay the cached reply as a single chunk
+    cache_key, cached = lookup_cached_response(personality_name, history, user_message)
+    if cached is not None:
+        yield cached
+        return
     
+    # Generate response with streaming
+    parts = []
+    for chunk in get_backend().stream(personality_name, history, user_message):
+        parts.append(chunk)
+        yield chunk
+    if cache_key:
+        response_cache.add(cache_key, "".join(parts))
+
+
+async def generate_response_streaming_async(
+    user_message: str,
+    conversation_history: List[models.Message],
+    personality_name: str = "sophia",
+    summary: Optional[str] = None,
+    recalled: Optional[List[str]] = None
+):
+    """
+    Async generator version of generate_response_streaming.
+    
+    Used by the SSE endpoint so each chunk can be forwarded to the client
+    the moment the model produces it.
+    
+    Args:
+        user_message: The user's current message
+        conversation_history: Previous messages in this conversation
+        personality_name: Name of the personality to use (default: "sophia")
+        summary: Optional rolling summary of turns not in conversation_history
+        recalled: Optional snippets of the user's other conversations
+        
+    Yields:
+        Chunks of AI-generated response text
+    """
     # Build chat history
-    history = build_conversation_history(conversation_history)
+    history = build_conversation_history(conversation_history, summary, recalled)
     
-    # Start chat with history
-    chat = model.start_chat(history=history)
+    # Repeated turn? Replay the cached reply as a single chunk
+    cache_key, cached = lookup_cached_response(personality_name, history, user_message)
+    if cached is not None:
+        yield cached
+        return
     
     # Generate response with streaming
-    response = chat.send_message(user_message, stream=True)
+    parts = []
+    async for chunk in get_backend().stream_async(personality_name, history, user_message):
+        parts.append(chunk)
+        yield chunk
+    # Only complete replies are cached (not ones cut short by a disconnect)
+    if cache_key:
+        response_cache.add(cache_key, "".join(parts))
+
+
+SUMMARIZER_PROMPT = """You maintain running notes on a coaching conversation between a user and their mindset coach.
+
+You are given the existing notes (possibly empty) and the next few messages. Return updated notes that:
+- Keep the user's goals, struggles, commitments, patterns and important personal details
+- Keep any advice or challenges the coach gave and how the user responded
+- Drop small talk and repetition
+- Are written in the third person, as compact bullet points
+- Stay under {max_words} words
+
+Return only the updated notes."""
+
+
+async def summarize_history_async(
+    previous_summary: Optional[str],
+    messages: List[models.Message],
+    max_tokens: Optional[int] = None
+) -> str:
+    """
+    Fold older messages into the conversation's rolling summary.
+    
+    Incremental: only the previous summary and the newly evicted messages
+    are sent, never the whole conversation.
     
-    for chunk in response:
-        if chunk.text:
-            yield chunk.text
+    Args:
+        previous_summary: The stored summary so far (None for the first fold)
+        messages: Messages to fold in, oldest first
+        max_tokens: Target size of the summary (default: HISTORY_SUMMARY_MAX_TOKENS)
+        
+    Returns:
+        The updated summary text
+    """
+    max_tokens = max_tokens or settings.HISTORY_SUMMARY_MAX_TOKENS
+    # Rough rule of thumb: ~0.75 words per token
+    system_prompt = SUMMARIZER_PROMPT.format(max_words=int(max_tokens * 0.75))
+    
+    transcript = "\n".join(
+        f"{'User' if msg.role == 'user' else 'Coach'}: {msg.content}"
+        for msg in messages
+    )
+    prompt = (
+        f"EXISTING NOTES:\n{previous_summary or '(none yet)'}\n\n"
+        f"NEW MESSAGES:\n{transcript}"
+    )
+    
+    response = await get_backend().generate_async(
+        "summarizer", [], prompt, system_prompt=system_prompt
+    )
+    return response.strip()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
 class Settings(BaseSettings):
@@ -8,8 +10,158 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     
+    # Run Alembic migrations when the app boots (main.lifespan). Off by
+    # default: deploys run `python -m app.migrate` once, before the new
+    # instances start (render.yaml preDeployCommand), so a cold start never
+    # waits on a migration
+    MIGRATE_ON_STARTUP: bool = False
+    
+    # Read replicas (see database.read_session)
+    # Comma-separated database URLs; empty = every query goes to DATABASE_URL
+    DATABASE_REPLICA_URLS: str = ""
+    # After a user writes, their reads stay on the primary for this long so
+    # they see their own writes despite replication lag
+    REPLICA_PIN_SECONDS: float = 5.0
+    
+    # Authenticated-principal cache (security.principal_cache)
+    # Skips the users lookup for a token seen within the TTL; 0 disables it
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL_SECONDS: float = 60.0
+    
+    # Password hashing (security.password_hashing_pool)
+    # PBKDF2-SHA256 rounds for new hashes; existing hashes made with a
+    # different count are rehashed on the user's next login
+    PASSWORD_HASH_ROUNDS: int = 29000
+    # Dedicated hashing threads, so a login burst can't take the request threadpool
+    PASSWORD_HASH_WORKERS: int = 2
+    # Hashes allowed to wait for a worker; beyond that logins get a 503
+    PASSWORD_HASH_MAX_QUEUE: int = 32
+    PASSWORD_HASH_RETRY_AFTER_SECONDS: int = 1
+    
+    # HTTP caching and compression (see http_cache.py)
+    # How long browsers may reuse GET /personalities without asking again
+    PERSONALITIES_MAX_AGE_SECONDS: int = 300
+    # Responses smaller than this aren't worth compressing
+    COMPRESSION_MINIMUM_SIZE: int = 1000
+    GZIP_COMPRESS_LEVEL: int = 6  # 1-9; beyond 6 costs CPU for little gain on JSON
+    BROTLI_QUALITY: int = 4  # 0-11; only used when brotli-asgi is installed
+    
+    # Which LLM backend ai_service uses (see llm_backends.py)
+    # "gemini" = Google Gemini, "fake" = offline deterministic stand-in
+    LLM_BACKEND: str = "gemini"
+    
     # Google Gemini AI Configuration
     GEMINI_API_KEY: str = ""  # Set this in .env file
+    GEMINI_MODEL: str = "gemini-2.5-flash"  # Free tier with long context
+    
+    # Max number of ready model clients kept by GeminiBackend.model_pool
+    # One per (model, personality, generation config) combination
+    MODEL_POOL_SIZE: int = 16
+    
+    # Resilience around LLM calls (see resilience.py)
+    LLM_RESILIENCE_ENABLED: bool = True
+    LLM_TIMEOUT_SECONDS: float = 30.0  # Per call, retries included (streams: until the first chunk)
+    LLM_MAX_RETRIES: int = 2  # Extra attempts, for timeouts / 429 / 5xx only
+    LLM_RETRY_BASE_DELAY_SECONDS: float = 0.25  # Full-jitter exponential backoff
+    LLM_RETRY_MAX_DELAY_SECONDS: float = 2.0
+    # Circuit breaker: fail fast after this many consecutive upstream failures...
+    LLM_BREAKER_FAILURE_THRESHOLD: int = 5
+    # ...for this long, then let one trial call through
+    LLM_BREAKER_RESET_SECONDS: float = 30.0
+    # Hedging: start a second attempt when a call is slower than the p95
+    # of recent calls (costs extra upstream calls, so opt-in)
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_QUANTILE: float = 0.95
+    LLM_HEDGE_MIN_SAMPLES: int = 20  # Don't hedge until this many latencies are known
+    
+    # Admission control in front of the LLM (see admission.py)
+    # "memory" = limits per worker process, "database" = shared by all
+    # workers through the llm_slots / rate_limit_buckets tables
+    ADMISSION_BACKEND: str = "memory"
+    # LLM turns running at once; 0 = unlimited
+    LLM_MAX_CONCURRENCY: int = 16
+    # Turns allowed to wait for a slot (FIFO); beyond that, 503
+    LLM_QUEUE_SIZE: int = 64
+    # Longest a turn waits for a slot before giving up with a 503
+    LLM_QUEUE_TIMEOUT_SECONDS: float = 10.0
+    # Per-user token bucket: sustained messages per minute and burst size - opt-in
+    # (0 disables it). Over the limit, turns get a 429 with Retry-After
+    USER_RATE_LIMIT_PER_MINUTE: float = 0.0
+    USER_RATE_LIMIT_BURST: int = 5
+    # Database backend: a slot held longer than this (crashed worker) is reclaimed
+    ADMISSION_LEASE_SECONDS: float = 300.0
+    # Database backend: how often the head of the queue checks for a free slot
+    ADMISSION_POLL_INTERVAL_MS: float = 50.0
+    
+    # Fake LLM backend (LLM_BACKEND=fake) - for offline runs and load tests
+    # Time to first token: "fixed", "uniform", "normal" or "lognormal"
+    FAKE_LLM_LATENCY_DISTRIBUTION: str = "lognormal"
+    FAKE_LLM_LATENCY_MEAN_MS: float = 800.0
+    FAKE_LLM_LATENCY_STDDEV_MS: float = 300.0
+    FAKE_LLM_TOKENS_PER_SECOND: float = 80.0  # Generation speed after the first token
+    FAKE_LLM_CHUNK_TOKENS: int = 8  # Tokens per streamed chunk
+    FAKE_LLM_RESPONSE_TOKENS: int = 60  # Length of every reply
+    FAKE_LLM_ERROR_RATE: float = 0.0  # Probability (0-1) that a call fails
+    FAKE_LLM_SEED: Optional[int] = None  # Set for reproducible timings
+    
+    # Response cache for repeated turns (see response_cache.py) - opt-in
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_TTL_SECONDS: float = 3600.0
+    RESPONSE_CACHE_MAX_BYTES: int = 8 * 1024 * 1024
+    # Candidate replies kept per key; a hit picks one at random
+    RESPONSE_CACHE_VARIANTS: int = 1
+    
+    # Idempotent chat turns (see idempotency.py)
+    # How long a finished turn is replayed for retries with the same Idempotency-Key
+    IDEMPOTENCY_TTL_SECONDS: float = 300.0
+    IDEMPOTENCY_MAX_ENTRIES: int = 10000
+    
+    # Write-behind persistence of assistant messages (see write_behind.py) - opt-in
+    # Replies are queued and written in batches instead of on the request path
+    WRITE_BEHIND_ENABLED: bool = False
+    WRITE_BEHIND_QUEUE_SIZE: int = 10000  # When full, the next save waits for a flush
+    WRITE_BEHIND_BATCH_SIZE: int = 200  # Flush early once this many are waiting
+    WRITE_BEHIND_FLUSH_INTERVAL_MS: float = 50.0
+    # Failed flushes (retried with backoff, up to 5s apart: about 20s in
+    # all) before a message's batch is written row by row and rows that
+    # still fail are dropped
+    WRITE_BEHIND_MAX_ATTEMPTS: int = 10
+    
+    # WebSocket chat channel, /chat/ws (see routers/chat_ws.py)
+    # Server "ping" frame interval; a client silent for 3 intervals is disconnected
+    WS_HEARTBEAT_SECONDS: float = 20.0
+    # Turns one connection may have in flight at once (across its conversations)
+    WS_MAX_ACTIVE_TURNS: int = 4
+    # Backpressure: frames buffered for a client that reads slower than
+    # replies are generated, and how long a full buffer may block before
+    # the connection is closed (the turns still finish and are saved)
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SEND_TIMEOUT_SECONDS: float = 10.0
+    # Largest client frame accepted
+    WS_MAX_MESSAGE_BYTES: int = 32768
+
+    # Conversation context window (see context_builder.py)
+    # Default token budget for history sent to Gemini on each turn;
+    # a personality can override it with "history_token_budget"
+    HISTORY_TOKEN_BUDGET: int = 4000
+    # Upper bound on the rolling summary of older turns
+    HISTORY_SUMMARY_MAX_TOKENS: int = 500
+
+    # Cross-conversation memory (see retrieval.py) - opt-in
+    # Relevant snippets of the user's other conversations are added to each
+    # turn. Changes every prompt (and so lowers response cache hits), and
+    # keeps an in-memory index per active user: set RETRIEVAL_ENABLED=true
+    RETRIEVAL_ENABLED: bool = False
+    RETRIEVAL_TOP_K: int = 3
+    # Token budget for all snippets together, and cap for a single one
+    RETRIEVAL_TOKEN_BUDGET: int = 300
+    RETRIEVAL_SNIPPET_MAX_TOKENS: int = 120
+    # BM25 score a snippet needs to be included (filters weak, one-word matches)
+    RETRIEVAL_MIN_SCORE: float = 3.0
+    # Users whose indexes are kept in memory (least recently used are dropped)
+    RETRIEVAL_MAX_USERS: int = 500
+    # Newest messages indexed per user
+    RETRIEVAL_MAX_MESSAGES_PER_USER: int = 50000
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,187 @@
+"""
+Token-budgeted conversation context.
+
+Instead of sending every message of a conversation to Gemini on every turn:
+- The most recent turns are sent word for word, up to the personality's
+  token budget (personalities.get_history_token_budget)
+- Older turns are folded into a rolling summary stored in
+  models.HistorySummary, updated incrementally only when turns fall out
+  of the window
+
+Prompt size therefore stays roughly constant no matter how long a
+coaching thread runs.
+"""
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import ai_service, metrics, models
+from .config import settings
+from .personalities import get_history_token_budget
+
+# Rough overhead per message for role markers and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text.
+
+    Uses the ~4 characters per token rule of thumb for English. Exact counts
+    would need a round-trip to Gemini's count_tokens API on every turn, which
+    costs more than the estimate saves; the budget only needs to be close.
+    """
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: models.Message) -> int:
+    return count_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+
+
+@dataclass
+class ConversationContext:
+    """
+    What gets sent to Gemini for one turn.
+
+    Attributes:
+        messages: Recent messages to send verbatim, oldest first
+        summary: Rolling summary of everything older (None if nothing was folded yet)
+        token_count: Estimated tokens of messages + summary
+        recalled: Snippets of the user's other conversations (see retrieval.py),
+                  filled in by the chat router; budgeted separately
+    """
+    messages: List[models.Message] = field(default_factory=list)
+    summary: Optional[str] = None
+    token_count: int = 0
+    recalled: List[str] = field(default_factory=list)
+
+
+async def save_summary(
+    db: AsyncSession,
+    conversation_id: int,
+    content: str,
+    covered_through_message_id: int,
+    token_count: int
+) -> None:
+    """
+    Store a conversation's summary and commit.
+
+    An upsert, so two workers folding the same conversation at once can't
+    collide on the insert; and it never replaces a summary that already
+    covers more messages, so the slower of the two can't roll it back.
+    """
+    values = {
+        "conversation_id": conversation_id,
+        "content": content,
+        "covered_through_message_id": covered_through_message_id,
+        "token_count": token_count,
+    }
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name in ("postgresql", "sqlite"):
+        insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+        statement = insert(models.HistorySummary).values(**values)
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=[models.HistorySummary.conversation_id],
+            set_={
+                "content": statement.excluded.content,
+                "covered_through_message_id": statement.excluded.covered_through_message_id,
+                "token_count": statement.excluded.token_count,
+                "updated_at": func.now(),
+            },
+            where=(
+                models.HistorySummary.covered_through_message_id
+                < statement.excluded.covered_through_message_id
+            ),
+        ))
+    else:
+        await db.merge(models.HistorySummary(**values))
+    await db.commit()
+
+
+async def build_context(
+    db: AsyncSession,
+    conversation_id: int,
+    personality_name: str,
+    exclude_message_id: Optional[int] = None
+) -> ConversationContext:
+    """
+    Build the history window for the next turn of a conversation.
+
+    Flow:
+    1. Load the stored summary (if any) and the messages it doesn't cover yet
+    2. Keep the newest messages that fit in the budget
+    3. If older messages fell out of the window, fold them into the summary
+       and save it, so the next turn starts from the new summary
+
+    When folding, the window is trimmed to half the budget rather than just
+    under it. That leaves room for a few more turns before the next fold,
+    so the summarizer runs every few turns instead of on every turn.
+
+    Args:
+        db: Database session
+        conversation_id: Conversation to build the context for
+        personality_name: Personality whose token budget applies
+        exclude_message_id: Message to leave out (the one being answered)
+
+    Returns:
+        ConversationContext with the verbatim window and the summary
+    """
+    budget = get_history_token_budget(personality_name)
+
+    # Step 1: Stored summary and the messages after it
+    summary_row = await db.get(models.HistorySummary, conversation_id)
+    covered_through = summary_row.covered_through_message_id if summary_row else 0
+
+    query = select(models.Message).where(
+        models.Message.conversation_id == conversation_id,
+        models.Message.id > covered_through
+    )
+    if exclude_message_id is not None:
+        query = query.where(models.Message.id != exclude_message_id)
+    result = await db.execute(query.order_by(models.Message.created_at, models.Message.id))
+    messages = result.scalars().all()
+
+    summary = summary_row.content if summary_row else None
+    summary_tokens = summary_row.token_count if summary_row else 0
+
+    # Step 2: Does everything still fit?
+    window_tokens = sum(message_tokens(msg) for msg in messages)
+    if window_tokens + summary_tokens <= budget:
+        return ConversationContext(messages, summary, window_tokens + summary_tokens)
+
+    # Step 3: Keep the newest messages that fit in half the budget, fold the rest
+    keep_budget = max(budget // 2 - settings.HISTORY_SUMMARY_MAX_TOKENS, 0)
+    kept_tokens = 0
+    split = len(messages)
+    while split > 0 and kept_tokens + message_tokens(messages[split - 1]) <= keep_budget:
+        split -= 1
+        kept_tokens += message_tokens(messages[split])
+    # Gemini expects the verbatim history to start with a user turn
+    while split < len(messages) and messages[split].role != "user":
+        kept_tokens -= message_tokens(messages[split])
+        split += 1
+
+    to_fold, recent = messages[:split], messages[split:]
+    if not to_fold:
+        return ConversationContext(recent, summary, kept_tokens + summary_tokens)
+
+    # End the read transaction: no connection is held during the summarizer call
+    await db.commit()
+    try:
+        with metrics.span("history_summarize"):
+            summary = await ai_service.summarize_history_async(summary, to_fold)
+    except Exception as e:
+        # Summarizing is best-effort: answer this turn with the old summary
+        # and a truncated window, and try folding again next turn
+        print(f"⚠️ History summary failed for conversation {conversation_id}: {e}")
+        return ConversationContext(recent, summary, kept_tokens + summary_tokens)
+
+    summary_tokens = count_tokens(summary)
+    await save_summary(db, conversation_id, summary, to_fold[-1].id, summary_tokens)
+
+    return ConversationContext(recent, summary, kept_tokens + summary_tokens)
@@ -1,3 +1,7 @@
+from typing import Optional, Tuple
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from . import models, schemas, security
@@ -7,6 +11,11 @@ def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+async def get_user_by_email_async(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+
 def create_user(db: Session, user: schemas.UserCreate):
     hashed_password = security.get_password_hash(user.password)
     db_user = models.User(email=user.email, hashed_password=hashed_password)
@@ -14,3 +23,87 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.commit()
     db.refresh(db_user)
     return db_user
+
+
+async def create_user_async(db: AsyncSession, email: str, hashed_password: str) -> models.User:
+    """
+    Insert a user whose password was already hashed.
+    
+    Hashing is left to the caller (security.get_password_hash_async) so it
+    runs on the hashing pool, not in this coroutine.
+    """
+    db_user = models.User(email=email, hashed_password=hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+
+async def _insert_message(db: AsyncSession, conversation_id: int, role: str, content: str) -> models.Message:
+    # INSERT ... RETURNING hands back the id and server-side created_at in
+    # the same round-trip (no flush + refresh SELECT)
+    return await db.scalar(
+        insert(models.Message)
+        .values(conversation_id=conversation_id, role=role, content=content)
+        .returning(models.Message)
+    )
+
+
+async def create_conversation_with_message(
+    db: AsyncSession,
+    user_id: int,
+    content: str
+) -> Tuple[models.Conversation, models.Message]:
+    """
+    Start a conversation with the user's first message, in one transaction.
+
+    Both rows come back from INSERT ... RETURNING, so this is two
+    statements and a commit.
+    """
+    conversation = await db.scalar(
+        insert(models.Conversation)
+        .values(user_id=user_id, message_count=1)
+        .returning(models.Conversation)
+    )
+    message = await _insert_message(db, conversation.id, "user", content)
+    await db.commit()
+    return conversation, message
+
+
+async def append_message(
+    db: AsyncSession,
+    conversation_id: int,
+    role: str,
+    content: str,
+    user_id: Optional[int] = None
+) -> Optional[models.Message]:
+    """
+    Add a message to a conversation and commit.
+
+    Updates the conversation's denormalized message_count, last_message_at
+    and updated_at in the same transaction, so the counters can never drift
+    from the messages table.
+
+    If user_id is given, the message is only added when the conversation
+    belongs to that user; the ownership check is part of the counter
+    UPDATE, so it costs no extra query. Returns None when it doesn't.
+    """
+    query = update(models.Conversation).where(models.Conversation.id == conversation_id)
+    if user_id is not None:
+        query = query.where(models.Conversation.user_id == user_id)
+    result = await db.execute(
+        query
+        .values(
+            message_count=models.Conversation.message_count + 1,
+            last_message_at=func.now(),
+            updated_at=func.now()
+        )
+        .returning(models.Conversation.id)
+        .execution_options(synchronize_session=False)
+    )
+    if result.first() is None:
+        await db.rollback()
+        return None
+    message = await _insert_message(db, conversation_id, role, content)
+    await db.commit()
+    return message
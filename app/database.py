@@ -1,7 +1,15 @@
+import itertools
 import os
+import threading
+import time
+from typing import Dict, List, Optional
+
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from .config import settings
 
 # Database URL - reads from environment variable
 # Why: Production (Render) will set DATABASE_URL automatically
@@ -20,6 +28,163 @@ engine = create_engine(SQLALCHEMY_DATABASE_URL)
 # Why: SessionLocal() creates new database sessions for each request
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+
+def _to_async_url(url: str) -> str:
+    """
+    Swap the sync driver in a database URL for its asyncio counterpart.
+
+    postgres://, postgresql:// and postgresql+psycopg2:// use asyncpg;
+    sqlite:// uses aiosqlite. Anything already async is returned as-is.
+    """
+    scheme, sep, rest = url.partition("://")
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg{sep}{rest}"
+    if scheme in ("sqlite", "sqlite+pysqlite"):
+        return f"sqlite+aiosqlite{sep}{rest}"
+    return url
+
+
+# Async engine for the same database
+# Why: Chat turns spend seconds waiting on Gemini. With an async engine the
+# endpoint awaits instead of pinning one threadpool thread per conversation.
+async_engine = create_async_engine(_to_async_url(SQLALCHEMY_DATABASE_URL))
+
+
+
+class ReplicaRouter:
+    """
+    Round-robin pool of read-replica engines, plus read-your-writes pins.
+
+    A user who just wrote is "pinned" to the primary for
+    REPLICA_PIN_SECONDS, so a replica lagging behind can't hide the
+    message they just sent. Pins are kept per process; with several
+    workers, a user whose next read lands on another worker can still
+    hit a lagging replica, so keep the pin window above the replica lag.
+    """
+
+    def __init__(self, replica_urls: List[str], pin_seconds: float):
+        self.engines: List[AsyncEngine] = [
+            create_async_engine(_to_async_url(url)) for url in replica_urls
+        ]
+        self.pin_seconds = pin_seconds
+        self._cycle = itertools.cycle(self.engines)
+        self._pinned_until: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def next_engine(self) -> AsyncEngine:
+        with self._lock:
+            return next(self._cycle)
+
+    def pin_user(self, user_id: int) -> None:
+        """Send this user's reads to the primary for the next pin_seconds."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pinned_until[user_id] = now + self.pin_seconds
+            # Drop expired pins now and then so the dict doesn't grow forever
+            if len(self._pinned_until) > 10000:
+                self._pinned_until = {
+                    uid: until for uid, until in self._pinned_until.items() if until > now
+                }
+
+    def is_pinned(self, user_id: int) -> bool:
+        with self._lock:
+            until = self._pinned_until.get(user_id)
+        return until is not None and until > time.monotonic()
+
+
+replica_router = ReplicaRouter(
+    [url.strip() for url in settings.DATABASE_REPLICA_URLS.split(",") if url.strip()],
+    settings.REPLICA_PIN_SECONDS,
+)
+
+
+class RoutingSession(Session):
+    """
+    Session that reads from the replica chosen in read_session(), if any.
+
+    Anything that flushes (a write) still goes to the primary, so a
+    read session that ends up writing doesn't write to a replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if replica is not None and not self._flushing:
+            return replica.sync_engine
+        return async_engine.sync_engine
+
+
+# Async session factory
+# Why: expire_on_commit=False keeps attributes readable after commit without
+# a lazy reload (lazy loads are not allowed on an AsyncSession)
+AsyncSessionLocal = async_sessionmaker(
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+
+async def get_db():
+    """
+    Request-scoped async session (FastAPI dependency).
+
+    FastAPI resolves a dependency once per request, so the auth dependency
+    (security.get_current_user) and the endpoint share this one session.
+
+    Usage:
+        async def endpoint(db: AsyncSession = Depends(get_db)):
+            ...
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def use_replica(session: AsyncSession, user_id: Optional[int] = None) -> None:
+    """
+    Send this session's reads to a replica, if any are configured.
+
+    Stays on the primary when there are no replicas or the user wrote
+    within the last REPLICA_PIN_SECONDS. The replica is picked once per
+    session, so every query in one request sees the same snapshot.
+    Call it before the session's first query, or after closing it.
+    """
+    if replica_router.enabled and not (user_id is not None and replica_router.is_pinned(user_id)):
+        session.sync_session.info["replica"] = replica_router.next_engine()
+
+
+async def use_replica_async(session: AsyncSession, user_id: Optional[int] = None) -> None:
+    """
+    use_replica() for a request session the auth lookup may already have used.
+
+    Ends that lookup's transaction on the primary first, so the session's
+    next query really goes to the replica.
+    """
+    if replica_router.enabled:
+        await session.close()
+        use_replica(session, user_id)
+
+
+def read_session(user_id: Optional[int] = None) -> AsyncSession:
+    """
+    New session for read-only work outside a request's dependencies
+    (e.g. a streamed export): on a replica if any are configured.
+
+    Usage:
+        async with read_session(current_user.id) as db:
+            ...
+    """
+    session = AsyncSessionLocal()
+    use_replica(session, user_id)
+    return session
+
+
 # Base class for our models
 # Why: All database models (User, Conversation, Message) inherit from this
 Base = declarative_base()
@@ -0,0 +1,122 @@
+"""
+HTTP conditional requests (ETag / If-None-Match) for read endpoints.
+
+The frontend refetches personalities and transcripts on every page load,
+though they rarely change: personalities only on deploy, transcripts
+only by growing at the end. Each endpoint derives a strong ETag from
+cheap facts (the personality registry, or a conversation's id and its
+newest message id) *before* building the response body. When the
+client's If-None-Match still matches, it gets a bodiless 304 and the
+messages are never loaded or serialized.
+
+Usage:
+    etag = http_cache.strong_etag("conversation", user_id, conversation_id, last_id)
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+"""
+
+import hashlib
+import json
+from typing import Any, Optional
+
+from fastapi import Response, status
+from fastapi.middleware.gzip import GZipMiddleware
+
+from .config import settings
+
+# Bump when a cached response's format changes, so old ETags stop matching
+ETAG_VERSION = 1
+
+# Per-user data: the browser may keep it but must check with us before reuse
+PRIVATE_REVALIDATE = "private, no-cache"
+
+
+def public_max_age(seconds: int) -> str:
+    """Cache-Control for data that's the same for everyone."""
+    return f"public, max-age={seconds}"
+
+
+def strong_etag(*parts: Any) -> str:
+    """Quoted strong ETag: a hash of the parts (JSON-encodable values)."""
+    raw = json.dumps([ETAG_VERSION, *parts], sort_keys=True, default=str, separators=(",", ":"))
+    return '"' + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    True if an If-None-Match header value matches the current ETag.
+
+    Uses the weak comparison If-None-Match calls for, so a W/ prefix
+    (added by some proxies when they compress) still matches.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def check(
+    if_none_match: Optional[str],
+    response: Response,
+    etag: str,
+    cache_control: str
+) -> Optional[Response]:
+    """
+    Set the caching headers, and short-circuit if the client is up to date.
+
+    Args:
+        if_none_match: The request's If-None-Match header
+        response: The endpoint's Response parameter (headers for a 200)
+        etag: Current strong ETag of the resource
+        cache_control: Cache-Control value
+
+    Returns:
+        A 304 Not Modified response to return as-is, or None to build the
+        full response (response then carries the headers)
+    """
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if cache_control.startswith("private"):
+        # The same URL has different content for each token
+        headers["Vary"] = "Authorization"
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def add_compression(app) -> None:
+    """
+    Compress responses of at least COMPRESSION_MINIMUM_SIZE bytes.
+
+    Brotli (with gzip fallback) when brotli-asgi is installed, else gzip.
+    Server-sent events are left uncompressed either way: buffering in the
+    compressor would hold back streamed tokens.
+    """
+    try:
+        from brotli_asgi import BrotliMiddleware  # Optional dependency
+    except ImportError:
+        BrotliMiddleware = None
+
+    if BrotliMiddleware is not None:
+        app.add_middleware(
+            BrotliMiddleware,
+            quality=settings.BROTLI_QUALITY,
+            minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+            gzip_fallback=True,
+            excluded_handlers=[r"^/chat/stream$"],
+        )
+    else:
+        # Starlette's gzip skips text/event-stream by itself
+        app.add_middleware(
+            GZipMiddleware,
+            minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+            compresslevel=settings.GZIP_COMPRESS_LEVEL,
+        )
@@ -0,0 +1,252 @@
+"""
+Idempotent chat turns and per-conversation turn serialization.
+
+Mobile clients retry POST /chat when their timeout fires, which is often
+while Gemini is still answering the first attempt. Without this, every
+retry is a second LLM call and a second pair of stored messages.
+
+- Idempotency-Key: a client-chosen key per logical turn. While the first
+  request with a key is running, retries with the same key wait for its
+  result instead of starting their own; once it finishes, the result is
+  replayed from memory for IDEMPOTENCY_TTL_SECONDS.
+- Conversation locks: turns on the same conversation run one at a time,
+  so a turn never reads history while another is half-written.
+
+Both are per process. Behind several workers, route a user's requests to
+the same worker (or accept that a retry landing elsewhere runs again).
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from . import metrics
+from .config import settings
+
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(payload: Dict[str, Any]) -> str:
+    """Hash of the request body, to catch a key reused for a different request."""
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    future: "asyncio.Future[Any]"
+    expires_at: float = field(default=float("inf"))  # Set once the result is in
+
+
+class IdempotencyStore:
+    """
+    In-flight and recently completed results, keyed by (scope, key).
+
+    Not thread-safe: it is only used from the event loop.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, ...], _Entry]" = OrderedDict()
+        self.replays = 0
+        self.coalesced = 0
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.expires_at <= now]:
+            del self._entries[key]
+        # Oldest completed entries go first; in-flight ones are never dropped
+        while len(self._entries) > self.max_entries:
+            for key, entry in self._entries.items():
+                if entry.future.done():
+                    del self._entries[key]
+                    break
+            else:
+                break
+
+    def claim(
+        self,
+        scope: Tuple[str, ...],
+        key: str,
+        request_fingerprint: str
+    ) -> "Optional[asyncio.Future[Any]]":
+        """
+        Claim a key, or get the result of whoever claimed it first.
+
+        Args:
+            scope: Namespaces the key, e.g. ("chat", str(user_id))
+            key: The client's Idempotency-Key
+            request_fingerprint: fingerprint() of the request body
+
+        Returns:
+            None if the caller now owns the key (and must call resolve() or
+            abandon()), else a future with the first request's result.
+
+        Raises:
+            HTTPException 400 for a malformed key, 422 if the key was
+            already used for a different request.
+        """
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters"
+            )
+        self._evict()
+
+        entry = self._entries.get(scope + (key,))
+        if entry is not None:
+            if entry.fingerprint != request_fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="Idempotency-Key was already used for a different request"
+                )
+            if entry.future.done():
+                self.replays += 1
+            else:
+                self.coalesced += 1
+            return entry.future
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[scope + (key,)] = _Entry(fingerprint=request_fingerprint, future=future)
+        return None
+
+    def resolve(self, scope: Tuple[str, ...], key: str, result: Any) -> None:
+        """Publish the owner's result to waiters and keep it for replays."""
+        entry = self._entries.get(scope + (key,))
+        if entry is None or entry.future.done():
+            return
+        entry.future.set_result(result)
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+
+    def abandon(self, scope: Tuple[str, ...], key: str, error: Optional[BaseException] = None) -> None:
+        """
+        The owner failed: pass the error to waiters and forget the key,
+        so a later retry runs the turn again.
+
+        An owner that was cancelled (client gone, shutdown) or died of a
+        non-Exception error leaves waiters a 503 to retry on, rather than a
+        CancelledError of their own that the request handler can't turn
+        into a response.
+        """
+        entry = self._entries.pop(scope + (key,), None)
+        if entry is None or entry.future.done():
+            return
+        if not isinstance(error, Exception):
+            error = HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The original request with this Idempotency-Key was interrupted, please retry",
+                headers={"Retry-After": "1"}
+            )
+        entry.future.set_exception(error)
+        entry.future.exception()  # Mark retrieved: there may be no waiter
+
+    async def run(
+        self,
+        scope: Tuple[str, ...],
+        key: str,
+        request_fingerprint: str,
+        fn: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Run fn() once per key and share its result (claim + resolve/abandon).
+
+        Returns:
+            (result, replayed): replayed is False only for the request
+            that actually ran fn()
+        """
+        existing = self.claim(scope, key, request_fingerprint)
+        if existing is not None:
+            # shield: a waiter that disconnects must not cancel the original turn
+            return await asyncio.shield(existing), True
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.abandon(scope, key, e)
+            raise
+        self.resolve(scope, key, result)
+        return result, False
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "in_flight": sum(1 for e in self._entries.values() if not e.future.done()),
+            "replays": self.replays,
+            "coalesced": self.coalesced,
+        }
+
+
+class ConversationLocks:
+    """
+    One asyncio.Lock per conversation, dropped again once nobody holds it.
+
+    A conversation_id of None (a turn that creates a new conversation)
+    never waits: nobody else can be writing to it yet.
+    """
+
+    def __init__(self):
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._users: Dict[int, int] = {}
+
+    async def acquire(self, conversation_id: Optional[int]) -> None:
+        if conversation_id is None:
+            return
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = self._locks[conversation_id] = asyncio.Lock()
+        self._users[conversation_id] = self._users.get(conversation_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(conversation_id)
+            raise
+
+    def release(self, conversation_id: Optional[int]) -> None:
+        if conversation_id is None:
+            return
+        self._locks[conversation_id].release()
+        self._forget(conversation_id)
+
+    def _forget(self, conversation_id: int) -> None:
+        self._users[conversation_id] -= 1
+        if not self._users[conversation_id]:
+            del self._users[conversation_id]
+            del self._locks[conversation_id]
+
+    @asynccontextmanager
+    async def hold(self, conversation_id: Optional[int]) -> AsyncIterator[None]:
+        """
+        Usage:
+            async with conversation_locks.hold(request.conversation_id):
+                ...
+        """
+        await self.acquire(conversation_id)
+        try:
+            yield
+        finally:
+            self.release(conversation_id)
+
+
+idempotency_store = IdempotencyStore(
+    ttl_seconds=settings.IDEMPOTENCY_TTL_SECONDS,
+    max_entries=settings.IDEMPOTENCY_MAX_ENTRIES,
+)
+conversation_locks = ConversationLocks()
+
+metrics.REGISTRY.register(metrics.StatsCollector(
+    "idempotency",
+    "Idempotency-Key results kept and shared, from IdempotencyStore.stats()",
+    idempotency_store.stats,
+))
@@ -0,0 +1,403 @@
+"""
+LLM backends used by ai_service.
+
+ai_service only talks to the LLMBackend interface below, so the chat
+router, the streaming path and the benchmarks can run against either:
+- GeminiBackend: Google Gemini through google.generativeai (production)
+- FakeBackend:   a deterministic in-process stand-in with configurable
+                 latency, token rate, chunk size and error rate, for
+                 offline development, load tests and profiling
+
+Which one is used is chosen by settings.LLM_BACKEND ("gemini" or "fake").
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, Hashable, Iterator, List, Optional, Protocol, Tuple
+
+from . import metrics
+from .config import settings
+from .personalities import PERSONALITIES, get_personality
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+# Chat history in Gemini format: [{"role": "user" | "model", "parts": [text]}]
+History = List[Dict[str, Any]]
+
+
+class LLMBackend(Protocol):
+    """
+    Interface every LLM backend implements.
+    
+    `personality_name` selects the system prompt from PERSONALITIES.
+    Internal callers (e.g. the history summarizer) can pass their own
+    `system_prompt`; `personality_name` is then only used as a cache key.
+    """
+    
+    def generate(self, personality_name: str, history: History, message: str,
+                 system_prompt: Optional[str] = None) -> str: ...
+    
+    async def generate_async(self, personality_name: str, history: History, message: str,
+                             system_prompt: Optional[str] = None) -> str: ...
+    
+    def stream(self, personality_name: str, history: History, message: str,
+               system_prompt: Optional[str] = None) -> Iterator[str]: ...
+    
+    def stream_async(self, personality_name: str, history: History, message: str,
+                     system_prompt: Optional[str] = None) -> AsyncIterator[str]: ...
+    
+    def warm(self) -> None: ...
+
+
+# ===== GEMINI =====
+
+def _genai():
+    """
+    google.generativeai, imported on first use.
+    
+    It pulls in grpc and protobuf (most of the app's import time), which a
+    process running the fake backend, or still booting, doesn't need.
+    """
+    import google.generativeai as genai
+    return genai
+
+
+def _freeze(config: Optional[Dict[str, Any]]) -> Hashable:
+    """Turn a generation config dict into something usable as a dict key."""
+    if not config:
+        return None
+    return tuple(sorted(
+        (key, _freeze(value) if isinstance(value, dict) else
+         tuple(value) if isinstance(value, list) else value)
+        for key, value in config.items()
+    ))
+
+
+def _prompt_fingerprint(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+
+
+class ModelPool:
+    """
+    Bounded, thread-safe LRU cache of ready GenerativeModel clients.
+    
+    Building a GenerativeModel converts the (large) personality system prompt
+    to protos and validates the config on every call. A model object holds no
+    per-conversation state (that lives in the ChatSession from start_chat),
+    so one instance per (model, personality, generation config) can be shared.
+    
+    Each entry remembers a fingerprint of the system prompt it was built
+    with. If a personality's prompt changes, the stale entry is dropped and
+    rebuilt on the next lookup.
+    """
+    
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple, Tuple[str, genai.GenerativeModel]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+    
+    def get(
+        self,
+        personality_name: str,
+        model_name: Optional[str] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        system_prompt: Optional[str] = None
+    ) -> "genai.GenerativeModel":
+        """
+        Return a ready model for this personality, building it on a miss.
+        
+        `system_prompt` is only needed for internal prompts that aren't in
+        PERSONALITIES (e.g. the history summarizer); `personality_name` is
+        then just the cache key.
+        
+        Raises:
+            ValueError: If the personality doesn't exist
+        """
+        model_name = model_name or settings.GEMINI_MODEL
+        if system_prompt is None:
+            system_prompt = get_personality(personality_name)["system_prompt"]
+        fingerprint = _prompt_fingerprint(system_prompt)
+        key = (model_name, personality_name, _freeze(generation_config))
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # Prompt changed since this client was built
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+        
+        # Build outside the lock so a miss doesn't serialize other lookups
+        model = _genai().GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_prompt,
+            generation_config=generation_config
+        )
+        
+        with self._lock:
+            self._entries[key] = (fingerprint, model)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return model
+    
+    def warm(self, personality_names: Optional[List[str]] = None) -> None:
+        """Pre-build clients (default: every personality) so first requests hit."""
+        for name in personality_names or list(PERSONALITIES):
+            self.get(name)
+    
+    def invalidate(self, personality_name: Optional[str] = None) -> None:
+        """Drop cached clients for one personality, or all of them."""
+        with self._lock:
+            for key in list(self._entries):
+                if personality_name is None or key[1] == personality_name:
+                    del self._entries[key]
+                    self.invalidations += 1
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+
+class GeminiBackend:
+    """
+    Google Gemini backend. Reuses ready model clients through a ModelPool.
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, model_name: Optional[str] = None):
+        _genai().configure(api_key=api_key if api_key is not None else settings.GEMINI_API_KEY)
+        self.model_name = model_name or settings.GEMINI_MODEL
+        self.model_pool = ModelPool(maxsize=settings.MODEL_POOL_SIZE)
+    
+    def _start_chat(self, personality_name: str, history: History, system_prompt: Optional[str]):
+        model = self.model_pool.get(personality_name, self.model_name, system_prompt=system_prompt)
+        return model.start_chat(history=history)
+    
+    def generate(self, personality_name, history, message, system_prompt=None):
+        chat = self._start_chat(personality_name, history, system_prompt)
+        return chat.send_message(message).text
+    
+    async def generate_async(self, personality_name, history, message, system_prompt=None):
+        chat = self._start_chat(personality_name, history, system_prompt)
+        response = await chat.send_message_async(message)
+        return response.text
+    
+    def stream(self, personality_name, history, message, system_prompt=None):
+        chat = self._start_chat(personality_name, history, system_prompt)
+        for chunk in chat.send_message(message, stream=True):
+            if chunk.text:
+                yield chunk.text
+    
+    async def stream_async(self, personality_name, history, message, system_prompt=None):
+        chat = self._start_chat(personality_name, history, system_prompt)
+        response = await chat.send_message_async(message, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+    
+    def warm(self) -> None:
+        self.model_pool.warm()
+
+
+# ===== FAKE =====
+
+class FakeLLMError(RuntimeError):
+    """Injected failure from FakeBackend (see FAKE_LLM_ERROR_RATE)."""
+
+
+# Words the fake coach "says". Deterministic per input, so the same
+# message always gets the same reply.
+_FAKE_VOCABULARY = (
+    "okay so real talk what are you avoiding here honestly the pattern "
+    "is clear you already know the next step focus on what you control "
+    "today not tomorrow small action beats big plans discipline is a "
+    "choice you make again and again so what will you do right now"
+).split()
+
+
+class FakeBackend:
+    """
+    Deterministic in-process LLM stand-in.
+    
+    Reply text depends only on (personality, history length, message), so
+    runs are reproducible. Timing follows real streaming behaviour: a
+    time-to-first-token drawn from the configured latency distribution,
+    then `chunk_tokens` words every `chunk_tokens / tokens_per_second`
+    seconds. With probability `error_rate` a call raises FakeLLMError
+    before producing any output.
+    
+    Latency distributions:
+    - "fixed":     always `latency_mean_ms`
+    - "uniform":   mean +/- stddev * sqrt(3) (same mean and spread)
+    - "normal":    Gaussian, clipped at 0
+    - "lognormal": long right tail like real LLM latencies
+    """
+    
+    def __init__(
+        self,
+        latency_distribution: Optional[str] = None,
+        latency_mean_ms: Optional[float] = None,
+        latency_stddev_ms: Optional[float] = None,
+        tokens_per_second: Optional[float] = None,
+        chunk_tokens: Optional[int] = None,
+        response_tokens: Optional[int] = None,
+        error_rate: Optional[float] = None,
+        seed: Optional[int] = None
+    ):
+        def pick(value, default):
+            return default if value is None else value
+        
+        self.latency_distribution = pick(latency_distribution, settings.FAKE_LLM_LATENCY_DISTRIBUTION)
+        self.latency_mean_ms = pick(latency_mean_ms, settings.FAKE_LLM_LATENCY_MEAN_MS)
+        self.latency_stddev_ms = pick(latency_stddev_ms, settings.FAKE_LLM_LATENCY_STDDEV_MS)
+        self.tokens_per_second = pick(tokens_per_second, settings.FAKE_LLM_TOKENS_PER_SECOND)
+        self.chunk_tokens = max(1, pick(chunk_tokens, settings.FAKE_LLM_CHUNK_TOKENS))
+        self.response_tokens = pick(response_tokens, settings.FAKE_LLM_RESPONSE_TOKENS)
+        self.error_rate = pick(error_rate, settings.FAKE_LLM_ERROR_RATE)
+        self._rng = random.Random(pick(seed, settings.FAKE_LLM_SEED))
+        self._rng_lock = threading.Lock()
+        if self.latency_distribution not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown FAKE_LLM_LATENCY_DISTRIBUTION: {self.latency_distribution}")
+    
+    def _first_token_delay(self) -> float:
+        """Seconds until the first token, drawn from the configured distribution."""
+        mean, stddev = self.latency_mean_ms, self.latency_stddev_ms
+        with self._rng_lock:
+            if self.latency_distribution == "fixed" or stddev <= 0 or mean <= 0:
+                ms = mean
+            elif self.latency_distribution == "uniform":
+                half_width = stddev * 3 ** 0.5
+                ms = self._rng.uniform(mean - half_width, mean + half_width)
+            elif self.latency_distribution == "normal":
+                ms = self._rng.gauss(mean, stddev)
+            else:
+                # Pick mu/sigma so the lognormal has the requested mean and stddev
+                sigma2 = math.log1p((stddev / mean) ** 2)
+                mu = math.log(mean) - sigma2 / 2
+                ms = self._rng.lognormvariate(mu, sigma2 ** 0.5)
+        return max(ms, 0.0) / 1000
+    
+    def _should_fail(self) -> bool:
+        with self._rng_lock:
+            return self._rng.random() < self.error_rate
+    
+    def _reply_chunks(self, personality_name: str, history: History, message: str) -> List[str]:
+        seed = hashlib.sha256(f"{personality_name}|{len(history)}|{message}".encode("utf-8")).digest()
+        words = random.Random(seed).choices(_FAKE_VOCABULARY, k=self.response_tokens)
+        return [
+            " ".join(words[i:i + self.chunk_tokens]) + " "
+            for i in range(0, len(words), self.chunk_tokens)
+        ]
+    
+    def _chunk_delay(self) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return self.chunk_tokens / self.tokens_per_second
+    
+    def _begin(self) -> float:
+        if self._should_fail():
+            raise FakeLLMError("Fake LLM backend injected failure")
+        return self._first_token_delay()
+    
+    def stream(self, personality_name, history, message, system_prompt=None):
+        time.sleep(self._begin())
+        for i, chunk in enumerate(self._reply_chunks(personality_name, history, message)):
+            if i:
+                time.sleep(self._chunk_delay())
+            yield chunk
+    
+    async def stream_async(self, personality_name, history, message, system_prompt=None):
+        await asyncio.sleep(self._begin())
+        for i, chunk in enumerate(self._reply_chunks(personality_name, history, message)):
+            if i:
+                await asyncio.sleep(self._chunk_delay())
+            yield chunk
+    
+    def generate(self, personality_name, history, message, system_prompt=None):
+        return "".join(self.stream(personality_name, history, message, system_prompt)).strip()
+    
+    async def generate_async(self, personality_name, history, message, system_prompt=None):
+        parts = [chunk async for chunk in self.stream_async(personality_name, history, message, system_prompt)]
+        return "".join(parts).strip()
+    
+    def warm(self) -> None:
+        pass
+
+
+# ===== SELECTION =====
+
+_BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+    """
+    Return the process-wide backend selected by settings.LLM_BACKEND.
+    
+    Built on first use so importing this module never touches the network.
+    Wrapped in resilience.ResilientBackend unless LLM_RESILIENCE_ENABLED is off.
+    
+    Raises:
+        ValueError: If LLM_BACKEND isn't a known backend name
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.LLM_BACKEND.lower()
+                if name not in _BACKENDS:
+                    raise ValueError(f"Unknown LLM_BACKEND '{name}'. Available: {list(_BACKENDS)}")
+                backend = _BACKENDS[name]()
+                if settings.LLM_RESILIENCE_ENABLED:
+                    # Deadlines, retries, circuit breaker, hedging (see resilience.py)
+                    from .resilience import ResilientBackend
+                    backend = ResilientBackend(backend)
+                _backend = backend
+    return _backend
+
+
+def _model_pool_stats() -> Optional[Dict[str, int]]:
+    # Only the Gemini backend has a pool (ResilientBackend forwards the attribute)
+    pool = getattr(_backend, "model_pool", None)
+    return None if pool is None else pool.stats()
+
+
+metrics.REGISTRY.register(metrics.StatsCollector(
+    "llm_model_pool",
+    "Reused Gemini model clients, from ModelPool.stats()",
+    _model_pool_stats,
+))
+
+
+def set_backend(backend: Optional[LLMBackend]) -> None:
+    """Replace the process-wide backend (None resets to settings on next use)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
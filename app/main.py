@@ -1,18 +1,46 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import crud, models, schemas, security
+from . import admission, ai_service, crud, http_cache, metrics, models, schemas, security, write_behind
 from sqlalchemy.exc import IntegrityError
 from .config import settings
-from .database import SessionLocal, engine
-from .routers import chat, personalities  # Import routers
+from .database import async_engine, get_db, replica_router
+from .routers import chat, chat_ws, personalities  # Import routers
 
-models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Migrations normally run as a separate step (python -m app.migrate)
+    if settings.MIGRATE_ON_STARTUP:
+        from . import migrate  # Imports Alembic, so only when needed
+        migrate.upgrade_database()
+    
+    # Get the LLM backend ready in the background, so the server accepts
+    # requests (and answers liveness checks) right away; /health/ready
+    # reports when it's done (for Gemini: import the SDK, build one model
+    # client per personality)
+    app.state.warm_up = asyncio.create_task(asyncio.to_thread(ai_service.warm_up))
+    
+    # Write-behind queue for assistant messages (opt-in, see app/write_behind.py)
+    if write_behind.message_queue is not None:
+        write_behind.message_queue.start()
+    yield
+    
+    # Write whatever replies are still queued before the process exits
+    if write_behind.message_queue is not None:
+        await write_behind.message_queue.stop()
+    await admission.admission_controller.close()
+    security.password_hashing_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -33,49 +61,115 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses, e.g. long transcripts (see app/http_cache.py)
+http_cache.add_compression(app)
+
+# Time every request (see app/metrics.py)
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Include routers
 app.include_router(chat.router)
+app.include_router(chat_ws.router)
 app.include_router(personalities.router)
 
 
-# Dependency
-def get_db():
-    db = SessionLocal()#creates a new database session per request 
-    try:
-        yield db #provides db session to path operation functions/endpoint func
-    finally:
-        db.close()
-
-
 @app.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=form_data.username)
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_email_async(db, email=form_data.username)
+    valid, new_hash = False, None
+    if user:
+        with metrics.span("password_verify"):
+            valid, new_hash = await security.verify_password_async(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # PASSWORD_HASH_ROUNDS changed since this hash was made; the plaintext
+        # is only available now, so upgrade the stored hash on this login
+        user.hashed_password = new_hash
+        await db.commit()
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "uid": user.id}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.post("/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await crud.get_user_by_email_async(db, email=user.email)
     if db_user:
         # 409 Conflict is a more appropriate status code for duplicate resources
         raise HTTPException(status_code=409, detail="Email already registered")
+    with metrics.span("password_hash"):
+        hashed_password = await security.get_password_hash_async(user.password)
     try:
-        return crud.create_user(db=db, user=user)
+        db_user = await crud.create_user_async(db, email=user.email, hashed_password=hashed_password)
     except IntegrityError:
         # Handle race conditions where the unique constraint is violated
         raise HTTPException(status_code=409, detail="Email already registered")
+    # The user logs in right after signing up; don't let a lagging replica 401 them
+    replica_router.pin_user(db_user.id)
+    return db_user
 
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Mindset Coach API"}
+
+
+@app.get("/health/live", include_in_schema=False)
+def liveness():
+    """
+    The process is up and serving requests. Checks nothing else, so a
+    slow database or LLM never gets a healthy process restarted.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness(response: Response):
+    """
+    Whether this instance should get traffic: the LLM backend is warmed up
+    and the database is reachable and migrated. 503 until then.
+    """
+    checks = {}
+
+    warm_up = getattr(app.state, "warm_up", None)
+    if warm_up is None or not warm_up.done():
+        checks["llm"] = "warming up"
+    elif warm_up.exception() is not None:
+        checks["llm"] = f"warm-up failed: {warm_up.exception()}"
+    else:
+        checks["llm"] = "ok"
+
+    try:
+        async with async_engine.connect() as conn:
+            # Fails until `python -m app.migrate` has run
+            await conn.execute(text("SELECT version_num FROM alembic_version"))
+        checks["database"] = "ok"
+    except Exception as e:
+        checks["database"] = f"unavailable: {type(e).__name__}"
+
+    ready = all(value == "ok" for value in checks.values())
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ready" if ready else "not ready", "checks": checks}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    """
+    Request and per-stage latency histograms in Prometheus text format.
+
+    Runs on the event loop (not in the thread pool): some collected
+    stats() belong to stores that are only safe to read from the loop
+    (IdempotencyStore, RetrievalMemory).
+    """
+    return PlainTextResponse(
+        metrics.render_latest(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
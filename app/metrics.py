@@ -0,0 +1,305 @@
+"""
+In-process metrics exposed in Prometheus text format at GET /metrics.
+
+- MetricsMiddleware times every request (by method, route template, status)
+- span("stage") times one step of a request (JWT decode, user lookup,
+  each commit, history load, the LLM call, ...), labelled with the
+  request's route and the personality answering it
+- Histograms use fixed buckets, so p50/p99 per stage can be computed in
+  Prometheus with histogram_quantile()
+- StatsCollector publishes the counters caches and pools keep themselves
+  (hits, misses, evictions, size), read when /metrics is scraped
+
+Everything is kept in memory per worker process; Prometheus scrapes each
+worker and aggregates.
+"""
+
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds. Covers fast DB round-trips up to slow LLM replies.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Thread-safe Prometheus-style histogram with labels."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count per bucket incl. +Inf, sum)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: (list(counts), total[0]) for key, (counts, total) in self._series.items()}
+        for key, (counts, total) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += counts[-1]
+            bucket_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Thread-safe monotonically increasing counter with labels."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for key, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """Thread-safe value that can go up and down."""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class StatsCollector:
+    """
+    A component's own stats() dict, read at scrape time: one gauge per
+    key, named `<name>_<key>` (e.g. llm_model_pool_hits).
+
+    For caches and stores that already count hits and misses under their
+    own lock, so their hot paths don't pay for a second set of counters.
+    `collect` returns None while there is nothing to report (the
+    component is disabled or not built yet).
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Optional[Dict[str, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        stats = self.collect()
+        if stats is None:
+            return []
+        lines: List[str] = []
+        for key, value in sorted(stats.items()):
+            name = f"{self.name}_{key}"
+            lines.append(f"# HELP {name} {self.documentation} ({key})")
+            lines.append(f"# TYPE {name} {self.type_name}")
+            lines.append(f"{name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+http_request_duration = REGISTRY.register(Histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request, from first byte in to last byte out.",
+    ("method", "route", "status"),
+))
+
+stage_duration = REGISTRY.register(Histogram(
+    "app_stage_duration_seconds",
+    "Time spent in one stage of a request (jwt_decode, user_lookup, db_commit, history_load, llm_call, ...).",
+    ("stage", "route", "personality"),
+))
+
+llm_time_to_first_token = REGISTRY.register(Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from starting a streamed LLM call to its first chunk.",
+    ("route", "personality"),
+))
+
+
+# ===== PER-REQUEST LABELS =====
+
+class RequestLabels:
+    """
+    Labels for the request being handled, shared by every span in it.
+
+    The route template is only known once routing has happened, so it is
+    read from the ASGI scope when a span finishes, not when the request starts.
+    """
+
+    def __init__(self, scope: Optional[dict] = None):
+        self.scope = scope
+        self.personality = ""
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route") if self.scope else None
+        return getattr(route, "path", "unmatched")
+
+
+_request_labels: contextvars.ContextVar[Optional[RequestLabels]] = contextvars.ContextVar(
+    "request_labels", default=None
+)
+
+
+def current_labels() -> RequestLabels:
+    labels = _request_labels.get()
+    return labels if labels is not None else RequestLabels()
+
+
+def set_personality(personality_name: str) -> None:
+    """Label the rest of this request's spans with the personality answering it."""
+    labels = _request_labels.get()
+    if labels is not None:
+        labels.personality = personality_name
+
+
+def bind_request_labels(scope: dict) -> None:
+    """
+    Label spans in the current task (and tasks it starts) with this
+    scope's route. For work MetricsMiddleware doesn't wrap, such as the
+    turns of a WebSocket connection.
+    """
+    _request_labels.set(RequestLabels(scope))
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time a block and record it as one stage of the current request.
+
+    Usage:
+        with metrics.span("llm_call"):
+            text = await ai_service.generate_response_async(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        labels = current_labels()
+        stage_duration.observe(
+            time.perf_counter() - start,
+            stage=stage, route=labels.route, personality=labels.personality
+        )
+
+
+def observe_time_to_first_token(seconds: float) -> None:
+    labels = current_labels()
+    llm_time_to_first_token.observe(seconds, route=labels.route, personality=labels.personality)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request.
+
+    Pure ASGI (not BaseHTTPMiddleware) so streamed responses are timed
+    until their last chunk, and nothing is buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        labels = RequestLabels(scope)
+        token = _request_labels.set(labels)
+        status_code = {"value": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_code["value"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                method=scope["method"], route=labels.route, status=str(status_code["value"])
+            )
+            _request_labels.reset(token)
+
+
+def render_latest() -> str:
+    """All metrics in Prometheus text exposition format (version 0.0.4)."""
+    return REGISTRY.render()
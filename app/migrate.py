@@ -0,0 +1,53 @@
+"""
+Apply database migrations (Alembic) up to the latest revision.
+
+Usage:
+    python -m app.migrate
+
+Databases created before migrations existed (by Base.metadata.create_all)
+have the tables but no alembic_version table. They are stamped at the
+initial revision first, so only the newer migrations run on them.
+"""
+
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+
+from . import models
+from .database import engine
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# Revision that matches the schema create_all used to produce
+INITIAL_REVISION = "0001"
+
+
+def get_alembic_config() -> Config:
+    config = Config(str(PROJECT_ROOT / "alembic.ini"))
+    # Absolute path so this works from any working directory
+    config.set_main_option("script_location", str(PROJECT_ROOT / "migrations"))
+    # Leave the app's logging setup alone
+    config.attributes["configure_logger"] = False
+    return config
+
+
+def upgrade_database() -> None:
+    """
+    Bring the database schema up to date.
+    """
+    config = get_alembic_config()
+
+    tables = set(inspect(engine).get_table_names())
+    if "users" in tables and "alembic_version" not in tables:
+        # Pre-migration database: history_summaries may be missing if it
+        # predates that table, so create it before stamping
+        models.HistorySummary.__table__.create(bind=engine, checkfirst=True)
+        command.stamp(config, INITIAL_REVISION)
+
+    command.upgrade(config, "head")
+
+
+if __name__ == "__main__":
+    upgrade_database()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Index, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -39,8 +39,16 @@ class Conversation(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
     # Timestamps for tracking when conversations are created/updated
+    # updated_at is also bumped by crud.append_message (onupdate alone never
+    # fires when a message is added, because the conversation row isn't touched)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    # Denormalized counters, maintained in the same transaction as every
+    # message insert (see crud.append_message), so listing conversations
+    # never has to scan the messages table
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     
     # Relationships:
     # 1. Many-to-One: This conversation belongs to one User
@@ -49,6 +57,14 @@ class Conversation(Base):
     # 2. One-to-Many: This conversation has many Messages
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
     # cascade="all, delete-orphan" means: if we delete a conversation, delete all its messages too
+    
+    # 3. One-to-One: Rolling summary of older messages (None until the history outgrows its budget)
+    history_summary = relationship("HistorySummary", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
+    
+    # Composite index for "my conversations, most recently active first"
+    __table_args__ = (
+        Index("ix_conversations_user_id_last_message_at", "user_id", "last_message_at"),
+    )
 
 
 class Message(Base):
@@ -75,3 +91,77 @@ class Message(Base):
     
     # Relationship: Many-to-One - This message belongs to one Conversation
     conversation = relationship("Conversation", back_populates="messages")
+    
+    # Composite index matching the hot queries: filter by conversation,
+    # order by time, with id as the tie-breaker / keyset column
+    __table_args__ = (
+        Index("ix_messages_conversation_id_created_at_id", "conversation_id", "created_at", "id"),
+    )
+
+
+class HistorySummary(Base):
+    """
+    Rolling summary of the older part of a conversation.
+    
+    Only the most recent turns are sent to Gemini word for word; everything
+    up to `covered_through_message_id` is folded into `content`. The summary
+    is updated incrementally (old summary + newly evicted messages) and kept
+    here so it isn't recomputed on every turn.
+    """
+    __tablename__ = "history_summaries"
+
+    # One summary per conversation, so the conversation id is the primary key
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), primary_key=True)
+    
+    # The summary text itself
+    content = Column(Text, nullable=False)
+    
+    # Id of the newest message already folded into the summary
+    # Messages with a larger id are still sent verbatim
+    covered_through_message_id = Column(Integer, nullable=False)
+    
+    # Estimated token count of `content` (see context_builder.count_tokens)
+    token_count = Column(Integer, nullable=False, default=0)
+    
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    # Relationship: One-to-One - This summary belongs to one Conversation
+    conversation = relationship("Conversation", back_populates="history_summary")
+
+
+class RateLimitBucket(Base):
+    """
+    Per-user token bucket, for admission.DatabaseRateLimiter.
+    
+    Only used with ADMISSION_BACKEND=database, so that every worker
+    process draws from the same bucket.
+    """
+    __tablename__ = "rate_limit_buckets"
+
+    # No foreign key: buckets are throwaway state, not user data
+    user_id = Column(Integer, primary_key=True)
+    
+    # Tokens left as of `updated_at`; refilled lazily on the next request
+    tokens = Column(Float, nullable=False)
+    
+    # Unix time (seconds) of the last refill
+    updated_at = Column(Float, nullable=False)
+
+
+class LLMSlot(Base):
+    """
+    One row per concurrent LLM turn allowed across all workers,
+    for admission.DatabaseConcurrencyLimiter.
+    
+    A slot is free when `holder` is NULL or its lease has expired (the
+    worker holding it died without releasing it).
+    """
+    __tablename__ = "llm_slots"
+
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    
+    # Random id of the turn holding the slot (NULL = free)
+    holder = Column(String, nullable=True)
+    
+    # Unix time (seconds) after which the slot counts as free again
+    expires_at = Column(Float, nullable=True)
@@ -0,0 +1,88 @@
+"""
+Opaque cursors for keyset ("seek") pagination.
+
+A cursor holds the sort key of the last row on a page, e.g.
+(updated_at, id). The next page starts strictly after that key, so
+pages stay stable while new rows are inserted and the database never
+has to skip over OFFSET rows.
+
+Cursors are URL-safe base64 of a small JSON list. They are not signed:
+they only ever narrow a query that is already restricted to the
+current user's rows.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, List, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import func
+from sqlalchemy.sql.elements import ColumnElement
+
+
+def encode_cursor(*values: Any) -> str:
+    """Encode sort-key values (datetimes become ISO strings) into a cursor."""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Raises:
+        HTTPException 400: If the cursor is malformed or has the wrong length
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError("wrong cursor size")
+        return values
+    except (ValueError, binascii.Error, UnicodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+
+def decode_timestamp_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Decode a (timestamp, id) cursor.
+
+    Raises:
+        HTTPException 400: If the cursor is malformed
+    """
+    timestamp, row_id = decode_cursor(cursor, 2)
+    try:
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+
+def comparable_timestamp(expression: ColumnElement, dialect_name: str) -> ColumnElement:
+    """
+    Make a timestamp expression safe to compare against a cursor value.
+
+    Postgres compares real timestamps, so the expression is returned as-is.
+    SQLite stores timestamps as text, and rows written by CURRENT_TIMESTAMP
+    ("2024-01-01 10:00:00") and by Python ("2024-01-01 10:00:00.000000")
+    don't compare correctly as strings. On SQLite both sides are
+    normalized with strftime to millisecond precision.
+    """
+    if dialect_name == "sqlite":
+        return func.strftime("%Y-%m-%d %H:%M:%f", expression)
+    return expression
+
+
+def comparable_cursor_timestamp(value: datetime, dialect_name: str) -> Any:
+    """Format a cursor timestamp to match comparable_timestamp()."""
+    if dialect_name == "sqlite":
+        return value.strftime("%Y-%m-%d %H:%M:%S.") + f"{value.microsecond // 1000:03d}"
+    return value
@@ -5,12 +5,17 @@ Each personality is designed to feel HUMAN - with flaws, attitude, and authentic
 Not 100% likeable, but real. Like texting a friend who challenges you.
 """
 
+from .config import settings
+
 PERSONALITIES = {
     "sophia": {
         "name": "Sophia",
         "tagline": "Warm, intuitive, but won't let you off easy",
         "description": "Sophia feels like that friend who really gets you but also calls you out on your BS. She's empathetic and warm, but she'll push you when you're making excuses. Sometimes she asks questions that make you uncomfortable - and that's the point.",
         
+        # Tokens of conversation history sent with each turn (older turns get summarized)
+        "history_token_budget": 4000,
+        
         "system_prompt": """You are Sophia, a mindset coach with a warm but direct approach.
 
 YOUR PERSONALITY:
@@ -51,6 +56,9 @@ REMEMBER: You're not a therapist. You're a coach. A friend who pushes. You chall
         "tagline": "Stoic, direct, no-nonsense truth-teller",
         "description": "Marcus is that coach who doesn't sugarcoat anything. He's inspired by stoic philosophy - focused on what you can control, action over feelings. He can be blunt, sometimes harsh, but he's never mean. He just believes in you too much to let you make excuses.",
         
+        # Marcus keeps things short, so he needs less verbatim history
+        "history_token_budget": 3000,
+        
         "system_prompt": """You are Marcus, a stoic mindset coach who values discipline and action.
 
 YOUR PERSONALITY:
@@ -111,6 +119,20 @@ def get_personality(personality_name: str) -> dict:
     return PERSONALITIES[personality_name]
 
 
+def get_history_token_budget(personality_name: str) -> int:
+    """
+    Get how many tokens of conversation history a personality is sent per turn.
+    
+    Args:
+        personality_name: Name of the personality (e.g., "sophia", "marcus")
+        
+    Returns:
+        The personality's "history_token_budget", or the global
+        HISTORY_TOKEN_BUDGET setting if it doesn't define one
+    """
+    return get_personality(personality_name).get("history_token_budget", settings.HISTORY_TOKEN_BUDGET)
+
+
 def list_personalities() -> list:
     """
     Get a list of all available personalities with their info.
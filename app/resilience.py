@@ -0,0 +1,416 @@
+"""
+Resilience layer around the LLM backend.
+
+ResilientBackend wraps any llm_backends.LLMBackend and adds:
+- Deadlines: each call gets LLM_TIMEOUT_SECONDS in total, retries included
+  (a streamed call: until its first chunk)
+- Retries: up to LLM_MAX_RETRIES more attempts with full-jitter
+  exponential backoff, for retryable errors only (timeouts, 429/5xx-style
+  upstream errors). Bad requests or blocked prompts fail at once.
+- Circuit breaker: after LLM_BREAKER_FAILURE_THRESHOLD consecutive
+  retryable failures, calls fail fast for LLM_BREAKER_RESET_SECONDS, then
+  one trial call decides whether to close it again
+- Hedging (opt-in, LLM_HEDGE_ENABLED): if a non-streamed call hasn't
+  answered by the observed p95 latency, a second attempt is started and
+  whichever finishes first wins
+
+When the upstream can't be reached in time, calls raise LLMUnavailableError,
+which the chat router turns into a 503 with Retry-After instead of a 500.
+State is exported through app/metrics.py.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator, Optional
+
+from . import metrics
+from .config import settings
+
+# Exception class names (from google.api_core and friends) worth retrying.
+# Matched by name so this module doesn't import the Gemini SDK.
+RETRYABLE_ERROR_NAMES = frozenset({
+    "TooManyRequests", "ResourceExhausted",  # 429
+    "InternalServerError", "BadGateway", "ServiceUnavailable", "GatewayTimeout",  # 5xx
+    "DeadlineExceeded", "Aborted", "RetryError",
+    "FakeLLMError",  # FakeBackend's injected failures behave like upstream 5xx
+})
+
+circuit_state = metrics.REGISTRY.register(metrics.Gauge(
+    "llm_circuit_state",
+    "LLM circuit breaker state: 0 = closed, 1 = half-open, 2 = open.",
+))
+llm_attempts = metrics.REGISTRY.register(metrics.Counter(
+    "llm_attempts_total",
+    "LLM call attempts by outcome (ok, retryable_error, error, timeout).",
+    ("outcome",),
+))
+llm_retries = metrics.REGISTRY.register(metrics.Counter(
+    "llm_retries_total",
+    "LLM attempts that were retries of a failed attempt.",
+))
+llm_rejected = metrics.REGISTRY.register(metrics.Counter(
+    "llm_circuit_rejections_total",
+    "LLM calls refused without trying because the circuit was open.",
+))
+llm_hedges = metrics.REGISTRY.register(metrics.Counter(
+    "llm_hedges_total",
+    "Hedged LLM attempts: started, and won (the hedge answered first).",
+    ("event",),
+))
+hedge_delay = metrics.REGISTRY.register(metrics.Gauge(
+    "llm_hedge_delay_seconds",
+    "Current hedging delay (p95 of recent successful LLM calls).",
+))
+
+
+class LLMUnavailableError(RuntimeError):
+    """
+    The LLM upstream is unhealthy, overloaded or too slow right now.
+
+    Attributes:
+        retry_after: Suggested seconds before the client tries again
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+async def close_stream(stream) -> None:
+    """
+    Close an abandoned async stream now, so its upstream connection is
+    released at once rather than whenever it is garbage-collected.
+    """
+    aclose = getattr(stream, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception:
+        pass  # It failed already; that error has been handled
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """True for errors another attempt might not hit (timeouts, 429, 5xx)."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(exc).__mro__)
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker (closed -> open -> half-open).
+
+    Only retryable failures count, and only a success resets the count.
+    A rejected prompt (non-retryable) leaves it unchanged either way: it
+    says nothing about the upstream's health, and a client sending bad
+    requests during an outage mustn't keep the breaker closed.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        circuit_state.set(state)
+
+    def retry_after(self) -> float:
+        return max(self._opened_at + self.reset_seconds - time.monotonic(), 1.0)
+
+    def before_call(self) -> None:
+        """Raise LLMUnavailableError if calls should fail fast right now."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_seconds:
+                    llm_rejected.inc()
+                    raise LLMUnavailableError("LLM circuit open", self.retry_after())
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                # Let exactly one trial call through
+                if self._trial_in_flight:
+                    llm_rejected.inc()
+                    raise LLMUnavailableError("LLM circuit half-open, trial in progress")
+                self._trial_in_flight = True
+
+    def release(self) -> None:
+        """The call was abandoned (cancelled) without an outcome."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self, retryable: bool) -> None:
+        with self._lock:
+            was_trial, self._trial_in_flight = self._trial_in_flight, False
+            if not retryable:
+                if was_trial:
+                    # Inconclusive trial: let the next call try again
+                    self._set_state(self.HALF_OPEN)
+                return
+            self._failures += 1
+            if was_trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, for the hedging delay."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class ResilientBackend:
+    """
+    LLMBackend decorator adding deadlines, retries, a circuit breaker and hedging.
+
+    Implements the same interface as the backend it wraps.
+    """
+
+    def __init__(
+        self,
+        backend,
+        timeout_seconds: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        retry_base_delay: Optional[float] = None,
+        retry_max_delay: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge_enabled: Optional[bool] = None,
+        hedge_quantile: Optional[float] = None,
+        hedge_min_samples: Optional[int] = None
+    ):
+        def pick(value, default):
+            return default if value is None else value
+
+        self.backend = backend
+        self.timeout_seconds = pick(timeout_seconds, settings.LLM_TIMEOUT_SECONDS)
+        self.max_retries = max(0, pick(max_retries, settings.LLM_MAX_RETRIES))
+        self.retry_base_delay = pick(retry_base_delay, settings.LLM_RETRY_BASE_DELAY_SECONDS)
+        self.retry_max_delay = pick(retry_max_delay, settings.LLM_RETRY_MAX_DELAY_SECONDS)
+        self.breaker = breaker or CircuitBreaker(
+            settings.LLM_BREAKER_FAILURE_THRESHOLD, settings.LLM_BREAKER_RESET_SECONDS
+        )
+        self.hedge_enabled = pick(hedge_enabled, settings.LLM_HEDGE_ENABLED)
+        self.hedge_quantile = pick(hedge_quantile, settings.LLM_HEDGE_QUANTILE)
+        self.hedge_min_samples = pick(hedge_min_samples, settings.LLM_HEDGE_MIN_SAMPLES)
+        self.latencies = LatencyTracker()
+
+    def __getattr__(self, name):
+        # Backend-specific extras (e.g. GeminiBackend.model_pool) stay reachable
+        return getattr(self.backend, name)
+
+    # ----- Helpers -----
+
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter: uniform in [0, min(max, base * 2^attempt)]."""
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+
+    def _record(self, exc: Optional[BaseException]) -> bool:
+        """Update the breaker and counters for one attempt; returns retryable."""
+        if exc is None:
+            self.breaker.record_success()
+            llm_attempts.inc(outcome="ok")
+            return False
+        retryable = is_retryable(exc)
+        self.breaker.record_failure(retryable)
+        if isinstance(exc, asyncio.TimeoutError):
+            llm_attempts.inc(outcome="timeout")
+        else:
+            llm_attempts.inc(outcome="retryable_error" if retryable else "error")
+        return retryable
+
+    def _unavailable(self, exc: BaseException) -> LLMUnavailableError:
+        if isinstance(exc, LLMUnavailableError):
+            return exc
+        if isinstance(exc, asyncio.TimeoutError):
+            return LLMUnavailableError(f"LLM did not answer within {self.timeout_seconds:g}s")
+        return LLMUnavailableError(f"LLM upstream error: {exc}")
+
+    async def _hedged(self, call):
+        """
+        Run call(); if it's slower than the p95 of recent calls, race a second one.
+        """
+        delay = self.latencies.quantile(self.hedge_quantile, self.hedge_min_samples) if self.hedge_enabled else None
+        if delay is None:
+            return await call()
+        hedge_delay.set(delay)
+
+        first = asyncio.ensure_future(call())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+
+            llm_hedges.inc(event="started")
+            second = asyncio.ensure_future(call())
+            tasks.append(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            llm_hedges.inc(event="won")
+                        return task.result()
+            # Both failed: report the original attempt's error
+            return first.result()
+        finally:
+            # The loser (or both, if we were cancelled by the deadline)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    # ----- LLMBackend interface -----
+
+    async def generate_async(self, personality_name, history, message, system_prompt=None):
+        deadline = time.monotonic() + self.timeout_seconds
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = time.monotonic()
+            remaining = deadline - started
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                response = await asyncio.wait_for(
+                    self._hedged(lambda: self.backend.generate_async(
+                        personality_name, history, message, system_prompt
+                    )),
+                    timeout=remaining
+                )
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                retryable = self._record(e)
+                pause = self._backoff(attempt)
+                if not retryable:
+                    raise
+                if attempt >= self.max_retries or time.monotonic() + pause >= deadline:
+                    raise self._unavailable(e) from e
+                attempt += 1
+                llm_retries.inc()
+                await asyncio.sleep(pause)
+                continue
+            self._record(None)
+            self.latencies.observe(time.monotonic() - started)
+            return response
+
+    async def stream_async(self, personality_name, history, message, system_prompt=None) -> AsyncIterator[str]:
+        """
+        Deadline and retries apply until the first chunk. After that, the
+        reply is already reaching the client and can't be restarted.
+        """
+        deadline = time.monotonic() + self.timeout_seconds
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            stream = self.backend.stream_async(personality_name, history, message, system_prompt)
+            iterator = stream.__aiter__()
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                first = await asyncio.wait_for(iterator.__anext__(), timeout=remaining)
+            except StopAsyncIteration:
+                self._record(None)
+                return
+            except asyncio.CancelledError:
+                self.breaker.release()
+                await close_stream(stream)
+                raise
+            except Exception as e:
+                await close_stream(stream)
+                retryable = self._record(e)
+                pause = self._backoff(attempt)
+                if not retryable:
+                    raise
+                if attempt >= self.max_retries or time.monotonic() + pause >= deadline:
+                    raise self._unavailable(e) from e
+                attempt += 1
+                llm_retries.inc()
+                await asyncio.sleep(pause)
+                continue
+            break
+
+        finished = False
+        try:
+            yield first
+            async for chunk in iterator:
+                yield chunk
+            finished = True
+        except Exception as e:
+            finished = True
+            self._record(e)
+            raise
+        finally:
+            if not finished:
+                # The consumer stopped reading (e.g. client went away)
+                self.breaker.release()
+                await close_stream(stream)
+        self._record(None)
+
+    def generate(self, personality_name, history, message, system_prompt=None):
+        """
+        Blocking variant: breaker and retries, but no deadline (a blocking
+        call can't be cancelled; use generate_async on request paths).
+        """
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                response = self.backend.generate(personality_name, history, message, system_prompt)
+            except Exception as e:
+                if not self._record(e):
+                    raise
+                if attempt >= self.max_retries:
+                    raise self._unavailable(e) from e
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                llm_retries.inc()
+                continue
+            self._record(None)
+            return response
+
+    def stream(self, personality_name, history, message, system_prompt=None) -> Iterator[str]:
+        """Blocking streaming variant: circuit breaker only."""
+        self.breaker.before_call()
+        try:
+            for chunk in self.backend.stream(personality_name, history, message, system_prompt):
+                yield chunk
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record(None)
+
+    def warm(self) -> None:
+        self.backend.warm()
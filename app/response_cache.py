@@ -0,0 +1,152 @@
+"""
+Opt-in cache of AI responses for repeated turns.
+
+A large share of traffic is the same opener ("hi", "I need motivation",
+the onboarding prompts) sent to a fresh conversation: same personality,
+same (empty) history, same message. Caching those replies skips the LLM
+call entirely.
+
+- Key: SHA-256 of (personality, normalized history, normalized message)
+- Eviction: LRU, plus a TTL per entry and a cap on total bytes
+- Variation: each key can hold several candidate replies. A key only
+  counts as a hit once it has `variants` candidates; until then the LLM
+  is called and its reply added, so repeat users don't always get the
+  exact same words.
+
+Enabled with settings.RESPONSE_CACHE_ENABLED (see ai_service.py).
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s']")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a message so trivial differences map to the same key.
+
+    "Hi!", "hi" and "  HI  " all become "hi".
+    """
+    text = _PUNCTUATION.sub(" ", text.casefold())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def make_key(personality_name: str, history: List[Dict[str, Any]], message: str) -> str:
+    """
+    Build the cache key for one turn.
+
+    Args:
+        personality_name: Personality answering the turn
+        history: Chat history in Gemini format (as sent to the backend)
+        message: The user's current message
+    """
+    normalized_history = [
+        [turn["role"], [normalize_text(str(part)) for part in turn["parts"]]]
+        for turn in history
+    ]
+    payload = json.dumps(
+        [personality_name.lower(), normalized_history, normalize_text(message)],
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Entry:
+    candidates: List[str] = field(default_factory=list)
+    size: int = 0
+    expires_at: float = 0.0
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU + TTL cache of response candidates with a byte cap.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl_seconds: float,
+        variants: int = 1
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return a cached reply for this key, or None on a miss.
+
+        A key with fewer than `variants` candidates is still a miss, so
+        the caller generates (and adds) another candidate.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None or len(entry.candidates) < self.variants:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._rng.choice(entry.candidates)
+
+    def add(self, key: str, response: str) -> None:
+        """Store a reply as one more candidate for this key."""
+        size = len(response.encode("utf-8"))
+        if size + len(key) > self.max_bytes:
+            return  # Would evict everything else; not worth caching
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                entry = _Entry(size=len(key), expires_at=time.monotonic() + self.ttl_seconds)
+                self._entries[key] = entry
+                self._bytes += entry.size
+            if len(entry.candidates) >= self.variants or response in entry.candidates:
+                return
+            entry.candidates.append(response)
+            entry.size += size
+            self._bytes += size
+            self._entries.move_to_end(key)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
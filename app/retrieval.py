@@ -0,0 +1,419 @@
+"""
+Cross-conversation memory: lexical retrieval over a user's past messages.
+
+Each turn only sends the current conversation (see context_builder), so
+the coach forgets what was said in other threads. Sending those threads
+too would blow up the prompt. Instead, every user gets an in-memory BM25
+index over their messages, and each turn:
+1. Scores the new message against the index
+2. Takes the top RETRIEVAL_TOP_K hits from *other* conversations that
+   score at least RETRIEVAL_MIN_SCORE
+3. Trims them to fit RETRIEVAL_TOKEN_BUDGET and hands them to ai_service,
+   which adds them to the prompt as notes
+
+Indexes are built from the database the first time a user chats (in a
+worker thread, newest RETRIEVAL_MAX_MESSAGES_PER_USER messages), then
+updated incrementally as messages are saved, dropping the oldest ones to
+stay within RETRIEVAL_MAX_MESSAGES_PER_USER. At most RETRIEVAL_MAX_USERS
+indexes are kept (LRU). Like the other caches, they are per process.
+
+Off by default: set RETRIEVAL_ENABLED=true. Memory grows with
+RETRIEVAL_MAX_USERS x RETRIEVAL_MAX_MESSAGES_PER_USER (in the worst case),
+and recalled snippets make prompts differ between otherwise identical
+turns, so response_cache hits become rarer.
+
+Scoring is plain Python over an inverted index (term -> {message: tf}),
+so a query only touches the postings of its own terms: a few
+milliseconds even at tens of thousands of messages (see
+benchmarks/bench_retrieval.py).
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import re
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import metrics, models
+from .config import settings
+from .context_builder import count_tokens
+
+# BM25 parameters (the usual defaults)
+K1 = 1.2
+B = 0.75
+
+# Terms in more than this share of a user's messages (and more than
+# MAX_CANDIDATES of them) are skipped at query time: their BM25 weight is
+# small (idf < 1.4, vs ~7 for a rare term), and their postings are the
+# longest to walk
+MAX_DOCUMENT_FREQUENCY = 0.25
+
+# Only the rarest terms of a long message are used as the query
+MAX_QUERY_TERMS = 32
+
+# Once this many messages have a score, the remaining (more common) query
+# terms only adjust those scores. Keeps a query on a big index to a few
+# milliseconds; messages matching only common terms rarely make the top k
+# anyway (about 92% of top-3 hits match exact BM25 on the benchmark's
+# 50k-message user)
+MAX_CANDIDATES = 1000
+
+STOPWORDS = frozenset("""
+    a about after again all also am an and any are as at be because been but by can
+    could did do does doing dont for from get got had has have having he her him his
+    how i id if im in into is it its ive just know like me more my no not now of
+    off ok okay on one or our out really she so some than that thats the their them
+    then there these they this to too up us very was we were what when where which
+    who why will with would yeah yes you your youre
+""".split())
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _stem(word: str) -> str:
+    """Crude suffix stripping, so "disciplined" and "discipline" share a term."""
+    for suffix in ("ing", "ed", "es", "s", "ly", "e"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased, stemmed terms of a text, without stopwords."""
+    return [
+        _stem(word)
+        for word in _WORD.findall(text.lower().replace("'", ""))
+        if len(word) > 1 and word not in STOPWORDS
+    ]
+
+
+@dataclass
+class _Document:
+    conversation_id: int
+    role: str
+    content: str
+
+
+class UserIndex:
+    """
+    BM25 index over one user's messages. Not thread-safe: built in a worker
+    thread, then only used from the event loop.
+    """
+
+    def __init__(self):
+        self.documents: Dict[Hashable, _Document] = {}
+        # term -> {document key: term frequency}
+        self.postings: Dict[str, Dict[Hashable, int]] = {}
+        # document key -> number of terms (kept apart from documents for
+        # the scoring loop)
+        self.lengths: Dict[Hashable, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, key: Hashable, conversation_id: int, role: str, content: str) -> None:
+        """
+        Index a message. Adding the same key twice is a no-op.
+
+        Messages must be added oldest first: trim() drops them in the order
+        they were added.
+        """
+        if key in self.documents:
+            return
+        terms = Counter(tokenize(content))
+        length = sum(terms.values())
+        self.documents[key] = _Document(conversation_id, role, content)
+        self.lengths[key] = length
+        self.total_length += length
+        for term, frequency in terms.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+            posting[key] = frequency
+
+    def remove(self, key: Hashable) -> None:
+        """Drop a message from the index (no-op for an unknown key)."""
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        self.total_length -= self.lengths.pop(key)
+        for term in set(tokenize(document.content)):
+            posting = self.postings[term]
+            del posting[key]
+            if not posting:
+                del self.postings[term]
+
+    def rekey(self, old_key: Hashable, new_key: Hashable) -> None:
+        """
+        Index a message under a new key. If new_key is already indexed
+        (the same message, loaded from the database), old_key is dropped.
+        """
+        if old_key not in self.documents:
+            return
+        if new_key in self.documents:
+            self.remove(old_key)
+            return
+        self.documents[new_key] = self.documents.pop(old_key)
+        self.lengths[new_key] = self.lengths.pop(old_key)
+        for term in set(tokenize(self.documents[new_key].content)):
+            posting = self.postings[term]
+            posting[new_key] = posting.pop(old_key)
+
+    def trim(self, max_documents: int) -> None:
+        """Drop the oldest messages until at most max_documents are left."""
+        while len(self.documents) > max_documents:
+            self.remove(next(iter(self.documents)))
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        exclude_conversation_id: Optional[int] = None,
+        min_score: float = 0.0
+    ) -> List[Tuple[float, _Document]]:
+        """
+        Top k documents for a query, best first, as (score, document).
+        """
+        count = len(self.documents)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1.0
+        length_norm = K1 * B / average_length
+        lengths = self.lengths
+
+        # Rarest terms first: they carry the most weight and have the
+        # shortest postings
+        postings = sorted(
+            (posting for posting in map(self.postings.get, set(tokenize(query))) if posting),
+            key=len
+        )[:MAX_QUERY_TERMS]
+
+        scores: Dict[Hashable, float] = {}
+        for posting in postings:
+            frequency = len(posting)
+            if frequency > MAX_CANDIDATES and frequency > count * MAX_DOCUMENT_FREQUENCY:
+                break
+            idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            if len(scores) < MAX_CANDIDATES:
+                keys = posting
+            else:
+                # Enough candidates: common terms only re-rank them, rather
+                # than walking their whole postings for new ones
+                keys = [key for key in scores if key in posting]
+            for key in keys:
+                tf = posting[key]
+                # BM25: idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+                weight = idf * tf * (K1 + 1) / (tf + K1 * (1 - B) + length_norm * lengths[key])
+                scores[key] = scores.get(key, 0.0) + weight
+
+        documents = self.documents
+        candidates = (
+            (score, key) for key, score in scores.items()
+            if score >= min_score and documents[key].conversation_id != exclude_conversation_id
+        )
+        return [(score, documents[key]) for score, key in heapq.nlargest(k, candidates)]
+
+
+def build_index(rows: Iterable[Tuple[Hashable, int, str, str]]) -> UserIndex:
+    """Index (key, conversation_id, role, content) rows, oldest first."""
+    index = UserIndex()
+    for key, conversation_id, role, content in rows:
+        index.add(key, conversation_id, role, content)
+    return index
+
+
+def format_snippets(
+    hits: List[Tuple[float, _Document]],
+    token_budget: int,
+    snippet_max_tokens: int
+) -> List[str]:
+    """
+    Hits as prompt lines ("I said: ..." for the user, "You said: ..." for
+    the coach), truncated and packed into the token budget, best first.
+    """
+    lines = []
+    seen = set()
+    used = 0
+    max_chars = snippet_max_tokens * 4  # See context_builder.count_tokens
+    for _, document in hits:
+        content = " ".join(document.content.split())
+        if content in seen:
+            continue
+        seen.add(content)
+        if len(content) > max_chars:
+            content = content[:max_chars].rsplit(" ", 1)[0] + "…"
+        speaker = "I said" if document.role == "user" else "You said"
+        line = f"{speaker}: {content}"
+        tokens = count_tokens(line)
+        if used + tokens > token_budget:
+            continue  # A shorter, lower-ranked hit may still fit
+        used += tokens
+        lines.append(line)
+    return lines
+
+
+class RetrievalMemory:
+    """
+    Per-user UserIndex objects, built on first use and kept up to date
+    with add(). Only used from the event loop.
+    """
+
+    def __init__(self, max_users: int, max_messages_per_user: int):
+        self.max_users = max_users
+        self.max_messages_per_user = max_messages_per_user
+        self._indexes: "OrderedDict[int, UserIndex]" = OrderedDict()
+        # Builds in progress, and messages saved while they run
+        self._loading: Dict[int, "asyncio.Future[UserIndex]"] = {}
+        self._added_while_loading: Dict[int, List[Tuple[Hashable, int, str, str]]] = {}
+        # Keys for queued (write-behind) messages, which have no id yet
+        self._pending_keys = itertools.count(-1, -1)
+
+    def add(
+        self,
+        user_id: int,
+        message_id: Optional[int],
+        conversation_id: int,
+        role: str,
+        content: str
+    ) -> Hashable:
+        """
+        Index a newly saved message.
+
+        Users without an index yet are skipped: their first turn loads
+        every stored message anyway.
+
+        Returns:
+            The message's key in the index: its id, or a placeholder for a
+            queued (write-behind) message, to hand to rekey() once the
+            message is stored
+        """
+        key = message_id if message_id is not None else next(self._pending_keys)
+        row = (key, conversation_id, role, content)
+        if user_id in self._loading:
+            self._added_while_loading[user_id].append(row)
+            return key
+        index = self._indexes.get(user_id)
+        if index is not None:
+            index.add(*row)
+            index.trim(self.max_messages_per_user)
+        return key
+
+    def rekey(self, user_id: int, key: Hashable, message_id: Optional[int]) -> None:
+        """
+        A queued message was stored (under message_id) or dropped
+        (message_id None): replace its placeholder key, so it isn't indexed
+        twice once it is also read back from the database.
+        """
+        if user_id in self._loading:
+            rows = self._added_while_loading[user_id]
+            rows[:] = [
+                (message_id,) + row[1:] if row[0] == key else row
+                for row in rows if row[0] != key or message_id is not None
+            ]
+            return
+        index = self._indexes.get(user_id)
+        if index is None:
+            return
+        if message_id is None:
+            index.remove(key)
+        else:
+            index.rekey(key, message_id)
+
+    async def _load(self, db: AsyncSession, user_id: int) -> UserIndex:
+        rows = (await db.execute(
+            select(
+                models.Message.id,
+                models.Message.conversation_id,
+                models.Message.role,
+                models.Message.content
+            )
+            .join(models.Conversation)
+            .where(models.Conversation.user_id == user_id)
+            .order_by(models.Message.id.desc())
+            .limit(self.max_messages_per_user)
+        )).all()
+        # Tokenizing thousands of messages would stall the event loop.
+        # Oldest first, so trim() drops the oldest
+        return await asyncio.to_thread(build_index, [tuple(row) for row in reversed(rows)])
+
+    async def index_for(self, db: AsyncSession, user_id: int) -> UserIndex:
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+            return index
+
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = self._loading[user_id] = asyncio.get_running_loop().create_future()
+        self._added_while_loading[user_id] = []
+        try:
+            index = await self._load(db, user_id)
+        except BaseException as e:
+            del self._loading[user_id]
+            del self._added_while_loading[user_id]
+            loading.set_exception(e)
+            loading.exception()  # Mark retrieved: there may be no waiter
+            raise
+        for row in self._added_while_loading.pop(user_id):
+            index.add(*row)
+        index.trim(self.max_messages_per_user)
+        del self._loading[user_id]
+        self._indexes[user_id] = index
+        while len(self._indexes) > self.max_users:
+            self._indexes.popitem(last=False)
+        loading.set_result(index)
+        return index
+
+    async def recall(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        conversation_id: int,
+        query: str
+    ) -> List[str]:
+        """
+        Snippets of the user's other conversations relevant to `query`,
+        ready for the prompt (see format_snippets). Empty if nothing
+        scores high enough.
+        """
+        index = await self.index_for(db, user_id)
+        hits = index.search(
+            query,
+            settings.RETRIEVAL_TOP_K,
+            exclude_conversation_id=conversation_id,
+            min_score=settings.RETRIEVAL_MIN_SCORE,
+        )
+        return format_snippets(hits, settings.RETRIEVAL_TOKEN_BUDGET, settings.RETRIEVAL_SNIPPET_MAX_TOKENS)
+
+    def clear(self) -> None:
+        self._indexes.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._indexes),
+            "messages": sum(len(index) for index in self._indexes.values()),
+            "loading": len(self._loading),
+        }
+
+
+# Created only when retrieval is enabled (None = no cross-conversation memory)
+memory: Optional[RetrievalMemory] = None
+if settings.RETRIEVAL_ENABLED:
+    memory = RetrievalMemory(
+        max_users=settings.RETRIEVAL_MAX_USERS,
+        max_messages_per_user=settings.RETRIEVAL_MAX_MESSAGES_PER_USER,
+    )
+metrics.REGISTRY.register(metrics.StatsCollector(
+    "retrieval",
+    "Per-user retrieval indexes, from RetrievalMemory.stats()",
+    lambda: None if memory is None else memory.stats(),
+))
@@ -1,11 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+import asyncio
+import functools
+import json
+import math
+import time
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, tuple_
 from datetime import datetime
-from typing import List
+from typing import Callable, List, Optional, Set, Tuple
 
-from .. import models, schemas, security, ai_service
-from ..database import SessionLocal
+from .. import models, schemas, security, ai_service, context_builder, crud, http_cache, metrics, retrieval, search, serialization, write_behind
+from ..admission import admission_controller
+from ..database import AsyncSessionLocal, get_db, read_session, replica_router, use_replica_async
+from ..idempotency import conversation_locks, fingerprint, idempotency_store
+from ..resilience import LLMUnavailableError
+from ..personalities import get_personality
+from ..pagination import (
+    comparable_cursor_timestamp,
+    comparable_timestamp,
+    decode_cursor,
+    decode_timestamp_cursor,
+    encode_cursor,
+)
 
 # Create a router for chat-related endpoints
 # prefix="/chat" means all routes in this router will start with /chat
@@ -13,24 +30,242 @@ from ..database import SessionLocal
 router = APIRouter(prefix="/chat", tags=["chat"])
 
 
-# Dependency to get database session
-def get_db():
-    db = SessionLocal()
+# Dependency for read-only endpoints
+# Why: history and listing reads can go to a read replica (see
+# database.use_replica), keeping them off the primary that takes the writes.
+# Same request session as get_db, so auth and the endpoint still share it.
+async def get_read_db(
+    db: AsyncSession = Depends(get_db),
+    current_user: security.Principal = Depends(security.get_current_user)
+) -> AsyncSession:
+    await use_replica_async(db, current_user.id)
+    return db
+
+
+def retry_after_seconds(error: LLMUnavailableError) -> int:
+    return max(1, int(math.ceil(error.retry_after)))
+
+
+def llm_unavailable(error: LLMUnavailableError) -> HTTPException:
+    """503 with Retry-After for an LLM upstream that is down or too slow."""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=f"AI service unavailable: {error}",
+        headers={"Retry-After": str(retry_after_seconds(error))}
+    )
+
+
+def conversation_not_found() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Conversation not found or you don't have access to it"
+    )
+
+
+async def get_owned_conversation(
+    db: AsyncSession,
+    conversation_id: int,
+    user_id: int
+) -> models.Conversation:
+    """
+    Load a conversation that belongs to the given user, or raise a 404.
+    """
+    result = await db.execute(
+        select(models.Conversation).where(
+            models.Conversation.id == conversation_id,
+            models.Conversation.user_id == user_id  # Security: ensure it belongs to this user
+        )
+    )
+    conversation = result.scalars().first()
+
+    if not conversation:
+        raise conversation_not_found()
+    return conversation
+
+
+async def latest_message_id(
+    db: AsyncSession,
+    conversation_id: Optional[int] = None,
+    user_id: Optional[int] = None
+) -> int:
+    """
+    Id of the newest stored message of a conversation (or of all a user's
+    conversations), 0 if there is none.
+
+    Messages are only ever appended, so this plus the conversation id
+    identifies a transcript's state: the basis of its ETag.
+    """
+    query = select(func.max(models.Message.id))
+    if conversation_id is not None:
+        query = query.where(models.Message.conversation_id == conversation_id)
+    if user_id is not None:
+        query = query.join(models.Conversation).where(models.Conversation.user_id == user_id)
+    return (await db.execute(query)).scalar() or 0
+
+
+async def start_turn(
+    db: AsyncSession,
+    request: schemas.ChatRequest,
+    current_user: security.Principal
+) -> Tuple[int, context_builder.ConversationContext, str]:
+    """
+    Shared first half of a chat turn (used by /chat and /chat/stream).
+
+    1. Resolve the personality (400 if it doesn't exist)
+    2. Save the user's message in one transaction: either together with a
+       new conversation, or after checking the given one is the user's
+    3. Build the history window (excluding the new message): recent turns
+       verbatim plus a rolling summary of older ones
+    4. Recall relevant snippets of the user's other conversations
+       (retrieval.py), and index the new message for later turns
+
+    Returns:
+        (conversation_id, context, personality_name)
+    """
+    # Determine which personality to use
+    personality_name = request.personality_id or current_user.selected_personality or "sophia"
+    # Before anything is written: an unknown name must not leave a user
+    # message behind without a reply
     try:
-        yield db
-    finally:
-        db.close()
+        get_personality(personality_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    # Only known names become metric labels (bounded series count)
+    metrics.set_personality(personality_name)
+
+    # Save the user's message, creating the conversation if needed.
+    # Either way it is one transaction (see crud)
+    if request.conversation_id:
+        # Write-behind: the previous reply may still be queued. Write it
+        # first so ids (and the history below) stay in conversation order
+        queue = write_behind.message_queue
+        if queue is not None and queue.has_pending(request.conversation_id):
+            await queue.flush()
+        # Ownership check and counter bump happen in the same UPDATE
+        with metrics.span("db_commit_user_message"):
+            user_message = await crud.append_message(
+                db, request.conversation_id, "user", request.message, user_id=current_user.id
+            )
+        if user_message is None:
+            raise conversation_not_found()
+        conversation_id = request.conversation_id
+    else:
+        with metrics.span("db_commit_conversation"):
+            conversation, user_message = await crud.create_conversation_with_message(
+                db, current_user.id, request.message
+            )
+        conversation_id = conversation.id
+    # Read-your-writes: keep this user's reads on the primary for a while
+    replica_router.pin_user(current_user.id)
+
+    # Build the token-budgeted history (excluding the message we just added)
+    with metrics.span("history_load"):
+        context = await context_builder.build_context(
+            db,
+            conversation_id,
+            personality_name,
+            exclude_message_id=user_message.id
+        )
+    memory = retrieval.memory
+    if memory is not None:
+        with metrics.span("retrieval"):
+            context.recalled = await memory.recall(db, current_user.id, conversation_id, request.message)
+        memory.add(current_user.id, user_message.id, conversation_id, "user", request.message)
+    # End the read transaction: no connection is held while the LLM answers
+    await db.commit()
+
+    return conversation_id, context, personality_name
+
+
+async def start_admitted_turn(
+    db: AsyncSession,
+    request: schemas.ChatRequest,
+    current_user: security.Principal
+) -> Tuple[int, context_builder.ConversationContext, str]:
+    """
+    start_turn for a turn already through admission control. If the
+    request is refused there (404 conversation, 400 personality, ...), the
+    user gets their rate limit token back: the turn never reached the LLM.
+    """
+    try:
+        return await start_turn(db, request, current_user)
+    except HTTPException as e:
+        if e.status_code < 500:
+            await admission_controller.refund(current_user.id)
+        raise
+
+
+async def complete_turn(
+    db: AsyncSession,
+    request: schemas.ChatRequest,
+    current_user: security.Principal
+) -> dict:
+    """
+    Run one whole non-streamed turn (the body of POST /chat).
+
+    Holds the conversation's lock throughout, so two turns on the same
+    conversation can't interleave their history reads and writes.
+    Admission control (rate limit, LLM slot) comes next, inside the lock
+    (a turn waiting for the lock doesn't sit on an LLM slot) and before
+    anything is written (a rejected turn leaves nothing behind).
+    """
+    async with conversation_locks.hold(request.conversation_id), \
+            admission_controller.hold(current_user.id):
+        # Steps 1-3: Conversation, user message and history window
+        conversation_id, context, personality_name = await start_admitted_turn(
+            db, request, current_user
+        )
+
+        # Step 4: Generate AI response using Gemini with personality
+        try:
+            with metrics.span("llm_call"):
+                ai_response_text = await ai_service.generate_response_async(
+                    user_message=request.message,
+                    conversation_history=context.messages,
+                    personality_name=personality_name,
+                    summary=context.summary,
+                    recalled=context.recalled
+                )
+        except LLMUnavailableError as e:
+            # Upstream down or too slow (after retries): tell the client
+            # when to come back instead of reporting a server bug
+            raise llm_unavailable(e)
+        except Exception as e:
+            # If AI generation fails, provide a helpful error
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"AI service error: {str(e)}"
+            )
+
+        # Step 5: Save the AI's response
+        with metrics.span("db_commit_assistant_message"):
+            ai_message = await save_assistant_message(
+                conversation_id, current_user.id, ai_response_text, db=db
+            )
+        replica_router.pin_user(current_user.id)
+
+    # Step 6: Return the response in frontend-expected format
+    return {
+        "conversation_id": conversation_id,
+        "response": ai_response_text,
+        "created_at": ai_message.created_at.isoformat()
+    }
 
 
 @router.post("", response_model=dict)
-def send_message(
+async def send_message(
     request: schemas.ChatRequest,
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Send a message to the AI coach.
-    
+
     Flow:
     1. Check if conversation_id is provided
        - If yes: Verify it belongs to the current user
@@ -40,159 +275,673 @@ def send_message(
     4. Generate AI response using Gemini with selected personality
     5. Save the AI's response to the database
     6. Return the response
-    
+
+    Retries: send the same Idempotency-Key header with each retry of a
+    turn. A retry that arrives while the turn is still running waits for
+    it; one that arrives later gets the same result back (with an
+    Idempotent-Replayed: true header). Either way Gemini is called once.
+
     Authentication: Requires valid JWT token in Authorization header
     """
-    
-    # Determine which personality to use
-    personality_name = request.personality_id or current_user.selected_personality or "sophia"
-    
-    # Step 1: Get or create conversation
-    if request.conversation_id:
-        # User provided a conversation_id, so retrieve it
-        conversation = db.query(models.Conversation).filter(
-            models.Conversation.id == request.conversation_id,
-            models.Conversation.user_id == current_user.id  # Security: ensure it belongs to this user
-        ).first()
-        
-        if not conversation:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Conversation not found or you don't have access to it"
-            )
-    else:
-        # No conversation_id provided, create a new conversation
-        conversation = models.Conversation(user_id=current_user.id)
-        db.add(conversation)
-        db.commit()
-        db.refresh(conversation)  # Refresh to get the auto-generated ID
-    
-    # Step 2: Save the user's message
-    user_message = models.Message(
-        conversation_id=conversation.id,
-        role="user",
-        content=request.message
+    if idempotency_key is None:
+        return await complete_turn(db, request, current_user)
+
+    result, replayed = await idempotency_store.run(
+        ("chat", str(current_user.id)),
+        idempotency_key,
+        fingerprint(request.dict()),
+        lambda: complete_turn(db, request, current_user)
     )
-    db.add(user_message)
-    db.commit()
-    
-    # Step 3: Retrieve conversation history (excluding the message we just added)
-    conversation_history = db.query(models.Message).filter(
-        models.Message.conversation_id == conversation.id,
-        models.Message.id != user_message.id  # Exclude the current message
-    ).order_by(models.Message.created_at).all()
-    
-    # Step 4: Generate AI response using Gemini with personality
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Format one Server-Sent Events frame.
+
+    Each frame is "event: <name>" plus a single JSON "data:" line.
+    json.dumps never emits raw newlines, so the payload can't break the frame.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def save_assistant_message(
+    conversation_id: int,
+    user_id: int,
+    content: str,
+    db: Optional[AsyncSession] = None
+):
+    """
+    Persist the assistant's reply.
+
+    With write-behind enabled (write_behind.py) the reply is only queued,
+    and the returned PendingMessage has no id yet. Otherwise it is written
+    now, in `db` or, for a streamed turn, in its own session: the stream
+    outlives the request's dependencies, and may run after the client
+    has already gone away.
+
+    Returns:
+        The saved Message, or the queued PendingMessage
+    """
+    queue = write_behind.message_queue
+    if queue is not None:
+        message = await queue.put(conversation_id, user_id, "assistant", content)
+    elif db is not None:
+        message = await crud.append_message(db, conversation_id, "assistant", content)
+    else:
+        async with AsyncSessionLocal() as db:
+            message = await crud.append_message(db, conversation_id, "assistant", content)
+    memory = retrieval.memory
+    if memory is not None:
+        key = memory.add(user_id, message.id, conversation_id, "assistant", content)
+        if message.id is None:
+            # Queued: index it under its id once the flush has stored it
+            message.on_settled.append(lambda stored: memory.rekey(user_id, key, stored.id))
+    return message
+
+
+# Streamed turns still running (a reference keeps each task from being
+# garbage-collected while its client is gone)
+_stream_tasks: Set[asyncio.Task] = set()
+
+
+async def replay_stream(result: "asyncio.Future[dict]"):
+    """
+    SSE for a retried streamed turn: wait for the original, then send its
+    whole reply as a single token event.
+    """
     try:
-        ai_response_text = ai_service.generate_response(
-            user_message=request.message,
-            conversation_history=conversation_history,
-            personality_name=personality_name
-        )
+        turn = await asyncio.shield(result)
     except Exception as e:
-        # If AI generation fails, provide a helpful error
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"AI service error: {str(e)}"
+        detail = e.detail if isinstance(e, HTTPException) else f"AI service error: {str(e)}"
+        yield format_sse("error", {"detail": detail})
+        return
+    yield format_sse("start", {"conversation_id": turn["conversation_id"]})
+    yield format_sse("token", {"text": turn["response"]})
+    yield format_sse("done", {
+        "conversation_id": turn["conversation_id"],
+        "message_id": turn["message_id"],
+        "created_at": turn["created_at"]
+    })
+
+
+async def start_streamed_turn(
+    db: AsyncSession,
+    request: schemas.ChatRequest,
+    current_user: security.Principal,
+    on_done: Optional[Callable[[dict], None]] = None,
+    on_failure: Optional[Callable[[BaseException], None]] = None
+) -> Tuple[int, "asyncio.Queue[Tuple[str, dict]]"]:
+    """
+    Start a streamed turn (used by /chat/stream and the /chat/ws socket).
+
+    The conversation lock, admission control (in that order, see
+    complete_turn) and start_turn happen before this returns, so rejections surface as HTTPExceptions. The reply is
+    then generated by a background task that owns the lock and the
+    admission ticket: it completes and is saved even if the client goes
+    away.
+
+    Args:
+        db: Session for start_turn (not used once this returns)
+        request: The turn
+        current_user: Who is chatting
+        on_done: Called with the done event's data plus "response" (the
+                 whole reply) once the reply is saved
+        on_failure: Called with the exception if the turn fails, before
+                    or after this returns
+
+    Returns:
+        (conversation_id, events): events yields ("token", {"text"}) for
+        each chunk, then exactly one ("done", {...}) or ("error", {...})
+    """
+    ticket = None
+    locked = False
+    try:
+        # Serialize with other turns on this conversation until the reply
+        # is saved. Taken before the LLM slot, so waiting here holds no slot
+        await conversation_locks.acquire(request.conversation_id)
+        locked = True
+        # Rate limit and LLM slot before anything is written
+        ticket = await admission_controller.acquire(current_user.id)
+        conversation_id, context, personality_name = await start_admitted_turn(
+            db, request, current_user
         )
-    
-    # Step 5: Save the AI's response
-    ai_message = models.Message(
-        conversation_id=conversation.id,
-        role="assistant",
-        content=ai_response_text
-    )
-    db.add(ai_message)
-    db.commit()
-    db.refresh(ai_message)  # Refresh to get created_at timestamp
-    
-    # Step 6: Return the response in frontend-expected format
-    return {
-        "conversation_id": conversation.id,
-        "response": ai_response_text,
-        "created_at": ai_message.created_at.isoformat()
+    except BaseException as e:
+        if locked:
+            conversation_locks.release(request.conversation_id)
+        admission_controller.release(ticket)
+        if on_failure is not None:
+            on_failure(e)
+        raise
+
+    events: "asyncio.Queue[Tuple[str, dict]]" = asyncio.Queue()
+
+    async def generate():
+        """Produce the reply into `events`; owns the lock and the admission ticket."""
+        parts: List[str] = []
+        try:
+            try:
+                with metrics.span("llm_stream"):
+                    started = time.perf_counter()
+                    async for chunk in ai_service.generate_response_streaming_async(
+                        user_message=request.message,
+                        conversation_history=context.messages,
+                        personality_name=personality_name,
+                        summary=context.summary,
+                        recalled=context.recalled
+                    ):
+                        if not parts:
+                            metrics.observe_time_to_first_token(time.perf_counter() - started)
+                        parts.append(chunk)
+                        events.put_nowait(("token", {"text": chunk}))
+            except Exception as e:
+                if on_failure is not None:
+                    on_failure(e)
+                error = {"detail": f"AI service error: {str(e)}"}
+                if isinstance(e, LLMUnavailableError):
+                    error = {"detail": str(e), "retry_after": retry_after_seconds(e)}
+                events.put_nowait(("error", error))
+                return
+
+            with metrics.span("db_commit_assistant_message"):
+                ai_message = await save_assistant_message(conversation_id, current_user.id, "".join(parts))
+            replica_router.pin_user(current_user.id)
+            done = {
+                "conversation_id": conversation_id,
+                "message_id": ai_message.id,
+                "created_at": ai_message.created_at.isoformat()
+            }
+            if on_done is not None:
+                on_done(dict(done, response="".join(parts)))
+            events.put_nowait(("done", done))
+        except BaseException as e:
+            if on_failure is not None:
+                on_failure(e)
+            events.put_nowait(("error", {"detail": "Could not save the reply"}))
+            raise
+        finally:
+            conversation_locks.release(request.conversation_id)
+            admission_controller.release(ticket)
+
+    task = asyncio.create_task(generate())
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+    return conversation_id, events
+
+
+@router.post("/stream")
+async def stream_message(
+    request: schemas.ChatRequest,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Send a message to the AI coach and stream the reply as Server-Sent Events.
+
+    The user's message is saved before streaming starts. Events:
+    - start: {"conversation_id"}
+    - token: {"text"} for each chunk as Gemini produces it
+    - done:  {"conversation_id", "message_id", "created_at"} once the reply is saved
+    - error: {"detail"} if generation fails mid-stream
+
+    The reply is generated by a background task, so if the client
+    disconnects mid-stream the turn still completes and is saved.
+    With an Idempotency-Key, a retry of the same turn doesn't start a new
+    one: it receives the finished reply as one token event.
+
+    Authentication: Requires valid JWT token in Authorization header
+    """
+    scope = ("stream", str(current_user.id))
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Stop nginx-style proxies from buffering the stream
     }
+    on_done = on_failure = None
+    if idempotency_key is not None:
+        existing = idempotency_store.claim(scope, idempotency_key, fingerprint(request.dict()))
+        if existing is not None:
+            headers["Idempotent-Replayed"] = "true"
+            return StreamingResponse(replay_stream(existing), media_type="text/event-stream", headers=headers)
+        # The turn settles the key: resolved with the reply, or abandoned on failure
+        on_done = functools.partial(idempotency_store.resolve, scope, idempotency_key)
+        on_failure = functools.partial(idempotency_store.abandon, scope, idempotency_key)
+
+    # Rejections (rate limit, no LLM slot, unknown conversation) are plain
+    # 4xx/5xx responses rather than SSE errors: nothing is streamed yet
+    conversation_id, events = await start_streamed_turn(db, request, current_user, on_done, on_failure)
+
+    async def event_stream():
+        yield format_sse("start", {"conversation_id": conversation_id})
+        while True:
+            event, data = await events.get()
+            yield format_sse(event, data)
+            if event != "token":
+                return
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
 
 
-@router.get("/conversations", response_model=List[schemas.ConversationSummary])
-def list_conversations(
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+@router.get("/conversations", response_model=schemas.ConversationPage)
+async def list_conversations(
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
-    List all conversations for the current user.
-    
+    List the current user's conversations, most recently active first.
+
     Returns a summary of each conversation including message count.
+    Counts and last activity are denormalized onto the conversation row
+    (see crud.append_message), so this reads only the conversations table,
+    through the (user_id, last_message_at) index.
+
+    Pagination (keyset on (last_message_at, id)):
+    - limit: Page size (1-100, default 20)
+    - cursor: The next_cursor from the previous page
+
+    The ETag covers the page's rows, so a 304 saves the transfer (not the query).
     """
-    conversations = db.query(models.Conversation).filter(
-        models.Conversation.user_id == current_user.id
-    ).order_by(models.Conversation.updated_at.desc()).all()
-    
-    # Add message count to each conversation
-    result = []
-    for conv in conversations:
-        message_count = db.query(func.count(models.Message.id)).filter(
-            models.Message.conversation_id == conv.id
-        ).scalar()
-        
-        result.append(schemas.ConversationSummary(
-            id=conv.id,
-            created_at=conv.created_at,
-            updated_at=conv.updated_at,
-            message_count=message_count
-        ))
-    
-    return result
+    query = select(
+        models.Conversation.id,
+        models.Conversation.created_at,
+        models.Conversation.last_message_at,
+        models.Conversation.message_count
+    ).where(models.Conversation.user_id == current_user.id)
+
+    # Keyset: (last_message_at, id) strictly after the cursor, newest first
+    dialect_name = db.get_bind().dialect.name
+    sort_key = comparable_timestamp(models.Conversation.last_message_at, dialect_name)
+    if cursor:
+        cursor_updated_at, cursor_id = decode_timestamp_cursor(cursor)
+        query = query.where(
+            tuple_(sort_key, models.Conversation.id)
+            < tuple_(comparable_cursor_timestamp(cursor_updated_at, dialect_name), cursor_id)
+        )
+
+    # Fetch one extra row to know whether there is a next page
+    rows = (await db.execute(
+        query.order_by(sort_key.desc(), models.Conversation.id.desc()).limit(limit + 1)
+    )).all()
+
+    etag = http_cache.strong_etag(
+        "conversations", current_user.id, cursor, limit, [tuple(row) for row in rows]
+    )
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+
+    # updated_at is the last activity, here and in get_conversation
+    items = [
+        schemas.ConversationSummary(
+            id=row.id,
+            created_at=row.created_at,
+            updated_at=row.last_message_at,
+            message_count=row.message_count
+        )
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last.updated_at, last.id)
+
+    return schemas.ConversationPage(items=items, next_cursor=next_cursor)
+
+
+def transcript_columns():
+    """The columns of a schemas.MessageResponse, selected as plain rows."""
+    return select(
+        models.Message.id,
+        models.Message.role,
+        models.Message.content,
+        models.Message.created_at
+    )
+
+
+def transcript_rows(rows, pending: List[write_behind.PendingMessage]) -> List[dict]:
+    """
+    schemas.MessageResponse-shaped dicts for transcript_columns() rows,
+    plus replies still queued by write-behind.
+
+    Fast read path for whole transcripts: no ORM objects in the identity
+    map and no pydantic validation, just tuples to dicts, encoded by
+    serialization.json_response. response_model still documents the shape.
+    """
+    if pending:
+        rows = write_behind.overlay(rows, pending)
+    return [
+        {"id": m.id, "role": m.role, "content": m.content, "created_at": m.created_at}
+        for m in rows
+    ]
 
 
 @router.get("/conversations/{conversation_id}", response_model=schemas.ConversationDetail)
-def get_conversation(
+async def get_conversation(
     conversation_id: int,
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     Get a specific conversation with full message history.
-    
+
+    Conditional: the ETag is the conversation id plus its newest message
+    id, checked before the messages are loaded, so an unchanged transcript
+    costs one indexed lookup and a 304.
+
     Security: Only returns conversation if it belongs to the current user.
     """
-    conversation = db.query(models.Conversation).filter(
-        models.Conversation.id == conversation_id,
-        models.Conversation.user_id == current_user.id
-    ).first()
-    
-    if not conversation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Conversation not found or you don't have access to it"
-        )
-    
-    # Get all messages for this conversation
-    messages = db.query(models.Message).filter(
-        models.Message.conversation_id == conversation_id
-    ).order_by(models.Message.created_at).all()
-    
-    return schemas.ConversationDetail(
-        id=conversation.id,
-        created_at=conversation.created_at,
-        updated_at=conversation.updated_at,
-        messages=[schemas.MessageResponse.from_orm(msg) for msg in messages]
+    conversation = await get_owned_conversation(db, conversation_id, current_user.id)
+
+    # Replies still queued by write-behind (snapshot before the query)
+    queue = write_behind.message_queue
+    pending = queue.pending_for_conversation(conversation_id) if queue is not None else []
+
+    etag = http_cache.strong_etag(
+        "conversation",
+        current_user.id,
+        conversation_id,
+        await latest_message_id(db, conversation_id=conversation_id),
+        len(pending)
     )
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+
+    # Get all messages for this conversation (fast path, see transcript_rows)
+    rows = (await db.execute(
+        transcript_columns().where(
+            models.Message.conversation_id == conversation_id
+        ).order_by(models.Message.created_at, models.Message.id)
+    )).all()
+
+    return serialization.json_response({
+        "id": conversation.id,
+        "created_at": conversation.created_at,
+        # Same source as the conversation list (its sort key): last activity
+        "updated_at": conversation.last_message_at,
+        "messages": transcript_rows(rows, pending),
+    }, headers=response.headers)
 
 
 @router.get("/history", response_model=List[schemas.MessageResponse])
-def get_chat_history(
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+async def get_chat_history(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     Get chat history for the current user (all messages from all conversations).
-    
+
     Returns messages in chronological order.
+    Conditional on the user's newest message id (see get_conversation).
+    """
+    # Replies still queued by write-behind (snapshot before the query)
+    queue = write_behind.message_queue
+    pending = queue.pending_for_user(current_user.id) if queue is not None else []
+
+    etag = http_cache.strong_etag(
+        "history",
+        current_user.id,
+        await latest_message_id(db, user_id=current_user.id),
+        len(pending)
+    )
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+
+    rows = (await db.execute(
+        transcript_columns().join(models.Conversation).where(
+            models.Conversation.user_id == current_user.id
+        ).order_by(models.Message.created_at, models.Message.id)
+    )).all()
+
+    return serialization.json_response(transcript_rows(rows, pending), headers=response.headers)
+
+
+@router.get("/search", response_model=schemas.SearchPage)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=50),
+    cursor: Optional[str] = None,
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Full-text search over the current user's messages, best match first.
+
+    Every word of q must appear (English stemming: "disciplined" finds
+    "discipline"). Each result has its conversation id and a highlighted
+    snippet (see search.py).
+
+    Pagination:
+    - limit: Page size (1-50, default 20)
+    - cursor: The next_cursor from the previous page
+
+    Ranked results can't be keyset-paginated on a stable column, so the
+    cursor holds an offset; ranking has to score every match anyway, so
+    skipping the earlier ones adds little.
+    """
+    offset = decode_cursor(cursor, 1)[0] if cursor else 0
+    if not isinstance(offset, int) or offset < 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+    # Queued replies (write-behind) aren't in the index until written
+    await flush_pending_writes(current_user.id)
+    with metrics.span("search"):
+        hits = await search.search_messages(db, current_user.id, q, limit + 1, offset)
+
+    next_cursor = encode_cursor(offset + limit) if len(hits) > limit else None
+    return schemas.SearchPage(
+        results=[schemas.SearchResult.from_orm(hit) for hit in hits[:limit]],
+        next_cursor=next_cursor
+    )
+
+
+# ===== PAGINATED AND STREAMED HISTORY =====
+
+# Rows fetched per round-trip by the NDJSON export's server-side cursor
+EXPORT_BATCH_SIZE = 500
+
+
+async def get_message_page(
+    db: AsyncSession,
+    query,
+    limit: int,
+    before_id: Optional[int],
+    after_id: Optional[int]
+) -> schemas.MessagePage:
+    """
+    Run one keyset-paginated page of a message query.
+
+    Ordered by Message.id (not created_at) so messages written in the same
+    instant still have a stable, total order.
+
+    - after_id: Page forward from that message (oldest first)
+    - before_id: Page backward from that message
+    - neither: The newest page
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before_id or after_id, not both"
+        )
+
+    # Fetch one extra row to know whether there is another page
+    if after_id is not None:
+        query = query.where(models.Message.id > after_id).order_by(models.Message.id.asc())
+    else:
+        if before_id is not None:
+            query = query.where(models.Message.id < before_id)
+        query = query.order_by(models.Message.id.desc())
+    rows = (await db.execute(query.limit(limit + 1))).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()  # Backward pages are fetched newest first; return oldest first
+
+    messages = [schemas.HistoryMessage(**row._mapping) for row in rows]
+    next_cursor = None
+    if has_more and messages:
+        next_cursor = messages[-1].id if after_id is not None else messages[0].id
+
+    return schemas.MessagePage(messages=messages, has_more=has_more, next_cursor=next_cursor)
+
+
+async def flush_pending_writes(user_id: int) -> None:
+    """
+    Write the user's queued replies (write-behind) before a paged read.
+
+    Keyset pages and exports are keyed on message ids, which queued
+    replies don't have yet, so these endpoints read through the queue
+    instead of overlaying it.
+    """
+    queue = write_behind.message_queue
+    if queue is not None and queue.has_pending_for_user(user_id):
+        await queue.flush()
+
+
+def message_columns():
+    return select(
+        models.Message.id,
+        models.Message.conversation_id,
+        models.Message.role,
+        models.Message.content,
+        models.Message.created_at
+    )
+
+
+def stream_ndjson(query, user_id: int) -> StreamingResponse:
+    """
+    Stream query rows as NDJSON (one JSON message per line).
+
+    Reads through a server-side cursor (yield_per) in its own read session, so
+    memory stays constant no matter how long the transcript is.
+    """
+    async def lines():
+        async with read_session(user_id) as db:
+            result = await db.stream(
+                query.order_by(models.Message.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for row in result:
+                yield json.dumps({
+                    "id": row.id,
+                    "conversation_id": row.conversation_id,
+                    "role": row.role,
+                    "content": row.content,
+                    "created_at": row.created_at.isoformat()
+                }) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.get("/history/page", response_model=schemas.MessagePage)
+async def get_chat_history_page(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Get one page of the current user's messages across all conversations.
+
+    Without a cursor this is the newest page. Pass next_cursor back as
+    before_id to load older messages, or use after_id to page forward.
+    Conditional on the user's newest message id (see get_conversation).
     """
-    messages = db.query(models.Message).join(models.Conversation).filter(
+    await flush_pending_writes(current_user.id)
+    etag = http_cache.strong_etag(
+        "history_page",
+        current_user.id,
+        await latest_message_id(db, user_id=current_user.id),
+        limit, before_id, after_id
+    )
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+    query = message_columns().join(models.Conversation).where(
         models.Conversation.user_id == current_user.id
-    ).order_by(models.Message.created_at).all()
-    
-    return [schemas.MessageResponse.from_orm(msg) for msg in messages]
+    )
+    return await get_message_page(db, query, limit, before_id, after_id)
+
+
+@router.get("/history/export")
+async def export_chat_history(
+    current_user: security.Principal = Depends(security.get_current_user)
+):
+    """
+    Download the current user's full message history as NDJSON, oldest first.
+    """
+    await flush_pending_writes(current_user.id)
+    query = message_columns().join(models.Conversation).where(
+        models.Conversation.user_id == current_user.id
+    )
+    return stream_ndjson(query, current_user.id)
+
+
+@router.get("/conversations/{conversation_id}/messages", response_model=schemas.MessagePage)
+async def get_conversation_messages(
+    conversation_id: int,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Get one page of a conversation's messages.
+
+    Same cursors as /chat/history/page, same ETags as /chat/conversations/{id}.
+    Security: Only returns messages if the conversation belongs to the current user.
+    """
+    await flush_pending_writes(current_user.id)
+    await get_owned_conversation(db, conversation_id, current_user.id)
+
+    etag = http_cache.strong_etag(
+        "conversation_page",
+        current_user.id,
+        conversation_id,
+        await latest_message_id(db, conversation_id=conversation_id),
+        limit, before_id, after_id
+    )
+    cached = http_cache.check(if_none_match, response, etag, http_cache.PRIVATE_REVALIDATE)
+    if cached is not None:
+        return cached
+
+    query = message_columns().where(models.Message.conversation_id == conversation_id)
+    return await get_message_page(db, query, limit, before_id, after_id)
+
+
+@router.get("/conversations/{conversation_id}/export")
+async def export_conversation(
+    conversation_id: int,
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Download a conversation's full transcript as NDJSON, oldest first.
+
+    Security: Only streams the conversation if it belongs to the current user.
+    """
+    await flush_pending_writes(current_user.id)
+    await get_owned_conversation(db, conversation_id, current_user.id)
 
+    query = message_columns().where(models.Message.conversation_id == conversation_id)
+    return stream_ndjson(query, current_user.id)
@@ -0,0 +1,290 @@
+"""
+WebSocket chat channel: /chat/ws
+
+One authenticated connection carries any number of turns, in any number
+of conversations at once, instead of one HTTP request (JWT decode, user
+lookup, connection setup) per message.
+
+Connect with the access token as a `token` query parameter (browsers
+can't set headers on a WebSocket) or an "Authorization: Bearer" header.
+The token is checked once, at connect; the connection is closed when it
+expires.
+
+Frames are JSON objects with a "type".
+
+Client -> server:
+- {"type": "chat", "message", "conversation_id"?, "personality_id"?, "ref"?}
+  Starts a turn (same fields as POST /chat). "ref" is any value the
+  client picks; it is echoed on every frame of that turn, so concurrent
+  turns (e.g. two new conversations) can be told apart
+- {"type": "ping"}, answered with {"type": "pong"}
+- {"type": "pong"}, the answer to a server ping (any frame counts as alive)
+
+Server -> client:
+- {"type": "ready", "user_id", "heartbeat_seconds"} once connected
+- {"type": "start", "ref", "conversation_id"}
+- {"type": "token", "ref", "text"} for each chunk of the reply
+- {"type": "done", "ref", "conversation_id", "message_id", "created_at"}
+- {"type": "error", "ref", "status"?, "detail", "retry_after"?} for a turn
+  that was refused (429/503 admission control, 404 conversation, 422 bad
+  frame) or failed; the connection stays open
+- {"type": "ping"} every WS_HEARTBEAT_SECONDS
+
+Turns take the same path as POST /chat/stream (admission control,
+conversation locks, context window, retrieval) and can be mixed freely
+with HTTP ones. The history window is still read per turn instead of
+being kept on the connection: other devices and HTTP clients write to
+the same conversations, and the read is one indexed query.
+
+Close codes: 1008 invalid or expired token, 1009 frame larger than
+WS_MAX_MESSAGE_BYTES, 1013 client too slow to read its frames (see
+ChatConnection.send), 1001 no frame from the client for 3 heartbeats.
+"""
+
+import asyncio
+import json
+import time
+from typing import Optional, Set
+
+from fastapi import APIRouter, HTTPException, WebSocket, status
+from pydantic import ValidationError
+
+from .. import metrics, schemas, security, serialization
+from ..config import settings
+from ..database import AsyncSessionLocal
+from .chat import start_streamed_turn
+
+router = APIRouter(prefix="/chat", tags=["chat"])
+
+open_connections = metrics.REGISTRY.register(metrics.Gauge(
+    "ws_connections",
+    "Open /chat/ws connections in this worker.",
+))
+server_closes = metrics.REGISTRY.register(metrics.Counter(
+    "ws_server_closes_total",
+    "/chat/ws connections refused or closed by the server "
+    "(token_invalid, token_expired, frame_too_large, slow_consumer, heartbeat_timeout).",
+    ("reason",),
+))
+turn_failures = metrics.REGISTRY.register(metrics.Counter(
+    "ws_turn_failures_total",
+    "/chat/ws turns that could not start because of an unexpected error, by exception type.",
+    ("error",),
+))
+
+# Turns still running (a reference keeps each task from being
+# garbage-collected after its connection is gone)
+_turn_tasks: Set[asyncio.Task] = set()
+
+
+def bearer_token(websocket: WebSocket) -> Optional[str]:
+    """The access token from the `token` query parameter or the Authorization header."""
+    token = websocket.query_params.get("token")
+    if token:
+        return token
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        return credentials
+    return None
+
+
+class ChatConnection:
+    """
+    One /chat/ws connection: the authenticated user, the turns in flight
+    and the frames waiting to be sent.
+
+    Three tasks run per connection: a reader (client frames, starting
+    turns), a writer (drains the outbox to the socket) and a heartbeat.
+    Each turn is a task of its own that feeds the outbox. Whichever of the
+    three ends first ends the connection; turns in flight still finish
+    and are saved.
+    """
+
+    def __init__(self, websocket: WebSocket, principal: security.Principal, expires_at: Optional[float]):
+        self.websocket = websocket
+        self.principal = principal
+        self.expires_at = expires_at
+        self.outbox: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.turns: Set[asyncio.Task] = set()
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self._client_left = False
+        self._close_requested = asyncio.Event()
+        self._close_code = status.WS_1000_NORMAL_CLOSURE
+        self._close_reason = ""
+
+    def request_close(self, code: int, reason: str) -> None:
+        """Close the connection (once the current frame is handled)."""
+        if self._close_requested.is_set():
+            return
+        self._close_code, self._close_reason = code, reason
+        server_closes.inc(reason=reason)
+        self._close_requested.set()
+
+    async def send(self, frame: dict) -> None:
+        """
+        Queue a frame for the client.
+
+        Backpressure: while the outbox is full this waits, which pauses
+        the turn producing the frames. A client that hasn't made room
+        within WS_SEND_TIMEOUT_SECONDS is disconnected rather than holding
+        its LLM slots. After the connection closes, frames are dropped.
+        """
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(self.outbox.put(frame), settings.WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            self.request_close(status.WS_1013_TRY_AGAIN_LATER, "slow_consumer")
+
+    async def run(self) -> None:
+        open_connections.inc()
+        self.outbox.put_nowait({
+            "type": "ready",
+            "user_id": self.principal.id,
+            "heartbeat_seconds": settings.WS_HEARTBEAT_SECONDS,
+        })
+        reader = asyncio.create_task(self._read())
+        writer = asyncio.create_task(self._write())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        close_requested = asyncio.create_task(self._close_requested.wait())
+        tasks = (reader, writer, heartbeat, close_requested)
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.closed = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Wake turns blocked in send(); they see `closed` from now on
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
+            open_connections.dec()
+            if not self._client_left:
+                try:
+                    await self.websocket.close(self._close_code, self._close_reason)
+                except RuntimeError:
+                    pass  # The socket is already gone
+
+    async def _read(self) -> None:
+        """Handle client frames until the client disconnects or sends one too large."""
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                self._client_left = True
+                return
+            self.last_seen = time.monotonic()
+            data = message.get("text")
+            if data is None:
+                data = (message.get("bytes") or b"").decode("utf-8", "replace")
+            if len(data.encode("utf-8")) > settings.WS_MAX_MESSAGE_BYTES:
+                self.request_close(status.WS_1009_MESSAGE_TOO_BIG, "frame_too_large")
+                return
+            await self._handle(data)
+
+    async def _write(self) -> None:
+        while True:
+            frame = await self.outbox.get()
+            await self.websocket.send_text(serialization.dumps(frame).decode("utf-8"))
+
+    async def _heartbeat(self) -> None:
+        interval = settings.WS_HEARTBEAT_SECONDS
+        while True:
+            delay = interval
+            if self.expires_at is not None:
+                delay = max(min(delay, self.expires_at - time.time()), 0)
+            await asyncio.sleep(delay)
+            if self.expires_at is not None and time.time() >= self.expires_at:
+                self.request_close(status.WS_1008_POLICY_VIOLATION, "token_expired")
+                return
+            if time.monotonic() - self.last_seen > 3 * interval:
+                self.request_close(status.WS_1001_GOING_AWAY, "heartbeat_timeout")
+                return
+            if not self.outbox.full():  # A client that far behind has frames to read already
+                self.outbox.put_nowait({"type": "ping"})
+
+    async def _handle(self, data: str) -> None:
+        try:
+            frame = json.loads(data)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict):
+            await self.send({"type": "error", "ref": None, "status": 400, "detail": "Frames must be JSON objects"})
+            return
+
+        kind = frame.get("type")
+        if kind == "chat":
+            await self._start_turn(frame)
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind != "pong":
+            await self.send({
+                "type": "error", "ref": frame.get("ref"), "status": 400, "detail": f"Unknown frame type: {kind!r}"
+            })
+
+    async def _start_turn(self, frame: dict) -> None:
+        ref = frame.get("ref")
+        if len(self.turns) >= settings.WS_MAX_ACTIVE_TURNS:
+            await self.send({
+                "type": "error", "ref": ref, "status": status.HTTP_429_TOO_MANY_REQUESTS,
+                "detail": f"At most {settings.WS_MAX_ACTIVE_TURNS} turns can run at once on one connection"
+            })
+            return
+        try:
+            request = schemas.ChatRequest.parse_obj(frame)
+        except ValidationError as e:
+            await self.send({
+                "type": "error", "ref": ref, "status": status.HTTP_422_UNPROCESSABLE_ENTITY, "detail": e.errors()
+            })
+            return
+
+        task = asyncio.create_task(self._run_turn(ref, request))
+        for tasks in (self.turns, _turn_tasks):
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def _run_turn(self, ref, request: schemas.ChatRequest) -> None:
+        metrics.bind_request_labels(self.websocket.scope)
+        try:
+            async with AsyncSessionLocal() as db:
+                conversation_id, events = await start_streamed_turn(db, request, self.principal)
+        except HTTPException as e:
+            error = {"type": "error", "ref": ref, "status": e.status_code, "detail": e.detail}
+            retry_after = (e.headers or {}).get("Retry-After")
+            if retry_after is not None:
+                error["retry_after"] = int(retry_after)
+            await self.send(error)
+            return
+        except Exception as e:
+            # The HTTP routes report these as 500s in the request metrics
+            turn_failures.inc(error=type(e).__name__)
+            await self.send({"type": "error", "ref": ref, "status": 500, "detail": "Could not start the turn"})
+            return
+
+        await self.send({"type": "start", "ref": ref, "conversation_id": conversation_id})
+        while True:
+            event, data = await events.get()
+            await self.send(dict(data, type=event, ref=ref))
+            if event != "token":
+                return
+
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    Chat over a WebSocket: authenticate once, then stream any number of
+    turns (see the module docstring for the protocol).
+    """
+    token = bearer_token(websocket)
+    try:
+        if token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        async with AsyncSessionLocal() as db:
+            principal = await security.authenticate_token(db, token)
+    except HTTPException:
+        server_closes.inc(reason="token_invalid")
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await ChatConnection(websocket, principal, security.token_expires_at(token)).run()
@@ -1,41 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 
-from .. import models, schemas, security
-from ..database import SessionLocal
+from .. import http_cache, models, schemas, security
+from ..config import settings
+from ..database import get_db, replica_router
 from ..personalities import list_personalities, get_personality
 
 # Create a router for personality-related endpoints
 router = APIRouter(prefix="/personalities", tags=["personalities"])
 
 
-# Dependency to get database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# The registry only changes with a deploy, so its hash is computed once
+PERSONALITIES_ETAG = http_cache.strong_etag("personalities", list_personalities())
 
 
 @router.get("", response_model=List[schemas.PersonalityInfo])
-def get_personalities():
+def get_personalities(
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
+):
     """
     List all available coach personalities.
     
     Returns personality information including name, tagline, and description.
     Does NOT include system prompts (those are internal).
+    
+    Cacheable: browsers reuse it for PERSONALITIES_MAX_AGE_SECONDS, then
+    revalidate with If-None-Match and get a 304 until the next deploy.
     """
+    cached = http_cache.check(
+        if_none_match,
+        response,
+        PERSONALITIES_ETAG,
+        http_cache.public_max_age(settings.PERSONALITIES_MAX_AGE_SECONDS)
+    )
+    if cached is not None:
+        return cached
     personalities = list_personalities()
     return [schemas.PersonalityInfo(**p) for p in personalities]
 
 
 @router.put("/me", response_model=schemas.User)
-def update_my_personality(
+async def update_my_personality(
     personality_update: schemas.PersonalityUpdate,
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Update the current user's selected personality.
@@ -53,8 +63,13 @@ def update_my_personality(
         )
     
     # Update user's personality
-    current_user.selected_personality = personality_update.personality
-    db.commit()
-    db.refresh(current_user)
+    # current_user is a cached snapshot, so load the row in this session
+    user = await db.get(models.User, current_user.id)
+    user.selected_personality = personality_update.personality
+    await db.commit()
+    replica_router.pin_user(user.id)
+    
+    # Cached principals still carry the old personality
+    security.principal_cache.invalidate_user(user.id)
     
-    return current_user
+    return user
@@ -42,7 +42,7 @@ class MessageResponse(BaseModel):
     Schema for a single message in the response.
     Used to return message history or individual messages.
     """
-    id: int
+    id: Optional[int]  # None while the message is still queued (write_behind.py)
     role: str  # "user" or "assistant"
     content: str
     created_at: datetime
@@ -51,6 +51,28 @@ class MessageResponse(BaseModel):
         orm_mode = True  # Allows Pydantic to read from SQLAlchemy Message objects
 
 
+class HistoryMessage(MessageResponse):
+    """
+    A message in the cross-conversation history, tagged with its conversation.
+    """
+    conversation_id: int
+
+
+class MessagePage(BaseModel):
+    """
+    Schema for one page of messages (keyset-paginated by message id).
+    
+    Fields:
+    - messages: Messages on this page, oldest first
+    - has_more: Whether there are more messages in the direction you paged
+    - next_cursor: Message id to continue from - pass it as before_id when
+                   paging backward (the default), or as after_id when paging forward
+    """
+    messages: List[HistoryMessage]
+    has_more: bool
+    next_cursor: Optional[int] = None
+
+
 class ChatResponse(BaseModel):
     """
     Schema for the API's response to a chat request.
@@ -79,6 +101,49 @@ class ConversationSummary(BaseModel):
         orm_mode = True
 
 
+class ConversationPage(BaseModel):
+    """
+    Schema for one page of the conversation list.
+    
+    Fields:
+    - items: Conversations on this page, most recently active first
+    - next_cursor: Pass as ?cursor= to get the next page (None on the last page)
+    """
+    items: List[ConversationSummary]
+    next_cursor: Optional[str] = None
+
+
+class SearchResult(BaseModel):
+    """
+    One message matching a search.
+    
+    Fields:
+    - snippet: HTML-escaped excerpt with matches wrapped in <mark>...</mark>
+    - score: Relevance, higher is better (only comparable within one search)
+    """
+    message_id: int
+    conversation_id: int
+    role: str
+    created_at: datetime
+    snippet: str
+    score: float
+
+    class Config:
+        orm_mode = True  # Built from search.SearchHit
+
+
+class SearchPage(BaseModel):
+    """
+    Schema for one page of search results, best match first.
+    
+    Fields:
+    - results: Matching messages on this page
+    - next_cursor: Pass as ?cursor= to get the next page (None on the last page)
+    """
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
+
 class ConversationDetail(BaseModel):
     """
     Schema for detailed conversation view with all messages.
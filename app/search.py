@@ -0,0 +1,142 @@
+"""
+Full-text search over a user's messages.
+
+Backed by the index from migration 0004:
+- PostgreSQL: messages.content_tsv (tsvector, GIN index), queried with
+  websearch_to_tsquery, ranked with ts_rank_cd, snippets by ts_headline
+- SQLite (local runs): the messages_fts FTS5 table, ranked with bm25(),
+  snippets by snippet()
+
+Both stem English words ("disciplined" finds "discipline") and require
+every search term to appear. Only the requesting user's conversations
+are searched.
+
+Snippets are HTML-escaped message text with the matched terms wrapped in
+<mark>...</mark>, so the frontend can render them as-is.
+"""
+
+import html
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List
+
+from fastapi import HTTPException, status
+from sqlalchemy import DateTime, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# The database marks matches with these; they're swapped for <mark> tags
+# after escaping, so message text can never inject markup
+_START, _STOP = "\x02", "\x03"
+
+# Words around the matches in a snippet
+SNIPPET_WORDS = 16
+
+# ts_headline is the expensive part, so it only runs for the page's rows
+_POSTGRES_QUERY = text(f"""
+    SELECT hit.id, hit.conversation_id, hit.role, hit.created_at, hit.score,
+           ts_headline('english', m.content, websearch_to_tsquery('english', :q),
+                       'StartSel=' || chr(2) || ', StopSel=' || chr(3) ||
+                       ', MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}, MaxFragments=2, FragmentDelimiter=" … "'
+           ) AS snippet
+    FROM (
+        SELECT m.id, m.conversation_id, m.role, m.created_at,
+               ts_rank_cd(m.content_tsv, query) AS score
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id,
+             websearch_to_tsquery('english', :q) query
+        WHERE c.user_id = :user_id AND m.content_tsv @@ query
+        ORDER BY score DESC, m.id DESC
+        LIMIT :limit OFFSET :offset
+    ) hit
+    JOIN messages m ON m.id = hit.id
+    ORDER BY hit.score DESC, hit.id DESC
+""").columns(created_at=DateTime(timezone=True))
+
+_SQLITE_QUERY = text(f"""
+    SELECT m.id, m.conversation_id, m.role, m.created_at,
+           -bm25(messages_fts) AS score,
+           snippet(messages_fts, 0, char(2), char(3), ' … ', {SNIPPET_WORDS}) AS snippet
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :q AND c.user_id = :user_id
+    ORDER BY bm25(messages_fts), m.id DESC
+    LIMIT :limit OFFSET :offset
+""").columns(created_at=DateTime(timezone=True))
+
+
+@dataclass
+class SearchHit:
+    message_id: int
+    conversation_id: int
+    role: str
+    created_at: datetime
+    score: float
+    snippet: str
+
+
+def highlight(snippet: str) -> str:
+    """Escape a database snippet and turn its match markers into <mark> tags."""
+    return html.escape(snippet or "").replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+
+def fts5_query(q: str) -> str:
+    """
+    User text as an FTS5 query: every word must match.
+
+    Each word is quoted, so FTS5 operators and punctuation in the input
+    (AND, NEAR, "*", unbalanced quotes...) can't cause syntax errors.
+    """
+    return " ".join('"' + word + '"' for word in re.findall(r"\w+", q))
+
+
+async def search_messages(
+    db: AsyncSession,
+    user_id: int,
+    q: str,
+    limit: int,
+    offset: int
+) -> List[SearchHit]:
+    """
+    One page of the user's messages matching q, best match first.
+
+    Args:
+        db: Database session
+        user_id: Whose conversations to search
+        q: Search text as the user typed it
+        limit: Page size
+        offset: Hits to skip (earlier pages)
+
+    Raises:
+        HTTPException 501: If the database has no search index (neither
+        PostgreSQL nor SQLite)
+    """
+    dialect_name = db.get_bind().dialect.name
+    params = {"user_id": user_id, "limit": limit, "offset": offset}
+    if dialect_name == "postgresql":
+        statement = _POSTGRES_QUERY
+        params["q"] = q
+    elif dialect_name == "sqlite":
+        statement = _SQLITE_QUERY
+        params["q"] = fts5_query(q)
+        if not params["q"]:
+            return []  # Nothing searchable (only punctuation)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Search is not available on this database"
+        )
+
+    rows = (await db.execute(statement, params)).all()
+    return [
+        SearchHit(
+            message_id=row.id,
+            conversation_id=row.conversation_id,
+            role=row.role,
+            created_at=row.created_at,
+            score=float(row.score),
+            snippet=highlight(row.snippet),
+        )
+        for row in rows
+    ]
@@ -1,13 +1,21 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Dict, Optional, Set, Tuple, TypeVar
 
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from . import metrics
 from .config import settings
+from .database import get_db
 
 # Configure a two-step hashing context:
 # - First apply sha256_crypt to the plaintext (pre-hash). This produces
@@ -20,10 +28,24 @@ from .config import settings
 # Use PBKDF2-SHA256 as the primary scheme. It has no 72-byte input limit
 # and doesn't require external C extensions. If you prefer bcrypt, you
 # can switch back, but you'll need to handle bcrypt's 72-byte limit.
-pwd_context = CryptContext(
-    schemes=["pbkdf2_sha256"],
-    default="pbkdf2_sha256",
-)
+def make_pwd_context(rounds: int) -> CryptContext:
+    """
+    Build the hashing context for a given PBKDF2 cost.
+    
+    min_rounds == max_rounds == rounds makes needs_update() (and so
+    verify_and_update()) flag any stored hash made with a different count,
+    whether the cost was raised or lowered.
+    """
+    return CryptContext(
+        schemes=["pbkdf2_sha256"],
+        default="pbkdf2_sha256",
+        pbkdf2_sha256__rounds=rounds,
+        pbkdf2_sha256__min_rounds=rounds,
+        pbkdf2_sha256__max_rounds=rounds,
+    )
+
+
+pwd_context = make_pwd_context(settings.PASSWORD_HASH_ROUNDS)
 
 # OAuth2PasswordBearer: This tells FastAPI where to look for the token
 # tokenUrl="token" means the client should POST to /token to get a token
@@ -40,6 +62,104 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+# ===== PASSWORD HASHING POOL =====
+
+T = TypeVar("T")
+
+password_hash_pending = metrics.REGISTRY.register(metrics.Gauge(
+    "password_hash_pending",
+    "Password hashes running or waiting for a hashing thread.",
+))
+password_hash_rejected = metrics.REGISTRY.register(metrics.Counter(
+    "password_hash_rejected_total",
+    "Password hashes refused because the hashing queue was full.",
+))
+
+
+class PasswordHashingPool:
+    """
+    Small dedicated thread pool for PBKDF2, with a cap on queued work.
+    
+    Why: PBKDF2 is deliberately slow (tens of ms of CPU per call). Run in
+    the shared request threadpool, a burst of logins (e.g. after a wave of
+    token expiries) takes every thread and chat requests queue behind it.
+    Here hashing gets its own few threads, and once `max_queue` calls are
+    already waiting, new ones are refused with a 503 + Retry-After instead
+    of piling up. hashlib releases the GIL while hashing, so threads do
+    run in parallel on multiple cores.
+    """
+    
+    def __init__(self, workers: int, max_queue: int, retry_after_seconds: int = 1):
+        self.workers = max(1, workers)
+        self.max_pending = self.workers + max(0, max_queue)
+        self.retry_after_seconds = retry_after_seconds
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+    
+    def _release(self, _future) -> None:
+        with self._lock:
+            self._pending -= 1
+        password_hash_pending.dec()
+    
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Run fn(*args) on a hashing thread.
+        
+        Raises a 503 HTTPException if the queue is full.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                password_hash_rejected.inc()
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many login attempts in progress, please retry shortly",
+                    headers={"Retry-After": str(self.retry_after_seconds)},
+                )
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+            executor = self._executor
+        password_hash_pending.inc()
+        # Released when the hash actually finishes, not when the caller gives
+        # up waiting, so a disconnected client still counts until its thread is free
+        future = executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+    
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hashing_pool = PasswordHashingPool(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_MAX_QUEUE,
+    retry_after_seconds=settings.PASSWORD_HASH_RETRY_AFTER_SECONDS,
+)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Check a password on the hashing pool.
+    
+    Returns:
+        (valid, new_hash): new_hash is set when the password is valid but the
+        stored hash was made with a different cost (PASSWORD_HASH_ROUNDS
+        changed); save it in place of the old one.
+    """
+    return await password_hashing_pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a new password on the hashing pool."""
+    return await password_hashing_pool.run(pwd_context.hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -53,57 +173,217 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+# ===== AUTHENTICATED PRINCIPAL CACHE =====
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Immutable snapshot of the authenticated user.
+    
+    This is what get_current_user returns instead of an ORM User: it is
+    safe to cache and share between requests, and it isn't tied to a
+    (closed) database session. To change the user, load the row by `id`
+    in your own session and call principal_cache.invalidate_user(id).
+    """
+    id: int
+    email: str
+    is_active: bool
+    selected_personality: str
+    
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            is_active=bool(user.is_active),
+            selected_personality=user.selected_personality,
+        )
+
+
+class PrincipalCache:
+    """
+    Thread-safe LRU of token -> Principal with a TTL.
+    
+    Saves the users lookup (and its pool checkout) on every authenticated
+    request. Entries never outlive the token's own "exp", and can be
+    dropped per user when their account changes.
+    """
+    
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[Principal, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _drop(self, token: str) -> None:
+        principal, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(principal.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[principal.id]
+    
+    def get(self, token: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] <= time.time():
+                self._drop(token)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, token: str, principal: Principal, token_expires_at: Optional[float] = None) -> None:
+        if self.maxsize <= 0 or self.ttl_seconds <= 0:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+            self._entries[token] = (principal, expires_at)
+            self._tokens_by_user.setdefault(principal.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+    
+    def invalidate_user(self, user_id: int) -> None:
+        """Forget every cached token of this user (call after changing the account)."""
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._drop(token)
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+principal_cache = PrincipalCache(
+    maxsize=settings.PRINCIPAL_CACHE_SIZE,
+    ttl_seconds=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+)
+metrics.REGISTRY.register(metrics.StatsCollector(
+    "principal_cache",
+    "Cached authenticated users, from PrincipalCache.stats()",
+    principal_cache.stats,
+))
+
+
+# ===== AUTH DEPENDENCIES =====
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def _decode_token(token: str) -> dict:
+    """
+    Decode a JWT and return its payload.
+    
+    Raises a 401 HTTPException if the token is invalid or has no subject
+    (failures show up as 401s in the request metrics, see metrics.py).
+    """
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except JWTError:
+        raise _credentials_exception()
+    if payload.get("sub") is None:  # "sub" is the subject (the user's email)
+        raise _credentials_exception()
+    return payload
+
+
+def _check_user(user, payload: dict) -> Principal:
+    """Turn the looked-up user into a Principal, or raise a 401."""
+    # "sub" must still match, in case the id was reused or the email changed
+    if user is None or user.email != payload["sub"]:
+        raise _credentials_exception()
+    return Principal.from_user(user)
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+) -> Principal:
     """
     Dependency function to get the current authenticated user from a JWT token.
     
     This function:
     1. Extracts the token from the Authorization header (handled by oauth2_scheme)
-    2. Decodes the JWT to get the user's email
-    3. Queries the database to get the full User object
+    2. Returns the cached Principal for this token, if there is one
+    3. Otherwise decodes the JWT and loads the user by id ("uid" claim;
+       tokens issued before it existed fall back to the email in "sub")
     4. Raises an HTTPException if anything fails
     
+    The lookup uses the request's own session (database.get_db), so an
+    authenticated request checks out one connection, not two.
+    
     Usage in endpoints:
-        @app.post("/protected")
-        def protected_route(current_user: User = Depends(get_current_user)):
-            # current_user is now the authenticated User object
+        @router.post("/protected")
+        async def protected_route(current_user: Principal = Depends(get_current_user)):
+            # current_user is a snapshot of the authenticated user
             return {"user_id": current_user.id}
     """
-    from . import models, crud
-    from .database import SessionLocal
+    return await authenticate_token(db, token)
+
+
+async def authenticate_token(db: AsyncSession, token: str) -> Principal:
+    """
+    The Principal for a bearer token (the body of get_current_user).
+
+    Also used directly where there is no per-request dependency, e.g.
+    once per connection by the /chat/ws socket.
+
+    Raises:
+        HTTPException 401: If the token is invalid or its user is gone
+    """
+    from . import crud, models
     
-    print(f"🔐 Token received: {token[:20] if token else 'None'}...")
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+    with metrics.span("jwt_decode"):
+        payload = _decode_token(token)
     
-    try:
-        # Decode the JWT token
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("sub")  # "sub" is the subject (user identifier)
-        print(f"✅ Token decoded successfully, email: {email}")
-        if email is None:
-            print("❌ No email in token payload")
-            raise credentials_exception
-    except JWTError as e:
-        print(f"❌ JWT decode error: {e}")
-        raise credentials_exception
-    
-    # Get a database session
-    db = SessionLocal()
-    try:
-        # Query the database for the user
-        user = crud.get_user_by_email(db, email=email)
-        if user is None:
-            print(f"❌ User not found for email: {email}")
-            raise credentials_exception
-        print(f"✅ User authenticated: {user.email}")
-        return user
-    finally:
-        db.close()
+    # Query the database for the user (primary key lookup when possible)
+    with metrics.span("user_lookup"):
+        if payload.get("uid") is not None:
+            user = await db.get(models.User, payload["uid"])
+        else:
+            user = await crud.get_user_by_email_async(db, email=payload["sub"])
+    principal = _check_user(user, payload)
+    
+    principal_cache.set(token, principal, payload.get("exp"))
+    return principal
 
+
+def token_expires_at(token: str) -> Optional[float]:
+    """
+    Unix time a token stops being valid (its "exp" claim), or None.
+
+    Doesn't verify the token: only call it on one authenticate_token accepted.
+    """
+    try:
+        exp = jwt.get_unverified_claims(token).get("exp")
+    except JWTError:
+        return None
+    return float(exp) if exp is not None else None
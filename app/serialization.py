@@ -0,0 +1,58 @@
+"""
+Fast JSON responses for large read endpoints.
+
+Returning pydantic models from an endpoint costs two validations per
+message (from_orm, then FastAPI's response_model check) plus
+jsonable_encoder walking every field. For transcripts with thousands of
+messages that is most of the request's CPU time. Endpoints on the fast
+path instead build plain dicts from column tuples and return
+json_response(...) directly, which FastAPI passes through untouched.
+
+Uses orjson when it is installed (optional: pip install orjson), else the
+standard json module. Both produce the same JSON as FastAPI's default
+encoding (datetimes as ISO 8601), so clients can't tell the paths apart.
+"""
+
+import json
+from datetime import date, datetime
+from typing import Any, Mapping, Optional
+
+from fastapi import Response
+
+try:
+    import orjson  # Optional dependency
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode content (dicts, lists, str, numbers, datetimes) as compact JSON bytes."""
+    if orjson is not None:
+        # OPT_NON_STR_KEYS: match json.dumps, which accepts int keys
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def json_response(content: Any, headers: Optional[Mapping[str, str]] = None) -> FastJSONResponse:
+    """
+    JSON response to return as-is from an endpoint.
+
+    Args:
+        content: Already-shaped response data (no pydantic models)
+        headers: Extra headers, e.g. the endpoint's Response parameter's
+                 headers (FastAPI doesn't merge those into a returned Response)
+    """
+    return FastJSONResponse(content, headers=dict(headers) if headers else None)
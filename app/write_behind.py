@@ -0,0 +1,328 @@
+"""
+Write-behind persistence for assistant messages (opt-in).
+
+Normally the assistant's reply is INSERTed and committed before /chat
+returns, so at peak the database's commit latency is added to every
+chat response. With WRITE_BEHIND_ENABLED:
+
+- The reply goes into an in-process bounded queue and the request returns
+- A background task drains the queue every WRITE_BEHIND_FLUSH_INTERVAL_MS
+  (or as soon as WRITE_BEHIND_BATCH_SIZE messages are waiting) with one
+  multi-row INSERT, one counter UPDATE per conversation and one commit
+- Until a message is committed, readers of its conversation see it
+  through an overlay (pending_for_conversation / pending_for_user)
+- The queue is flushed on shutdown (see main.lifespan)
+
+Timestamps come from the database, like those of messages written on
+the request path: a queued reply's created_at is provisional (the app
+server's clock) until its flush, which replaces it with the stored value.
+Clocks that disagree can't sort a reply before its prompt.
+
+A failing flush is retried with backoff. Once a message has been in
+WRITE_BEHIND_MAX_ATTEMPTS failed flushes, its batch is written row by row
+and rows that still fail are dropped (and counted), so one bad row can't
+hold up every message queued after it.
+
+Trade-off: a crash (not a clean shutdown) loses replies still in the
+queue, at most about one flush interval's worth.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from sqlalchemy import bindparam, func, insert
+
+from . import metrics, models
+from .config import settings
+from .database import AsyncSessionLocal
+
+queue_depth = metrics.REGISTRY.register(metrics.Gauge(
+    "write_behind_queue_depth",
+    "Messages waiting to be written by the write-behind queue.",
+))
+flush_batch_size = metrics.REGISTRY.register(metrics.Histogram(
+    "write_behind_flush_batch_size",
+    "Messages written per write-behind flush.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+))
+dropped_messages = metrics.REGISTRY.register(metrics.Counter(
+    "write_behind_dropped_total",
+    "Messages dropped after WRITE_BEHIND_MAX_ATTEMPTS failed flushes.",
+))
+
+# Longest pause between flush attempts while the database keeps failing
+MAX_RETRY_DELAY_SECONDS = 5.0
+
+
+@dataclass
+class PendingMessage:
+    """
+    A message accepted but maybe not yet committed.
+
+    Has the same fields as a Message row, so it can stand in for one in
+    responses. `id` is None until the flush that writes it, which also
+    replaces `created_at` with the database's timestamp.
+
+    `on_settled` callbacks run once the message is stored (id set) or
+    dropped (id still None).
+    """
+    conversation_id: int
+    user_id: int
+    role: str
+    content: str
+    created_at: datetime
+    id: Optional[int] = None
+    attempts: int = 0  # Failed flushes so far
+    on_settled: List[Callable[["PendingMessage"], None]] = field(default_factory=list, repr=False)
+
+    def settle(self) -> None:
+        for callback in self.on_settled:
+            callback(self)
+        self.on_settled = []
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of messages, drained in batches by one task.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval_seconds: float, max_attempts: int = 10):
+        self.max_size = max_size
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_attempts = max(1, max_attempts)
+        # Queued, then in flight: both stay visible to readers until committed
+        self._queued: List[PendingMessage] = []
+        self._in_flight: List[PendingMessage] = []
+        # Created on first use, inside the running event loop
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _primitives(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+        return self._flush_lock, self._wakeup
+
+    def __len__(self) -> int:
+        return len(self._queued) + len(self._in_flight)
+
+    async def put(
+        self,
+        conversation_id: int,
+        user_id: int,
+        role: str,
+        content: str
+    ) -> PendingMessage:
+        """
+        Queue a message and return it (with a provisional created_at, id
+        still None).
+
+        If the queue is full, flushes inline first: the caller waits for
+        the database rather than the queue growing without bound.
+        """
+        if len(self) >= self.max_size:
+            await self.flush()
+        message = PendingMessage(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            role=role,
+            content=content,
+            created_at=datetime.now(timezone.utc),
+        )
+        self._queued.append(message)
+        queue_depth.inc()
+        if len(self._queued) >= self.batch_size:
+            self._primitives()[1].set()
+        return message
+
+    # ----- Overlay for readers -----
+
+    def _pending(self) -> List[PendingMessage]:
+        return self._in_flight + self._queued
+
+    def has_pending(self, conversation_id: int) -> bool:
+        return any(m.conversation_id == conversation_id for m in self._pending())
+
+    def has_pending_for_user(self, user_id: int) -> bool:
+        return any(m.user_id == user_id for m in self._pending())
+
+    def pending_for_conversation(self, conversation_id: int) -> List[PendingMessage]:
+        """
+        Uncommitted messages of a conversation, oldest first.
+
+        Take this snapshot *before* querying the database, then drop any
+        entry whose id shows up in the query result (see overlay()).
+        """
+        return [m for m in self._pending() if m.conversation_id == conversation_id]
+
+    def pending_for_user(self, user_id: int) -> List[PendingMessage]:
+        return [m for m in self._pending() if m.user_id == user_id]
+
+    # ----- Draining -----
+
+    async def flush(self) -> int:
+        """
+        Write everything queued so far. Returns the number of messages written.
+
+        On a database error the batch goes back to the front of the queue
+        (so order is kept) and the error is raised. A batch holding a
+        message that has already failed max_attempts times is written row
+        by row instead (see _write_each).
+        """
+        flush_lock, _ = self._primitives()
+        async with flush_lock:
+            if not self._queued:
+                return 0
+            self._in_flight, self._queued = self._queued, []
+            batch = self._in_flight
+            if any(m.attempts >= self.max_attempts for m in batch):
+                retry = await self._write_each(batch)
+                self._queued = retry + self._queued
+                self._in_flight = []
+                queue_depth.dec(len(batch) - len(retry))
+                written = sum(1 for m in batch if m.id is not None)
+                flush_batch_size.observe(written)
+                return written
+            try:
+                await self._write(batch)
+            except Exception:
+                for message in batch:
+                    message.id = None  # Rolled back
+                    message.attempts += 1
+                self._queued = batch + self._queued
+                self._in_flight = []
+                raise
+            self._in_flight = []
+            queue_depth.dec(len(batch))
+            flush_batch_size.observe(len(batch))
+            return len(batch)
+
+    async def _write_each(self, batch: List[PendingMessage]) -> List[PendingMessage]:
+        """
+        Write a batch that keeps failing one message at a time. Messages out
+        of attempts that fail again are dropped; the others that fail are
+        returned, to be retried.
+        """
+        retry = []
+        for message in batch:
+            try:
+                await self._write([message])
+            except Exception as e:
+                message.id = None
+                message.attempts += 1
+                if message.attempts <= self.max_attempts:
+                    retry.append(message)
+                    continue
+                dropped_messages.inc()
+                message.settle()
+                print(
+                    f"❌ Write-behind dropped a message for conversation {message.conversation_id} "
+                    f"after {message.attempts} failed attempts: {e}"
+                )
+        return retry
+
+    async def _write(self, batch: List[PendingMessage]) -> None:
+        async with AsyncSessionLocal() as db:
+            # One multi-row INSERT for the whole batch; RETURNING in
+            # parameter order hands each message its id and created_at
+            # (the column's server default, now())
+            rows = (await db.execute(
+                insert(models.Message).returning(
+                    models.Message.id, models.Message.created_at, sort_by_parameter_order=True
+                ),
+                [
+                    {"conversation_id": m.conversation_id, "role": m.role, "content": m.content}
+                    for m in batch
+                ]
+            )).all()
+
+            # Keep the denormalized counters in step (see crud.append_message):
+            # one executemany UPDATE, one parameter set per conversation
+            per_conversation = {}
+            for m in batch:
+                per_conversation[m.conversation_id] = per_conversation.get(m.conversation_id, 0) + 1
+            conversations = models.Conversation.__table__
+            await db.execute(
+                conversations.update()
+                .where(conversations.c.id == bindparam("conversation_id"))
+                .values(
+                    message_count=conversations.c.message_count + bindparam("added"),
+                    last_message_at=func.now(),
+                    updated_at=func.now(),
+                ),
+                [
+                    {"conversation_id": cid, "added": count}
+                    for cid, count in per_conversation.items()
+                ]
+            )
+            await db.commit()
+            for message, (message_id, created_at) in zip(batch, rows):
+                message.id = message_id
+                message.created_at = created_at
+                message.settle()
+
+    async def _run(self) -> None:
+        _, wakeup = self._primitives()
+        failures = 0
+        while True:
+            if failures:
+                # Back off while the database keeps failing
+                await asyncio.sleep(min(self.flush_interval_seconds * 2 ** failures, MAX_RETRY_DELAY_SECONDS))
+            else:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=self.flush_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            wakeup.clear()
+            try:
+                await self.flush()
+                failures = 0
+            except Exception as e:
+                # Keep the messages and try again
+                failures += 1
+                print(f"⚠️ Write-behind flush failed, {len(self)} messages pending: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task and write whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"❌ Write-behind final flush failed, {len(self)} messages lost: {e}")
+
+
+def overlay(rows: list, pending: List[PendingMessage]) -> list:
+    """
+    Append pending messages to rows read from the database.
+
+    `pending` must be snapshotted before the query ran. A message committed
+    in between is both in `rows` and in `pending` (now with its id), so it
+    is only added once.
+    """
+    seen = {row.id for row in rows}
+    return list(rows) + [m for m in pending if m.id is None or m.id not in seen]
+
+
+# Created only when write-behind is enabled (None = write on the request path)
+message_queue: Optional[WriteBehindQueue] = None
+if settings.WRITE_BEHIND_ENABLED:
+    message_queue = WriteBehindQueue(
+        max_size=settings.WRITE_BEHIND_QUEUE_SIZE,
+        batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+        flush_interval_seconds=settings.WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000,
+        max_attempts=settings.WRITE_BEHIND_MAX_ATTEMPTS,
+    )
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Mindset Coach API.
+
+Run each module from the project root, e.g.:
+    python -m benchmarks.bench_model_pool
+"""
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark: per-call model setup with and without the Gemini ModelPool.
+
+Measures only the client-side work done before a request goes to Gemini
+(building the GenerativeModel and starting a chat). No network calls.
+
+Usage:
+    python -m benchmarks.bench_model_pool [--iterations 5000] [--personality sophia]
+"""
+
+import argparse
+import time
+
+import google.generativeai as genai
+
+from app.config import settings
+from app.llm_backends import ModelPool
+from app.personalities import get_personality
+
+# A short history so start_chat does realistic work
+HISTORY = [
+    {"role": "user", "parts": ["I keep putting off my workout plan."]},
+    {"role": "model", "parts": ["okay but what are you avoiding by waiting?"]},
+]
+
+
+def per_call_uncached(personality_name: str) -> None:
+    # What generate_response did before the pool existed
+    system_prompt = get_personality(personality_name)["system_prompt"]
+    model = genai.GenerativeModel(
+        model_name=settings.GEMINI_MODEL,
+        system_instruction=system_prompt
+    )
+    model.start_chat(history=HISTORY)
+
+
+model_pool = ModelPool(maxsize=settings.MODEL_POOL_SIZE)
+
+
+def per_call_pooled(personality_name: str) -> None:
+    model = model_pool.get(personality_name)
+    model.start_chat(history=HISTORY)
+
+
+def bench(fn, personality_name: str, iterations: int) -> float:
+    """Return mean microseconds per call."""
+    fn(personality_name)  # warm-up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(personality_name)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--personality", default="sophia")
+    args = parser.parse_args()
+
+    uncached = bench(per_call_uncached, args.personality, args.iterations)
+    pooled = bench(per_call_pooled, args.personality, args.iterations)
+
+    print(f"iterations:        {args.iterations}")
+    print(f"without pool:      {uncached:8.1f} us/call")
+    print(f"with ModelPool:    {pooled:8.1f} us/call")
+    print(f"saved per call:    {uncached - pooled:8.1f} us ({uncached / pooled:.2f}x)")
+    print(f"pool stats:        {model_pool.stats()}")
+
+
+if __name__ == "__main__":
+    main()
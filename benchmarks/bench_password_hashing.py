@@ -0,0 +1,69 @@
+"""
+Benchmark: logins per second (password verifications) through the hashing pool.
+
+Runs PBKDF2 verifications through security.PasswordHashingPool at a fixed
+concurrency and reports throughput overall and per core used, so the
+PASSWORD_HASH_ROUNDS / PASSWORD_HASH_WORKERS trade-off can be sized
+against expected login bursts. No database or HTTP involved.
+
+Usage:
+    python -m benchmarks.bench_password_hashing [--rounds 29000] [--workers 2] [--seconds 5]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from app.config import settings
+from app.security import PasswordHashingPool, make_pwd_context
+
+
+async def run(pool: PasswordHashingPool, verify, hashed: str, concurrency: int, seconds: float) -> int:
+    """Keep `concurrency` verifications in flight for `seconds`; return how many finished."""
+    deadline = time.perf_counter() + seconds
+    done = 0
+
+    async def client():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            valid, _ = await pool.run(verify, "correct horse battery staple", hashed)
+            assert valid
+            done += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=settings.PASSWORD_HASH_ROUNDS)
+    parser.add_argument("--workers", type=int, default=settings.PASSWORD_HASH_WORKERS)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    context = make_pwd_context(args.rounds)
+    hashed = context.hash("correct horse battery staple")
+
+    # Single call latency, for reference
+    start = time.perf_counter()
+    context.verify("correct horse battery staple", hashed)
+    single_ms = (time.perf_counter() - start) * 1000
+
+    # Two callers per worker keeps every hashing thread busy without
+    # hitting the queue limit
+    pool = PasswordHashingPool(workers=args.workers, max_queue=args.workers)
+    completed = asyncio.run(run(pool, context.verify_and_update, hashed, args.workers * 2, args.seconds))
+    pool.shutdown()
+
+    cores = min(args.workers, os.cpu_count() or 1)
+    per_second = completed / args.seconds
+    print(f"rounds:            {args.rounds}")
+    print(f"workers:           {args.workers} (cores used: {cores})")
+    print(f"single verify:     {single_ms:8.1f} ms")
+    print(f"logins/sec:        {per_second:8.1f}")
+    print(f"logins/sec/core:   {per_second / cores:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark: cross-conversation retrieval (retrieval.py) at growing history sizes.
+
+For a synthetic user with 1k / 10k / 50k messages (Zipf-distributed words,
+spread over conversations of 40 messages) reports:
+- build: time to index every message, as on the user's first turn
+- add:   time to index one more message, as after every saved message
+- recall p50 / p95: time to score a query and pick the top snippets,
+  as on every turn
+
+No database: rows are generated in memory and handed to build_index.
+
+Usage:
+    python -m benchmarks.bench_retrieval [--sizes 1000,10000,50000] [--queries 500]
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import List
+
+from app.config import settings
+from app.retrieval import build_index, format_snippets
+
+VOCABULARY_SIZE = 5000
+MESSAGE_WORDS = (8, 60)
+CONVERSATION_LENGTH = 40
+
+FILLER = "so i think that it was just really hard to keep going with the plan and".split()
+
+
+def make_vocabulary(rng: random.Random) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(VOCABULARY_SIZE)]
+
+
+def make_text(rng: random.Random, vocabulary: List[str], weights: List[float]) -> str:
+    length = rng.randint(*MESSAGE_WORDS)
+    words = rng.choices(vocabulary, weights=weights, k=length // 2) + rng.choices(FILLER, k=length - length // 2)
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run(size: int, queries: int, rng: random.Random, vocabulary: List[str], weights: List[float]) -> None:
+    rows = [
+        (i, i // CONVERSATION_LENGTH, "user" if i % 2 == 0 else "assistant", make_text(rng, vocabulary, weights))
+        for i in range(size)
+    ]
+
+    start = time.perf_counter()
+    index = build_index(rows)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    adds = []
+    for i in range(size, size + 200):
+        text = make_text(rng, vocabulary, weights)
+        start = time.perf_counter()
+        index.add(i, i // CONVERSATION_LENGTH, "user", text)
+        adds.append((time.perf_counter() - start) * 1000)
+
+    current_conversation = (size + 200) // CONVERSATION_LENGTH
+    recalls = []
+    for _ in range(queries):
+        query = make_text(rng, vocabulary, weights)
+        start = time.perf_counter()
+        hits = index.search(
+            query, settings.RETRIEVAL_TOP_K,
+            exclude_conversation_id=current_conversation,
+            min_score=settings.RETRIEVAL_MIN_SCORE,
+        )
+        format_snippets(hits, settings.RETRIEVAL_TOKEN_BUDGET, settings.RETRIEVAL_SNIPPET_MAX_TOKENS)
+        recalls.append((time.perf_counter() - start) * 1000)
+
+    print(
+        f"{size:>10} {build_ms:>10.0f} {statistics.median(adds):>9.3f} "
+        f"{statistics.median(recalls):>11.2f} {percentile(recalls, 0.95):>11.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng)
+    weights = [1 / rank for rank in range(1, VOCABULARY_SIZE + 1)]  # Zipf
+
+    print(f"{'messages':>10} {'build ms':>10} {'add ms':>9} {'recall p50':>11} {'recall p95':>11}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        run(size, args.queries, rng, vocabulary, weights)
+
+
+if __name__ == "__main__":
+    main()
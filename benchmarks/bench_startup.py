@@ -0,0 +1,106 @@
+"""
+Benchmark: cold-start cost of the API process.
+
+Reports, as medians over several fresh processes:
+- import time of app.main (python -c "import app.main")
+- time from spawning uvicorn to the first 200 from GET /
+- time from spawning uvicorn to the first 200 from GET /health/ready
+
+Runs against whatever DATABASE_URL / LLM_BACKEND the environment sets
+(migrate the database first: python -m app.migrate). Each uvicorn
+process gets a fresh port and is killed after the measurement.
+
+Usage:
+    python -m benchmarks.bench_startup [--runs 5] [--timeout 60]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_seconds() -> float:
+    """Import app.main in a fresh interpreter and return how long it took."""
+    code = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def status_of(url: str) -> Optional[int]:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None  # Not listening yet
+
+
+def boot_seconds(timeout: float):
+    """Start uvicorn; return seconds until / and /health/ready first answer 200."""
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_ROOT,
+        stdout=subprocess.DEVNULL,
+    )
+    first_200 = ready = None
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+            if first_200 is None and status_of(base + "/") == 200:
+                first_200 = time.perf_counter() - started
+            if first_200 is not None and status_of(base + "/health/ready") == 200:
+                ready = time.perf_counter() - started
+                break
+            time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+    if ready is None:
+        raise RuntimeError(f"not ready within {timeout:g}s (is the database migrated?)")
+    return first_200, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    imports = [import_seconds() for _ in range(args.runs)]
+    boots = [boot_seconds(args.timeout) for _ in range(args.runs)]
+
+    def ms(values):
+        return statistics.median(values) * 1000
+
+    print(f"backend:               {os.environ.get('LLM_BACKEND', 'gemini (default)')}")
+    print(f"runs:                  {args.runs}")
+    print(f"import app.main:       {ms(imports):8.1f} ms")
+    print(f"spawn -> first 200 /:  {ms([b[0] for b in boots]):8.1f} ms")
+    print(f"spawn -> ready:        {ms([b[1] for b in boots]):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
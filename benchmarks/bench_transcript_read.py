@@ -0,0 +1,112 @@
+"""
+Benchmark: reading a whole transcript, ORM + pydantic path vs the fast path.
+
+For a conversation of 100 / 1k / 10k messages (in a throwaway SQLite file)
+times what GET /chat/conversations/{id} does to produce its JSON body:
+- orm:  select Message objects, MessageResponse.from_orm each, then what
+        FastAPI does with the result (response_model validation,
+        jsonable_encoder, json.dumps) - the endpoint before the fast path
+- fast: select the four columns as rows, build dicts, encode with
+        serialization.dumps (orjson if installed) - the endpoint now
+
+Usage:
+    python -m benchmarks.bench_transcript_read [--sizes 100,1000,10000] [--repeat 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app import models, schemas, serialization
+from app.routers.chat import transcript_columns, transcript_rows
+
+
+async def seed(engine, conversation_id: int, size: int) -> None:
+    """One user, one conversation of `size` alternating messages."""
+    start = datetime(2026, 1, 1)
+    async with engine.begin() as conn:
+        await conn.execute(insert(models.Conversation).values(
+            id=conversation_id, user_id=1, created_at=start, last_message_at=start, message_count=size
+        ))
+        await conn.execute(insert(models.Message), [
+            {
+                "conversation_id": conversation_id,
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": f"message {i}: " + "okay so real talk what are you avoiding here " * 4,
+                "created_at": start + timedelta(seconds=i),
+            }
+            for i in range(size)
+        ])
+
+
+async def orm_path(db: AsyncSession, conversation_id: int) -> bytes:
+    result = await db.execute(
+        select(models.Message).where(
+            models.Message.conversation_id == conversation_id
+        ).order_by(models.Message.created_at, models.Message.id)
+    )
+    messages = [schemas.MessageResponse.from_orm(msg) for msg in result.scalars().all()]
+    # FastAPI: validate against response_model, encode, render
+    validated = parse_obj_as(List[schemas.MessageResponse], messages)
+    return json.dumps(jsonable_encoder(validated)).encode("utf-8")
+
+
+async def fast_path(db: AsyncSession, conversation_id: int) -> bytes:
+    rows = (await db.execute(
+        transcript_columns().where(
+            models.Message.conversation_id == conversation_id
+        ).order_by(models.Message.created_at, models.Message.id)
+    )).all()
+    return serialization.dumps(transcript_rows(rows, []))
+
+
+async def time_path(engine, path, conversation_id: int, repeat: int) -> float:
+    """Median milliseconds per call, each in a fresh session (as per request)."""
+    timings = []
+    for _ in range(repeat + 1):
+        async with AsyncSession(engine, expire_on_commit=False) as db:
+            start = time.perf_counter()
+            await path(db, conversation_id)
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings[1:])  # First call warms caches
+
+
+async def run(sizes: List[int], repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+            await conn.execute(insert(models.User).values(id=1, email="bench@example.com", hashed_password="x"))
+
+        encoder = "orjson" if serialization.orjson is not None else "json"
+        print(f"fast path encoder: {encoder}")
+        print(f"{'messages':>10} {'orm ms':>10} {'fast ms':>10} {'speedup':>8}")
+        for conversation_id, size in enumerate(sizes, start=1):
+            await seed(engine, conversation_id, size)
+            orm_ms = await time_path(engine, orm_path, conversation_id, repeat)
+            fast_ms = await time_path(engine, fast_path, conversation_id, repeat)
+            print(f"{size:>10} {orm_ms:>10.2f} {fast_ms:>10.2f} {orm_ms / fast_ms:>7.1f}x")
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run([int(size) for size in args.sizes.split(",")], args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Load test: the whole API under a realistic mix of requests.
+
+Starts uvicorn on a throwaway SQLite database with the fake LLM backend
+(simulated latency, no Gemini key needed), then for each concurrency level
+runs that many virtual users for --seconds. Each virtual user signs up,
+logs in, then loops over a weighted mix of:
+- POST /chat (a new conversation or a follow-up in one of its own)
+- GET /chat/conversations, /chat/conversations/{id} and /chat/history
+- POST /token (logging in again)
+
+Reports throughput and p50/p95/p99 latency per endpoint, and writes them
+as JSON (default: benchmarks/results/). With --baseline, compares against
+an earlier result file and exits with status 1 if p95 latency or
+throughput got worse by more than --tolerance.
+
+Needs httpx (a dev dependency: pipenv install --dev).
+
+Usage:
+    python -m benchmarks.load_test [--concurrency 1,10,50] [--seconds 30] [--llm-latency-ms 800]
+    python -m benchmarks.load_test --env WRITE_BEHIND_ENABLED=true --output after.json --baseline before.json
+    python -m benchmarks.load_test --url http://127.0.0.1:8000  # an already running server
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from .bench_startup import PROJECT_ROOT, free_port, status_of
+
+# Weighted mix of what a signed-in user does (weights, not percentages)
+MIX = {
+    "chat": 30,
+    "list": 25,
+    "detail": 20,
+    "history": 15,
+    "login": 10,
+}
+
+# Share of chat turns that continue one of the user's conversations
+FOLLOW_UP_SHARE = 0.7
+
+MESSAGES = [
+    "I keep putting off my workouts, how do I actually start?",
+    "I skipped the gym again today and I feel bad about it",
+    "How do I stop procrastinating on my thesis?",
+    "I want to wake up at 6am but I always snooze",
+    "Okay, I did it this morning. What next?",
+    "Honestly I'm just tired of trying",
+    "I made a plan for the week, can you check it?",
+]
+
+PASSWORD = "load-test-password"
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list (0 for an empty one)."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class Recorder:
+    """Latency and errors per endpoint for one concurrency level."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        """Send a request, timing it under `endpoint`. None if it never got a response."""
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.errors[endpoint][type(e).__name__] += 1
+            return None
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[endpoint][str(response.status_code)] += 1
+        return response
+
+    def summary(self, elapsed: float) -> dict:
+        endpoints = {}
+        all_latencies = []
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[endpoint])
+            all_latencies.extend(latencies)
+            endpoints[endpoint] = self._stats(latencies, self.errors[endpoint], elapsed)
+        total_errors = sum((errors for errors in self.errors.values()), Counter())
+        return {
+            "seconds": round(elapsed, 3),
+            "endpoints": endpoints,
+            "total": self._stats(sorted(all_latencies), total_errors, elapsed),
+        }
+
+    @staticmethod
+    def _stats(latencies: List[float], errors: Counter, elapsed: float) -> dict:
+        # Requests that never got a response count as errors but have no latency
+        failed = sum(count for reason, count in errors.items() if not reason.isdigit())
+        return {
+            "requests": len(latencies) + failed,
+            "errors": sum(errors.values()),
+            "error_reasons": dict(errors),
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+
+
+async def virtual_user(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    email: str,
+    deadline: float,
+    think_seconds: float,
+    rng: random.Random
+) -> None:
+    """Sign up, log in, then run the request mix until the deadline."""
+    await recorder.request(client, "POST /users/", "POST", "/users/", json={"email": email, "password": PASSWORD})
+
+    async def login() -> Optional[dict]:
+        response = await recorder.request(
+            client, "POST /token", "POST", "/token", data={"username": email, "password": PASSWORD}
+        )
+        if response is None or response.status_code != 200:
+            return None
+        return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    headers = await login()
+    if headers is None:
+        return
+    actions, weights = list(MIX), list(MIX.values())
+    conversations: List[int] = []
+
+    while time.perf_counter() < deadline:
+        action = rng.choices(actions, weights)[0]
+        if action in ("detail", "chat") and not conversations:
+            action = "chat"  # Nothing to read or follow up on yet
+            conversation_id = None
+        elif action == "chat" and rng.random() >= FOLLOW_UP_SHARE:
+            conversation_id = None
+        else:
+            conversation_id = rng.choice(conversations) if conversations else None
+
+        if action == "chat":
+            response = await recorder.request(
+                client, "POST /chat", "POST", "/chat", headers=headers,
+                json={"message": rng.choice(MESSAGES), "conversation_id": conversation_id}
+            )
+            if response is not None and response.status_code == 200 and conversation_id is None:
+                conversations.append(response.json()["conversation_id"])
+        elif action == "list":
+            await recorder.request(client, "GET /chat/conversations", "GET", "/chat/conversations", headers=headers)
+        elif action == "detail":
+            await recorder.request(
+                client, "GET /chat/conversations/{id}", "GET", f"/chat/conversations/{conversation_id}", headers=headers
+            )
+        elif action == "history":
+            await recorder.request(client, "GET /chat/history", "GET", "/chat/history", headers=headers)
+        else:
+            headers = await login() or headers
+
+        if think_seconds:
+            await asyncio.sleep(rng.expovariate(1 / think_seconds))
+
+
+async def run_level(url: str, concurrency: int, seconds: float, think_seconds: float, seed: int) -> dict:
+    """Run `concurrency` virtual users for `seconds`; return the level's summary."""
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]  # Fresh accounts for every level (and every run against --url)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + seconds
+        await asyncio.gather(*(
+            virtual_user(
+                client, recorder, f"load-{run_id}-{number}@example.com", deadline, think_seconds,
+                random.Random(seed + number)
+            )
+            for number in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+    return {"concurrency": concurrency, **recorder.summary(elapsed)}
+
+
+def start_server(llm_latency_ms: float, workers: int, overrides: Dict[str, str], database_dir: str):
+    """Start uvicorn on a fresh SQLite database; return (process, base URL) once it is ready."""
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(database_dir, 'load_test.db')}",
+        LLM_BACKEND="fake",
+        FAKE_LLM_LATENCY_MEAN_MS=str(llm_latency_ms),
+        MIGRATE_ON_STARTUP="true",
+        # Measure the server, not the per-user limit on how fast one person chats
+        USER_RATE_LIMIT_PER_MINUTE="0",
+    )
+    env.update(overrides)
+    if workers > 1:
+        # Several processes would race to migrate the same file
+        subprocess.run([sys.executable, "-m", "app.migrate"], cwd=PROJECT_ROOT, env=env, check=True)
+        env["MIGRATE_ON_STARTUP"] = "false"
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning",
+        ],
+        cwd=PROJECT_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    while status_of(url + "/health/ready") != 200:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+        if time.perf_counter() - started > 60:
+            server.terminate()
+            raise RuntimeError("server not ready within 60s")
+        time.sleep(0.05)
+    return server, url
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def print_level(level: dict) -> None:
+    print(f"\nconcurrency {level['concurrency']} ({level['seconds']:.1f}s)")
+    print(f"{'endpoint':<30} {'requests':>8} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(level["endpoints"].items()) + [("total", level["total"])]
+    for endpoint, stats in rows:
+        print(
+            f"{endpoint:<30} {stats['requests']:>8} {stats['errors']:>6} {stats['rps']:>8.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}"
+        )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of this run against a baseline run, as readable lines."""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in result["levels"]:
+        before_level = baseline_levels.get(level["concurrency"])
+        if before_level is None:
+            continue
+        for endpoint, stats in list(level["endpoints"].items()) + [("total", level["total"])]:
+            before = before_level["endpoints"].get(endpoint) if endpoint != "total" else before_level["total"]
+            if not before or not before["requests"]:
+                continue
+            where = f"concurrency {level['concurrency']}, {endpoint}"
+            if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{where}: p95 {before['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms")
+            if endpoint == "total" and stats["rps"] < before["rps"] * (1 - tolerance):
+                regressions.append(f"{where}: throughput {before['rps']:.1f} -> {stats['rps']:.1f} rps")
+            before_error_rate = before["errors"] / before["requests"]
+            error_rate = stats["errors"] / stats["requests"] if stats["requests"] else 0.0
+            if error_rate > before_error_rate + 0.01:
+                regressions.append(f"{where}: errors {before_error_rate:.1%} -> {error_rate:.1%}")
+    return regressions
+
+
+async def run(args, url: str) -> dict:
+    levels = []
+    for concurrency in args.concurrency:
+        level = await run_level(url, concurrency, args.seconds, args.think_ms / 1000, args.seed)
+        print_level(level)
+        levels.append(level)
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "settings": {
+            "url": args.url,
+            "seconds": args.seconds,
+            "think_ms": args.think_ms,
+            "llm_latency_ms": None if args.url else args.llm_latency_ms,
+            "workers": None if args.url else args.workers,
+            "env": args.env,
+            "mix": MIX,
+        },
+        "levels": levels,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", default="1,10,50", type=lambda value: [int(n) for n in value.split(",")])
+    parser.add_argument("--seconds", type=float, default=30.0, help="Duration of each concurrency level")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Mean pause between a user's requests")
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0, help="Fake LLM time to first token")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Server setting override (repeatable)")
+    parser.add_argument("--url", help="Test this running server instead of starting one")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/load_test_<time>.json)")
+    parser.add_argument("--baseline", help="Earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as database_dir:
+        server = None
+        url = args.url
+        if url is None:
+            overrides = dict(item.split("=", 1) for item in args.env)
+            overrides.setdefault("FAKE_LLM_SEED", str(args.seed))
+            server, url = start_server(args.llm_latency_ms, args.workers, overrides, database_dir)
+        try:
+            result = asyncio.run(run(args, url))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    output = Path(args.output) if args.output else (
+        PROJECT_ROOT / "benchmarks" / "results" / f"load_test_{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2) + "\n")
+    print(f"\nresults written to {output}")
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
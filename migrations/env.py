@@ -0,0 +1,72 @@
+"""
+Alembic environment.
+
+Uses the app's own engine settings (DATABASE_URL, see app/database.py) and
+models metadata, so `alembic revision --autogenerate` compares against
+app/models.py.
+"""
+
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from app import models
+from app.database import SQLALCHEMY_DATABASE_URL
+
+config = context.config
+
+# Only configure logging when run from the alembic CLI (not from app.migrate,
+# which shouldn't reset the app's loggers)
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+# Database objects that exist on purpose but aren't in app/models.py
+# (the full-text search index from migration 0004)
+UNMODELED_OBJECTS = {"content_tsv", "ix_messages_content_tsv"}
+
+
+def include_object(obj, name, type_, reflected, compare_to) -> bool:
+    """Keep autogenerate from proposing to drop the search index."""
+    if reflected and compare_to is None:
+        if name in UNMODELED_OBJECTS or (name or "").startswith("messages_fts"):
+            return False
+    return True
+
+
+def run_migrations_offline() -> None:
+    """Emit SQL to stdout instead of running it (alembic upgrade --sql)."""
+    context.configure(
+        url=SQLALCHEMY_DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
+        render_as_batch=SQLALCHEMY_DATABASE_URL.startswith("sqlite"),
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    """Run migrations against the database."""
+    connectable = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=pool.NullPool)
+
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            # SQLite can't ALTER most things in place; batch mode rebuilds tables
+            render_as_batch=connection.dialect.name == "sqlite",
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
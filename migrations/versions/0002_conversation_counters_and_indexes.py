@@ -0,0 +1,72 @@
+"""Composite indexes and denormalized conversation counters
+
+- messages(conversation_id, created_at, id) for per-conversation history reads
+- conversations(user_id, last_message_at) for the conversation list
+- conversations.message_count / last_message_at, maintained by
+  crud.append_message, so the list endpoint never scans messages
+- conversations.updated_at gets a default and is backfilled (it used to be
+  NULL until the row itself was updated, which never happened)
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.add_column(sa.Column("message_count", sa.Integer(), nullable=False, server_default="0"))
+        batch_op.add_column(sa.Column("last_message_at", sa.DateTime(timezone=True), nullable=True))
+        batch_op.alter_column("updated_at", server_default=sa.func.now())
+
+    # Backfill from existing messages
+    op.execute("""
+        UPDATE conversations SET
+            message_count = (
+                SELECT count(*) FROM messages WHERE messages.conversation_id = conversations.id
+            ),
+            last_message_at = COALESCE(
+                (SELECT max(messages.created_at) FROM messages WHERE messages.conversation_id = conversations.id),
+                conversations.created_at,
+                CURRENT_TIMESTAMP
+            )
+    """)
+    op.execute("UPDATE conversations SET updated_at = last_message_at WHERE updated_at IS NULL")
+
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.alter_column(
+            "last_message_at",
+            existing_type=sa.DateTime(timezone=True),
+            nullable=False,
+            server_default=sa.func.now(),
+        )
+
+    op.create_index(
+        "ix_conversations_user_id_last_message_at",
+        "conversations",
+        ["user_id", "last_message_at"],
+    )
+    op.create_index(
+        "ix_messages_conversation_id_created_at_id",
+        "messages",
+        ["conversation_id", "created_at", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_conversation_id_created_at_id", table_name="messages")
+    op.drop_index("ix_conversations_user_id_last_message_at", table_name="conversations")
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.alter_column("updated_at", server_default=None)
+        batch_op.drop_column("last_message_at")
+        batch_op.drop_column("message_count")
@@ -0,0 +1,43 @@
+"""Shared admission control state
+
+- rate_limit_buckets: per-user token buckets
+- llm_slots: leases on the LLM concurrency slots
+
+Only used with ADMISSION_BACKEND=database (see app/admission.py).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "rate_limit_buckets",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tokens", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.create_table(
+        "llm_slots",
+        sa.Column("slot", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("holder", sa.String(), nullable=True),
+        sa.Column("expires_at", sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint("slot"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("llm_slots")
+    op.drop_table("rate_limit_buckets")
@@ -0,0 +1,75 @@
+"""Full-text search index over message content
+
+- PostgreSQL: messages.content_tsv, a generated tsvector column (English
+  stemming), with a GIN index
+- SQLite: messages_fts, an external-content FTS5 table kept in step by
+  triggers on messages
+
+Either way the index is written by the same statement/transaction as the
+message itself, so search never sees a half-indexed message. Neither is
+in app/models.py (the ORM never reads them); app/search.py queries them
+directly, and migrations/env.py keeps autogenerate from dropping them.
+
+SQLite note: a batch migration that rebuilds the messages table drops
+the triggers below; recreate them in that migration.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        # Generated columns need PostgreSQL 12+
+        op.execute("""
+            ALTER TABLE messages ADD COLUMN content_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
+        """)
+        op.execute("CREATE INDEX ix_messages_content_tsv ON messages USING GIN (content_tsv)")
+    elif dialect == "sqlite":
+        op.execute("""
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='porter unicode61'
+            )
+        """)
+        op.execute("""
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        # Index the messages that already exist
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.execute("DROP INDEX ix_messages_content_tsv")
+        op.execute("ALTER TABLE messages DROP COLUMN content_tsv")
+    elif dialect == "sqlite":
+        op.execute("DROP TRIGGER messages_fts_update")
+        op.execute("DROP TRIGGER messages_fts_delete")
+        op.execute("DROP TRIGGER messages_fts_insert")
+        op.execute("DROP TABLE messages_fts")